@@ -1,6 +1,8 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from MultihopAttention.Layer import LSTM_Hidden_List
+from Util import sequence_length
 
 class AILSTM(nn.Module):
     def __init__(self,
@@ -16,21 +18,36 @@ class AILSTM(nn.Module):
         self.weight_last = nn.Linear(2 * args.lstm_hidden_size, args.num_class)
 
 
+    def interaction_max(self, question_lstm, answer_lstm):
+        '''
+        max pooling of the interaction A = tanh(weight_a([q_i; a_j])) over the question and the answer axis
+        weight_a([q_i; a_j]) = W_q q_i + W_a a_j + b and tanh is increasing, so
+        max_i A_ij = tanh(max_i W_q q_i + W_a a_j + b), the batch * L_q * L_a * hidden tensor is never built
+        :return: r_q batch * L_a * hidden, r_a batch * L_q * hidden
+        '''
+        hidden_size = question_lstm.shape[-1]
+        # ATTENTION: question is the first half of the concatenation
+        question_proj = F.linear(question_lstm, self.weight_a.weight[:, :hidden_size])
+        answer_proj = F.linear(answer_lstm, self.weight_a.weight[:, hidden_size:], self.weight_a.bias)
+        #ATTENTION: activate function is tanh
+        r_q = torch.tanh(torch.max(question_proj, dim=-2, keepdim=True)[0] + answer_proj)
+        r_a = torch.tanh(question_proj + torch.max(answer_proj, dim=-2, keepdim=True)[0])
+        return r_q, r_a
+
     def forward(self, question_content, answer_content):
         question_embed = self.wordEmbedd(question_content)
         answer_embed = self.wordEmbedd(answer_content)
-        question_lstm = self.LSTM(question_embed)
-        answer_lstm = self.LSTM(answer_embed)
-
-        # batch * question_length * answer_length * lstm_hidden_size
-        question_length = question_lstm.shape[-2]
-        answer_length = answer_lstm.shape[-2]
-        question_lstm_expand = question_lstm.unsqueeze(2).expand(-1, -1, answer_length, -1)
-        answer_lstm_expand = answer_lstm.unsqueeze(1).expand(-1, question_length, -1, -1)
-        #ATTENTION: activate function is tanh
-        A = torch.tanh(self.weight_a(torch.cat((question_lstm_expand, answer_lstm_expand), dim=-1)))
-        r_q, _ = torch.max(A, dim=-3)
-        r_a, _ = torch.max(A, dim=-2)
+        question_length, answer_length, total_length = None, None, None
+        if self.args.pack_sequence:
+            # outputs end at the longest post of the batch, the interaction below shrinks with them
+            question_length = sequence_length(question_content)
+            answer_length = sequence_length(answer_content)
+            # r_q runs over the answer positions and is joined with question_lstm, both need one length
+            total_length = int(max(question_length.max(), answer_length.max()))
+        question_lstm = self.LSTM(question_embed, question_length, total_length)
+        answer_lstm = self.LSTM(answer_embed, answer_length, total_length)
+
+        r_q, r_a = self.interaction_max(question_lstm, answer_lstm)
         cat_q = torch.cat((question_lstm, r_q), dim=-1)
         cat_a = torch.cat((answer_lstm, r_a), dim=-1)
         alpha_q = torch.softmax(self.a_feedfroward_question(cat_q), dim=-2)
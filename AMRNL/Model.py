@@ -1,7 +1,7 @@
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
-from Util import LSTM_MeanPool
+from Util import LSTM_MeanPool, sequence_length
 
 
 '''
@@ -37,6 +37,50 @@ class AMRNL(nn.Module):
         # self.drop_out = nn.Dropout(args.drop_out_lstm)
 
 
+    def encode(self, content):
+        '''
+        mean pooled lstm of a batch of posts, questions and answers share the encoder
+        '''
+        content_length = sequence_length(content) if self.args.pack_sequence else None
+        return self.lstm_meanpool(self.word2vec(content), content_length)
+
+    def question_representation(self, question):
+        '''
+        question half of the score, see score_representation
+        '''
+        question_lstm = self.encode(question)
+        if self.args.is_classification:
+            return self.question_weight(question_lstm)
+        return question_lstm
+
+    def answer_representation(self, answer, user):
+        '''
+        answer half of the score, computed once for the whole answer pool when serving
+        classification: answer_weight(a) + user_weight(u), ranking: M a of the bilinear match and u
+        :param user: N, author of every answer
+        '''
+        answer_lstm = self.encode(answer)
+        user_embed_feature = self.user_embed(user)
+        if self.args.is_classification:
+            return self.answer_weight(answer_lstm) + self.user_weight(user_embed_feature)
+        m_a = F.linear(answer_lstm, self.smantic_mach_bilinear.weight[0])
+        return torch.cat((m_a, user_embed_feature), dim=-1)
+
+    def score_representation(self, question_rep, answer_rep):
+        '''
+        score of every question against every answer, the same score forward gives for the pair
+        :param question_rep: Q * d from question_representation
+        :param answer_rep: N * d' from answer_representation
+        :return: Q * N
+        '''
+        if self.args.is_classification:
+            score = self.classify_weight(torch.tanh(question_rep.unsqueeze(1) + answer_rep.unsqueeze(0)))
+            return torch.softmax(score, dim=-1)[:, :, 1]
+        hidden_size = question_rep.shape[-1]
+        match_score = torch.mm(question_rep, answer_rep[:, :hidden_size].t()) + self.smantic_mach_bilinear.bias
+        relevance_score = torch.mm(question_rep, answer_rep[:, hidden_size:].t())
+        return match_score * relevance_score
+
     def forward(self,
                 question_list,
                 answer_list,
@@ -44,12 +88,10 @@ class AMRNL(nn.Module):
                 ):
 
 
-        question_embed_feature = self.word2vec(question_list)
-        answer_embed_feature = self.word2vec(answer_list)
         user_embed_feature = self.user_embed(user_list)
 
-        question_lstm = self.lstm_meanpool(question_embed_feature)
-        answer_lstm = self.lstm_meanpool(answer_embed_feature)
+        question_lstm = self.encode(question_list)
+        answer_lstm = self.encode(answer_list)
         # question_lstm = self.drop_out(question_lstm)
         # answer_lstm = self.drop_out(answer_lstm)
 
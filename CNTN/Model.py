@@ -30,19 +30,61 @@ class CNTN(nn.Module):
         nn.init.xavier_normal_(self.linear_V.weight)
         nn.init.xavier_normal_(self.linear_U.weight)
 
-    def forward(self, question, answer):
+    def encode(self, content):
+        '''
+        cnn feature of a batch of posts, questions and answers share the encoder
+        :param content: N * L word ids
+        :return: N * lstm_hidden_size
+        '''
+        content_embed = self.word_embedding(content).unsqueeze(1)
+        content_cnn, _ = torch.max(torch.relu(self.cnn_lr(content_embed)), dim=-2)
+        content_cnn = self.dropout(self.bn(content_cnn))
+        return content_cnn.squeeze(-1)
+
+    def question_representation(self, question):
+        '''
+        question half of the score, see score_representation
+        '''
+        question_cnn = self.encode(question)
+        if self.args.is_classification:
+            return self.weight_question(question_cnn)
+        hidden_size = question_cnn.shape[-1]
+        return torch.cat((question_cnn, F.linear(question_cnn, self.linear_V.weight[:, :hidden_size])), dim=-1)
+
+    def answer_representation(self, answer):
+        '''
+        answer half of the score, computed once for the whole answer pool when serving
+        classification: weight_answer(a), ranking: M_k a of every slice of bilinear_M, then V_a a + b
+        '''
+        answer_cnn = self.encode(answer)
+        if self.args.is_classification:
+            return self.weight_answer(answer_cnn)
+        hidden_size = answer_cnn.shape[-1]
+        m_a = torch.einsum('kij,nj->nki', self.bilinear_M.weight, answer_cnn).reshape(answer_cnn.shape[0], -1)
+        v_a = F.linear(answer_cnn, self.linear_V.weight[:, hidden_size:], self.bilinear_M.bias)
+        return torch.cat((m_a, v_a), dim=-1)
+
+    def score_representation(self, question_rep, answer_rep):
+        '''
+        score of every question against every answer, the same score forward gives for the pair
+        :param question_rep: Q * d from question_representation
+        :param answer_rep: N * d' from answer_representation
+        :return: Q * N
+        '''
+        if self.args.is_classification:
+            score = self.last_weight(torch.tanh(question_rep.unsqueeze(1) + answer_rep.unsqueeze(0)))
+            return F.softmax(score, dim=-1)[:, :, 1]
+        feature_r = self.args.cntn_feature_r
+        hidden_size = question_rep.shape[-1] - feature_r
+        question_cnn, v_q = question_rep[:, :hidden_size], question_rep[:, hidden_size:]
+        m_a = answer_rep[:, :feature_r * hidden_size].view(-1, feature_r, hidden_size)
+        q_m_a = torch.einsum('qi,nki->qnk', question_cnn, m_a) + v_q.unsqueeze(1) + answer_rep[:, feature_r * hidden_size:].unsqueeze(0)
+        return self.linear_U(torch.tanh(q_m_a)).squeeze(-1)
 
-        question_embed = self.word_embedding(question)
-        question_embed.unsqueeze_(1)
-        answer_embed = self.word_embedding(answer)
-        answer_embed.unsqueeze_(1)
+    def forward(self, question, answer):
 
-        question_cnn, _ = torch.max(torch.relu(self.cnn_lr(question_embed)), dim=-2)
-        question_cnn = self.bn(question_cnn)
-        answer_cnn, _ = torch.max(torch.relu(self.cnn_lr(answer_embed)), dim=-2)
-        answer_cnn = self.bn(answer_cnn)
-        question_cnn = self.dropout(question_cnn)
-        answer_cnn = self.dropout(answer_cnn)
+        question_cnn = self.encode(question)
+        answer_cnn = self.encode(answer)
 
         # cnn_count = len(self.cnn_list)
         # for depth, cnn in enumerate(self.cnn_list):
@@ -67,8 +109,6 @@ class CNTN(nn.Module):
         # # Final Layer
         # question_embed = matrix2vec_max_pooling(question_embed, dim=-1)
         # answer_embed = matrix2vec_max_pooling(answer_embed, dim =-1)
-        question_cnn.squeeze_()
-        answer_cnn.squeeze_()
         # question_embed.squeeze_()
         # answer_embed.squeeze_()
         # q_m_a = self.bilinear_M(question_embed, answer_embed)
@@ -1,3 +1,4 @@
+import os
 import torch
 class config_data_preprocess:
 
@@ -16,9 +17,17 @@ class config_data_preprocess:
 
     # store preprocessed data
     save_data = "data/math_remove.torchpickle" if not is_classification else "data/store_SemEval_cate.torchpickle"
+    # write a directory of memory-mappable arrays (save_data without extension) instead of one pickle
+    columnar = True
     log_file = "text_log/preprocess.log"
     logger_name = "preprocess"
     max_love_count = 10
+    #parse Posts.xml / Votes.xml with iterparse instead of loading the whole tree
+    xml_streaming = True
+    #processes used by text cleaning, 1 runs in the main process
+    clean_worker = 4
+    #posts handed to a cleaning worker at a time
+    clean_chunk_size = 1000
 
 
 class config_model:
@@ -33,6 +42,14 @@ class config_model:
 
     #dataset
     neg_size = 1
+    #gather a whole batch with numpy fancy indexing instead of one row per __getitem__
+    batch_fetch = True
+    #batch rows of similar question + answer length together (DataSet.sampler.LengthBucketBatchSampler)
+    length_bucket = True
+    #batches sorted together by length, larger pools give tighter batches but less randomness
+    bucket_pool = 50
+    #run the lstm encoders on packed sequences and mean pool over the real words only
+    pack_sequence = True
 
 
 
@@ -43,6 +60,33 @@ class config_model:
     batch_size = 64
     num_class = 2 if is_classification else 1
 
+    #grid search
+    #trials trained at the same time, cpu threads are split among them
+    grid_worker = 1
+    #one csv row of metrics per trial, {} is the dataset name
+    grid_result_file = "result/grid_{}.csv"
+    #stop trials early with asynchronous successive halving
+    halving = False
+    #validation metric of eval_epoch that decides which trials go on
+    halving_metric = "P@1"
+    #first rung epoch, later rungs are min_epoch * reduction^k
+    halving_min_epoch = 2
+    #keep the top 1/reduction of the trials at every rung
+    halving_reduction = 3
+    #rung records, {} is the dataset name
+    halving_dir = "result/halving_{}"
+    #save model / optimizer / random states while training, a killed run or sweep resumes where it stopped
+    #runs that already ended are not trained again, their stored metrics are reported; clear checkpoint_dir to rerun
+    checkpoint = False
+    #one sub directory per grid search trial, {} is the dataset name
+    checkpoint_dir = "result/checkpoint_{}"
+    #epochs between two checkpoints, the last epoch is always saved
+    checkpoint_every = 1
+    #validation metric ranking the kept checkpoints
+    checkpoint_metric = "P@1"
+    #best checkpoints kept besides the last one
+    checkpoint_best = 3
+
 
 
 
@@ -51,7 +95,9 @@ class config_model:
     # data = "data/store_stackoverflow_datascience.torchpickle"
     # data = "/home/yichuan/course/induceiveAnswer/data/store_SemEval.torchpickle"
     # data = "data/store_SemEval.torchpickle"
-    data = "data/store_SemEval_cate.torchpickle"
+    # data = "data/store_SemEval_cate.torchpickle"
+    # what preprocess.py last wrote: the directory of save_data without extension when columnar
+    data = os.path.splitext(config_data_preprocess.save_data)[0] if config_data_preprocess.columnar else config_data_preprocess.save_data
 
     #=====================
     #content_data setting
@@ -64,6 +110,8 @@ class config_model:
     #max length of user context
     max_u_len = 200
     k_neighbor = 5
+    #reuse the lda annoy index and the same category neighbor tables test_qn built in an earlier run
+    neighbor_pretrain = False
 
 
     # learning rate
@@ -73,6 +121,8 @@ class config_model:
     #word embedding setting
     #======================
     embed_fileName="data/glove/glove.6B.100d.txt"
+    #float32 .npy of the vocabulary rows, keyed by embedding file, vocabulary and embed size
+    embed_cache_dir = "data/embed_cache"
     #vocabulary size
     vocab_size = 30000
     #word to vector embed size
@@ -109,6 +159,31 @@ class config_model:
     # location to store or load model
     cov_model_path = "result"
 
+    #serving (serve_answer.py)
+    #CNTN / AMRNL score the whole answer pool, BiLstMCNN / Hybrid re-score annoy candidates
+    serve_model = "CNTN"
+    #state dict of the trained model
+    serve_model_file = "result/serve_model.pt"
+    serve_top_k = 10
+    #answers taken from the annoy index before re-scoring
+    serve_candidate = 200
+    #only re-score annoy candidates even for CNTN / AMRNL
+    serve_use_annoy = False
+    #prefix of the answer representations and the annoy index
+    serve_cache = "data/serve_cache/answer"
+    #reuse the cached representations / annoy index when they were built from the same weights and answer pool
+    serve_load_cache = True
+    #scoring server (serve_score.py), serves serve_model
+    score_socket = "/tmp/answer_score.sock"
+    #rows (question, answer pairs) merged into one forward
+    score_batch_rows = 256
+    #a batch waits at most this long for more requests after its first one
+    score_wait_ms = 5
+    #run local clients against the server and print the latency percentiles instead of serving
+    score_bench = False
+    score_bench_request = 1000
+    score_bench_client = 16
+
     # #Rank evaluate setting
     # ndcg_k = 2
 
@@ -139,6 +214,20 @@ class config_model:
     neighbor_number_list = [2]
     graphsage_depth = len(neighbor_number_list)
     max_degree = 6
+    #redraw the padded neighbor table from the CSR adjacency at the start of every epoch
+    resample_adj = False
+    #seed of the neighbor sampler generator, None follows the global torch seed
+    sampler_seed = None
+    #draw neighbors proportional to their degree instead of uniformly
+    degree_weighted_sample = False
+    #encode every unique post / user context once per forward instead of once per hop, eval mode only
+    encode_dedup = True
+    #reuse the encodings across batches while the model is in eval mode
+    eval_encode_cache = True
+    #validation computes every node representation once and scores edges by lookup
+    eval_node_table = True
+    #nodes per batch when the node table is built
+    node_table_batch = 512
 
     #==============
     #ARMNL smooth
@@ -6,6 +6,31 @@ from Constants import Constants
 from random import shuffle
 import itertools
 from scipy.stats import rankdata
+from DataSet.sampler import NegativeSampler
+
+
+def content_matrix(content_embed):
+    # padded content as one matrix, rows are gathered by numpy fancy indexing in batch fetch mode
+    # the array (memmap of a preprocessed directory) is shared as is, lists of the old pickle are
+    # converted once per ContentEmbed and not once per dataset
+    content = content_embed.content_list
+    if isinstance(content, np.ndarray):
+        return content
+    if getattr(content_embed, "content_matrix", None) is None:
+        content_embed.content_matrix = np.asarray(content)
+    return content_embed.content_matrix
+
+
+def gather_content(matrix, row):
+    # only the gathered rows are cast to int64
+    return torch.from_numpy(matrix[row].astype(np.int64, copy=False))
+
+
+def pair_length(content_embed, question_answer_user_vote, user_count):
+    # words of question + answer of every row, the sort key of length bucketing
+    length = np.asarray(content_embed.length_list, dtype=np.int64)
+    lines = np.asarray(question_answer_user_vote)
+    return length[lines[:, 0] - user_count] + length[lines[:, 1] - user_count]
 
 
 def context_collect_fn_train(batch):
@@ -34,12 +59,13 @@ def my_clloect_fn_train(batch):
     return (question_content, answer_pos_content, answer_neg_list)
 
 def my_collect_fn_test(batch):
-    question_content, answer_pos_content, score_pos_list, question_id = list(zip(*batch))
+    question_content, answer_pos_content, score_pos_list, question_id, answer_id = list(zip(*batch))
     question_content = torch.LongTensor(question_content)
     answer_pos_content =torch.LongTensor(answer_pos_content)
     score_pos_list = torch.FloatTensor(score_pos_list)
     question_id = torch.LongTensor(question_id)
-    return (question_content, answer_pos_content, score_pos_list, question_id)
+    answer_id = torch.LongTensor(answer_id)
+    return (question_content, answer_pos_content, score_pos_list, question_id, answer_id)
 
 def my_collect_fn_train_hybrid(batch):
     question_content, answer_content, user_context, score, neg_ans_content, \
@@ -56,13 +82,14 @@ def my_collect_fn_train_hybrid(batch):
 
 
 def my_collect_fn_test_hybrid(batch):
-    question_content, answer_content, user_context, score, question_id = list(zip(*batch))
+    question_content, answer_content, user_context, score, question_id, answer_id = list(zip(*batch))
     question_content = torch.LongTensor(question_content)
     answer_content = torch.LongTensor(answer_content)
     user_context = torch.LongTensor(user_context)
     score = torch.FloatTensor(score)
     question_id = torch.LongTensor(question_id)
-    return question_content, answer_content, user_context, score, question_id
+    answer_id = torch.LongTensor(answer_id)
+    return question_content, answer_content, user_context, score, question_id, answer_id
 
 # def my_collect_fn_test(batch):
 #
@@ -104,7 +131,45 @@ def classify_collect_fn_Nei(batch):
     return q_iter, question_key, question_neighbor, question_neighbor_key, a_iter, u_iter, gt_iter
 
 
-class rankDataNei(data.Dataset):
+class QuestionNeighborDataset(data.Dataset):
+    '''
+    same category neighbors of the question of a row, subclasses set user_count, k,
+    question_answer_user_vote_cate, question_neighbor_finder and question_neighbor_table
+    '''
+
+    def findSimCate(self, cate_index):
+        same_cate = self.question_answer_user_vote_cate[self.question_answer_user_vote_cate[:,-1] == cate_index][:,0]
+
+        return same_cate
+
+    def questionNeighbor(self, question_id, cate_index):
+        if self.question_neighbor_table is not None:
+            question_key = self.question_neighbor_table.get_item(question_id - self.user_count).tolist()
+            question_neighbor = self.question_neighbor_table.find_by_index(question_id - self.user_count, self.k)
+            question_neighbor_feature = self.question_neighbor_table.get_item(question_neighbor).tolist()
+            question_neighbor = (question_neighbor + self.user_count).tolist()
+            return question_key, question_neighbor, question_neighbor_feature
+        question_key = self.question_neighbor_finder.get_item(question_id - self.user_count)
+        sam_cateory = self.findSimCate(cate_index)
+        question_neighbor = self.nearestNeighbor(sam_cateory - self.user_count, question_id - self.user_count)
+        # question_neighbor = self.question_neighbor_finder.find_by_index(question_id - self.user_count, self.k)
+        question_neighbor_feature = [self.question_neighbor_finder.get_item(i) for i in question_neighbor]
+        question_neighbor = [item + self.user_count for item in question_neighbor]
+        return question_key, question_neighbor, question_neighbor_feature
+
+    def nearestNeighbor(self, neighbors, index):
+        distance_list = [self.question_neighbor_finder.get_distance(index, i) for i in neighbors]
+        sort_index = np.argsort(distance_list)
+        if len(sort_index) < self.k:
+            result = neighbors[sort_index]
+            more = self.k - len(sort_index)
+            result = np.append(result, self.question_neighbor_finder.find_by_index(index, more))
+        else:
+            result = neighbors[sort_index[:self.k]]
+        return result
+
+
+class rankDataNei(QuestionNeighborDataset):
     def __init__(self,
                  args,
                  question_answer_user_vote_cate,
@@ -113,50 +178,25 @@ class rankDataNei(data.Dataset):
                  user_count,
                  question_count,
                  is_training=False,
-                 answer_user_dic=None
+                 answer_user_dic=None,
+                 question_neighbor_table=None
                  ):
         super(rankDataNei, self).__init__()
         self.args = args
         self.question_answer_user_vote_cate = question_answer_user_vote_cate
         self.question_neighbor_finder = question_neighbor_finder
+        # SimQues.Layer.CategoryNeighbor, precomputed same category neighbors
+        self.question_neighbor_table = question_neighbor_table
         self.user_count = user_count
         self.k = args.k_neighbor
         self.question_count = question_count
         self.answer_score = answer_score
-        self.answer_index_sort = self.rankAnswer(answer_score)
+        self.negative_sampler = NegativeSampler(answer_score, args.neg_size, user_count + question_count)
         self.is_training = is_training
         self.answer_user_dic = answer_user_dic
 
-    def findSimCate(self, cate_index):
-        same_cate = self.question_answer_user_vote_cate[self.question_answer_user_vote_cate[:,-1] == cate_index][:,0]
-
-        return same_cate
-
-    def nearestNeighbor(self, neighbors, index):
-        distance_list = [self.question_neighbor_finder.get_distance(index, i) for i in neighbors]
-        sort_index = np.argsort(distance_list)
-        if len(sort_index) < self.k:
-            result = neighbors[sort_index]
-            more = self.k - len(sort_index)
-            result = np.append(result, self.question_neighbor_finder.find_by_index(index, more))
-        else:
-            result = neighbors[sort_index[:self.k]]
-        return result
-
-    def rankAnswer(self, answer_score):
-        # small in the begin
-        rank_answer_index = np.argsort(answer_score)
-        return rank_answer_index
-
     def negative_sampling(self, answerid):
-        answerid = answerid - self.user_count - self.question_count
-        locate = np.where(self.answer_index_sort == answerid)[0][0]
-        if locate > self.args.neg_size:
-            negative_answer = np.random.choice(list(range(locate)), self.args.neg_size, replace=False)
-        else:
-            negative_answer = np.random.choice(list(range(len(self.answer_score))), self.args.neg_size, replace=False)
-        negative_answer = negative_answer[0]
-        return negative_answer + self.user_count + self.question_count
+        return self.negative_sampler.sample(answerid)
 
 
     def __len__(self):
@@ -165,12 +205,8 @@ class rankDataNei(data.Dataset):
     def __getitem__(self, index):
         question_answer_vote_line = self.question_answer_user_vote_cate[index]
         question_id = question_answer_vote_line[0]
-        question_key = self.question_neighbor_finder.get_item(question_id - self.user_count)
-        sam_cateory = self.findSimCate(question_answer_vote_line[4])
-        question_neighbor = self.nearestNeighbor(sam_cateory - self.user_count, question_id - self.user_count)
-        # question_neighbor = self.question_neighbor_finder.find_by_index(question_id - self.user_count, self.k)
-        question_neighbor_feature = [self.question_neighbor_finder.get_item(i) for i in question_neighbor]
-        question_neighbor = [item + self.user_count for item in question_neighbor]
+        question_key, question_neighbor, question_neighbor_feature = \
+            self.questionNeighbor(question_id, question_answer_vote_line[4])
 
 
         answer_id = question_answer_vote_line[1]
@@ -188,47 +224,30 @@ class rankDataNei(data.Dataset):
 
 
 
-class classifyDataNei(data.Dataset):
+class classifyDataNei(QuestionNeighborDataset):
     def __init__(self,
                  args,
                  question_answer_user_vote_cate,
                  question_neighbor_finder,
-                 user_count
+                 user_count,
+                 question_neighbor_table=None
                  ):
         self.args = args
         self.question_answer_user_vote_cate = question_answer_user_vote_cate
         self.question_neighbor_finder = question_neighbor_finder
+        # SimQues.Layer.CategoryNeighbor, precomputed same category neighbors
+        self.question_neighbor_table = question_neighbor_table
         self.user_count = user_count
         self.k = args.k_neighbor
 
-    def findSimCate(self, cate_index):
-        same_cate = self.question_answer_user_vote_cate[self.question_answer_user_vote_cate[:,-1] == cate_index][:,0]
-
-        return same_cate
-
-    def nearestNeighbor(self, neighbors, index):
-        distance_list = [self.question_neighbor_finder.get_distance(index, i) for i in neighbors]
-        sort_index = np.argsort(distance_list)
-        if len(sort_index) < self.k:
-            result = neighbors[sort_index]
-            more = self.k - len(sort_index)
-            result = np.append(result, self.question_neighbor_finder.find_by_index(index, more))
-        else:
-            result = neighbors[sort_index[:self.k]]
-        return result
-
     def __len__(self):
         return len(self.question_answer_user_vote_cate)
 
     def __getitem__(self, index):
         question_answer_vote_line = self.question_answer_user_vote_cate[index]
         question_id = question_answer_vote_line[0]
-        question_key = self.question_neighbor_finder.get_item(question_id - self.user_count)
-        sam_cateory = self.findSimCate(question_answer_vote_line[4])
-        question_neighbor = self.nearestNeighbor(sam_cateory - self.user_count, question_id - self.user_count)
-        # question_neighbor = self.question_neighbor_finder.find_by_index(question_id - self.user_count, self.k)
-        question_neighbor_feature = [self.question_neighbor_finder.get_item(i) for i in question_neighbor]
-        question_neighbor = [item + self.user_count for item in question_neighbor]
+        question_key, question_neighbor, question_neighbor_feature = \
+            self.questionNeighbor(question_id, question_answer_vote_line[4])
 
 
         answer_id = question_answer_vote_line[1]
@@ -309,7 +328,7 @@ class rankDataSetEdge(data.Dataset):
         self.question_count = question_count
         self.answer_score = answer_score
         self.answer_user_dic = answer_user_dic
-        self.answer_index_sort = self.rankAnswer(answer_score)
+        self.negative_sampler = NegativeSampler(answer_score, args.neg_size, user_count + question_count)
         self.edges = self.edgeGenre()
 
     def edgeGenre(self):
@@ -322,20 +341,8 @@ class rankDataSetEdge(data.Dataset):
                 edges.append(edge)
         return edges
 
-    def rankAnswer(self, answer_score):
-        # small in the begin
-        rank_answer_index = np.argsort(answer_score)
-        return rank_answer_index
-
     def negative_sampling(self, answerid):
-        answerid = answerid - self.user_count - self.question_count
-        locate = np.where(self.answer_index_sort == answerid)[0][0]
-        if locate > self.args.neg_size:
-            negative_answer = np.random.choice(list(range(locate)), self.args.neg_size, replace=False)
-        else:
-            negative_answer = np.random.choice(list(range(len(self.answer_score))), self.args.neg_size, replace=False)
-        negative_answer = negative_answer[0]
-        return negative_answer + self.user_count + self.question_count
+        return self.negative_sampler.sample(answerid)
 
     def __len__(self):
         return len(self.edges)
@@ -367,11 +374,27 @@ class classifyDataOrdinary(data.Dataset):
         self.content = content
         self.question_answer_user_vote = question_answer_user_vote
         self.user_count = user_count
+        if self.args.batch_fetch:
+            self.content_matrix = content_matrix(content)
+            self.question_answer_user_vote_array = np.asarray(question_answer_user_vote)
+
+    def sample_length(self):
+        return pair_length(self.content, self.question_answer_user_vote, self.user_count)
 
     def __len__(self):
         return len(self.question_answer_user_vote)
 
+    def get_batch(self, index):
+        lines = self.question_answer_user_vote_array[index]
+        question_content = gather_content(self.content_matrix, lines[:, 0] - self.user_count)
+        answer_content = gather_content(self.content_matrix, lines[:, 1] - self.user_count)
+        label_list = torch.from_numpy(lines[:, 3].astype(np.int64))
+        question_id = torch.from_numpy(lines[:, 0].astype(np.int64))
+        return question_content, answer_content, label_list, question_id
+
     def __getitem__(self, index):
+        if isinstance(index, (list, np.ndarray)):
+            return self.get_batch(index)
         question_answer_vote_line = self.question_answer_user_vote[index]
         question_id = question_answer_vote_line[0]
         answer_id = question_answer_vote_line[1]
@@ -394,6 +417,7 @@ class rankDataOrdinary(data.Dataset):
                  ):
         self.args = args
         self.content = content_embed
+        self.content_embed = content_embed
         self.question_answer_user_vote = question_answer_user_vote
 
         self.user_count = user_count
@@ -402,30 +426,40 @@ class rankDataOrdinary(data.Dataset):
         self.is_Multihop = is_Multihop
         if self.is_training:
             self.answer_score = answer_score
-            self.answer_index_sort = self.rankAnswer(answer_score)
-
-    def rankAnswer(self, answer_score):
-        # small in the begin
-        rank_answer_index = np.argsort(answer_score)
-        return rank_answer_index
+            self.negative_sampler = NegativeSampler(answer_score, args.neg_size, user_count + question_count,
+                                                    uniform=is_Multihop)
+        if self.args.batch_fetch:
+            self.content_matrix = content_matrix(content_embed)
+            self.question_answer_user_vote_array = np.asarray(question_answer_user_vote)
 
     def negative_sampling(self, answerid):
-        # rank = self.rank_score[answerid - self.user_count - self.question_count]
-        # negative_answer_candidate = self.rank_index[:rank]
-        answerid = answerid - self.user_count - self.question_count
-        locate = np.where(self.answer_index_sort == answerid)[0][0]
-        if locate > self.args.neg_size and self.is_Multihop is False:
-            negative_answer = np.random.choice(list(range(locate)), self.args.neg_size, replace=False)
-        else:
-            negative_answer = np.random.choice(list(range(len(self.answer_score))), self.args.neg_size, replace=False)
-        negative_answer = negative_answer[0]
-        return negative_answer + self.user_count + self.question_count
+        return self.negative_sampler.sample(answerid)
 
 
+    def sample_length(self):
+        return pair_length(self.content, self.question_answer_user_vote, self.user_count)
+
     def __len__(self):
         return len(self.question_answer_user_vote)
 
+    def get_batch(self, index):
+        lines = self.question_answer_user_vote_array[index]
+        question_content = gather_content(self.content_matrix, lines[:, 0] - self.user_count)
+        answer_content = gather_content(self.content_matrix, lines[:, 1] - self.user_count)
+        if self.is_training:
+            neg_ans = self.negative_sampler.sample_batch(lines[:, 1])
+            neg_ans_content = gather_content(self.content_matrix, neg_ans - self.user_count)
+            return question_content, answer_content, neg_ans_content
+        else:
+            score = torch.from_numpy(lines[:, 3].astype(np.float32))
+            question_id = torch.from_numpy(lines[:, 0].astype(np.int64))
+            # answer ids let the diversity metric gather the content of the top answers afterwards
+            answer_id = torch.from_numpy(lines[:, 1].astype(np.int64))
+            return question_content, answer_content, score, question_id, answer_id
+
     def __getitem__(self, index):
+        if isinstance(index, (list, np.ndarray)):
+            return self.get_batch(index)
         question_answer_vote_line = self.question_answer_user_vote[index]
         question_id = question_answer_vote_line[0]
         answer_id = question_answer_vote_line[1]
@@ -438,47 +472,90 @@ class rankDataOrdinary(data.Dataset):
 
             return question_content, answer_content, neg_ans_content
         else:
-            return question_content, answer_content, pos_score, question_id
+            return question_content, answer_content, pos_score, question_id, answer_id
+
+
+
+
 
 
+class UserContextDataset(data.Dataset):
+    '''
+    user documents of the datasets with user context, subclasses set args, user_count, content_embed,
+    user_context, user_context_file, user_context_matrix = None and is_hybrid
+    '''
+    is_hybrid = True
 
+    def get_user_context(self, userid):
+        if self.user_context_file is not None:
+            if self.user_context_matrix is None:
+                # open lazily so that every DataLoader worker maps the same pages
+                self.user_context_matrix = np.load(self.user_context_file, mmap_mode='r')
+            return self.user_context_matrix[userid].tolist()
+        document = []
+        for answer_id in self.user_context[userid]:
+            document += self.content_embed.content_embed(answer_id - self.user_count)
+            if len(document) > self.args.max_u_len:
+                document = document[:self.args.max_u_len]
+                break
+        if len(document) < self.args.max_u_len:
+            pad_word = [Constants.PAD] * (self.args.max_u_len - len(document))
+            document += pad_word
+        return document
 
+    def get_user_context_batch(self, user_id):
+        if not self.is_hybrid:
+            return torch.from_numpy(user_id.astype(np.int64))
+        if self.user_context_file is not None:
+            if self.user_context_matrix is None:
+                self.user_context_matrix = np.load(self.user_context_file, mmap_mode='r')
+            return torch.from_numpy(self.user_context_matrix[user_id].astype(np.int64))
+        return torch.LongTensor([self.get_user_context(i) for i in user_id])
 
 
-class classifyDataSetUserContext(data.Dataset):
+class classifyDataSetUserContext(UserContextDataset):
     def __init__(self,
                  args,
                  question_answer_user_vote,
                  content_embed,
                  user_count,
                  is_hybrid=False,
-                 user_context=None
+                 user_context=None,
+                 user_context_file=None
                  ):
         self.args = args
         self.user_context = user_context
+        # .npy written by UserContextEmbed.buildUserContextEmbed, preferred over user_context
+        self.user_context_file = user_context_file
+        self.user_context_matrix = None
         self.content_embed = content_embed
         self.user_count = user_count
         self.question_answer_user_vote = question_answer_user_vote
         self.is_hybrid = is_hybrid
+        if self.args.batch_fetch:
+            self.content_matrix = content_matrix(content_embed)
+            self.question_answer_user_vote_array = np.asarray(question_answer_user_vote)
 
 
-    def get_user_context(self, userid):
-        document = []
-        for answer_id in self.user_context[userid]:
-            document += self.content_embed.content_embed(answer_id - self.user_count)
-            if len(document) > self.args.max_u_len:
-                document = document[:self.args.max_u_len]
-                break
-        if len(document) < self.args.max_u_len:
-            pad_word = [Constants.PAD] * (self.args.max_u_len - len(document))
-            document += pad_word
-        return document
 
+    def sample_length(self):
+        return pair_length(self.content_embed, self.question_answer_user_vote, self.user_count)
 
     def __len__(self):
         return len(self.question_answer_user_vote)
 
+    def get_batch(self, index):
+        lines = self.question_answer_user_vote_array[index]
+        question_content = gather_content(self.content_matrix, lines[:, 0] - self.user_count)
+        answer_content = gather_content(self.content_matrix, lines[:, 1] - self.user_count)
+        user_context = self.get_user_context_batch(lines[:, 2])
+        label_list = torch.from_numpy(lines[:, 3].astype(np.int64))
+        question_id = torch.from_numpy(lines[:, 0].astype(np.int64))
+        return question_content, answer_content, user_context, label_list, question_id
+
     def __getitem__(self, index):
+        if isinstance(index, (list, np.ndarray)):
+            return self.get_batch(index)
         question_answer_vote_line = self.question_answer_user_vote[index]
         question_id = question_answer_vote_line[0]
         answer_id = question_answer_vote_line[1]
@@ -491,7 +568,7 @@ class classifyDataSetUserContext(data.Dataset):
 
 
 
-class rankDataSetUserContext(data.Dataset):
+class rankDataSetUserContext(UserContextDataset):
     def __init__(self,
                  args,
                  question_answer_user_vote,
@@ -502,10 +579,14 @@ class rankDataSetUserContext(data.Dataset):
                  is_training=True,
                  answer_score=None,
                  answer_user_dic=None,
-                 is_hybrid=False
+                 is_hybrid=False,
+                 user_context_file=None
                  ):
         self.args = args
         self.user_context = user_context
+        # .npy written by UserContextEmbed.buildUserContextEmbed, preferred over user_context
+        self.user_context_file = user_context_file
+        self.user_context_matrix = None
         self.content_embed = content_embed
         self.is_training = is_training
         self.user_count = user_count
@@ -515,44 +596,46 @@ class rankDataSetUserContext(data.Dataset):
         self.is_hybrid = is_hybrid
         if is_training:
             self.answer_score = answer_score
-            self.answer_index_sort = self.rankAnswer(answer_score)
+            self.negative_sampler = NegativeSampler(answer_score, args.neg_size, user_count + question_count)
+        if self.args.batch_fetch:
+            self.content_matrix = content_matrix(content_embed)
+            self.question_answer_user_vote_array = np.asarray(question_answer_user_vote)
+            if is_training:
+                # answer id -> user id as an array, negative users are gathered in one indexing
+                self.answer_user_array = np.zeros(max(answer_user_dic.keys()) + 1, dtype=np.int64)
+                self.answer_user_array[list(answer_user_dic.keys())] = list(answer_user_dic.values())
 
 
 
-    def rankAnswer(self, answer_score):
-        #small in the begin
-        rank_answer_index = np.argsort(answer_score)
-        return rank_answer_index
-
     def negative_sampling(self, answerid):
-        # rank = self.rank_score[answerid - self.user_count - self.question_count]
-        # negative_answer_candidate = self.rank_index[:rank]
-        answerid = answerid - self.user_count - self.question_count
-        locate = np.where(self.answer_index_sort == answerid)[0][0]
-        if locate > self.args.neg_size:
-            negative_answer = np.random.choice(list(range(locate)), self.args.neg_size, replace=False)
-        else:
-            negative_answer = np.random.choice(list(range(len(self.answer_score))), self.args.neg_size, replace=False)
-        negative_answer = negative_answer[0]
-        return negative_answer + self.user_count + self.question_count
+        return self.negative_sampler.sample(answerid)
 
-    def get_user_context(self, userid):
-        document = []
-        for answer_id in self.user_context[userid]:
-            document += self.content_embed.content_embed(answer_id - self.user_count)
-            if len(document) > self.args.max_u_len:
-                document = document[:self.args.max_u_len]
-                break
-        if len(document) < self.args.max_u_len:
-            pad_word = [Constants.PAD] * (self.args.max_u_len - len(document))
-            document += pad_word
-        return document
 
+    def sample_length(self):
+        return pair_length(self.content_embed, self.question_answer_user_vote, self.user_count)
 
     def __len__(self):
         return len(self.question_answer_user_vote)
 
+    def get_batch(self, index):
+        lines = self.question_answer_user_vote_array[index]
+        question_content = gather_content(self.content_matrix, lines[:, 0] - self.user_count)
+        answer_content = gather_content(self.content_matrix, lines[:, 1] - self.user_count)
+        user_context = self.get_user_context_batch(lines[:, 2])
+        score = torch.from_numpy(lines[:, 3].astype(np.float32))
+        if self.is_training:
+            neg_ans = self.negative_sampler.sample_batch(lines[:, 1])
+            neg_ans_content = gather_content(self.content_matrix, neg_ans - self.user_count)
+            neg_user_context = self.get_user_context_batch(self.answer_user_array[neg_ans])
+            return question_content, answer_content, user_context, score, neg_ans_content, neg_user_context
+        else:
+            question_id = torch.from_numpy(lines[:, 0].astype(np.int64))
+            answer_id = torch.from_numpy(lines[:, 1].astype(np.int64))
+            return question_content, answer_content, user_context, score, question_id, answer_id
+
     def __getitem__(self, index):
+        if isinstance(index, (list, np.ndarray)):
+            return self.get_batch(index)
         question_answer_vote_line = self.question_answer_user_vote[index]
         question_id = question_answer_vote_line[0]
         answer_id = question_answer_vote_line[1]
@@ -567,7 +650,7 @@ class rankDataSetUserContext(data.Dataset):
 
             return question_content, answer_content, user_context, score, neg_ans_content, neg_user_context
         else:
-            return question_content, answer_content, user_context, score, question_id
+            return question_content, answer_content, user_context, score, question_id, answer_id
 
 
 
@@ -575,7 +658,7 @@ class rankDataSetUserContext(data.Dataset):
 
 
 
-class rankData(data.Dataset):
+class rankData(UserContextDataset):
     def __init__(self,
                  G,
                  args,
@@ -586,11 +669,15 @@ class rankData(data.Dataset):
                  user_context=None,
                  user_count=None,
                  is_training=True,
-                 answer_user_dic=None
+                 answer_user_dic=None,
+                 user_context_file=None
                  ):
         self.args = args
         self.user_context = user_context
+        self.user_context_file = user_context_file
+        self.user_context_matrix = None
         self.content = content
+        self.content_embed = content
         self.is_training = is_training
         self.user_count = user_count
         self.question_count = question_count
@@ -666,33 +753,15 @@ class rankData(data.Dataset):
                 score_neg = self.G[question][user_neg]['score']
                 answer_neg_list.append(answer_n)
                 score_neg_list.append(score_neg)
-                if self.user_context is not None:
-                    document = []
-                    for neg_id in self.user_context[user_neg]:
-                        document += self.content.content_embed(neg_id - self.user_count)
-                        if len(document) > self.args.max_u_len:
-                            document = document[:self.args.max_u_len]
-                            break
-                    if len(document) < self.args.max_u_len:
-                        pad_word = [Constants.PAD] * (self.args.max_u_len - len(document))
-                        document += pad_word
-                    user_neg_list.append(document)
+                if self.user_context is not None or self.user_context_file is not None:
+                    user_neg_list.append(self.get_user_context(user_neg))
                 else:
                     user_neg_list.append(user_neg)
 
             question_list.append(question)
             answer_pos_list.append(answer_pos)
-            if self.user_context is not None:
-                document = []
-                for post_id in self.user_context[user_pos]:
-                    document += self.content.content_embed(post_id - self.user_count)
-                    if len(document) > self.args.max_u_len:
-                        document = document[:self.args.max_u_len]
-                        break
-                if len(document) < self.args.max_u_len:
-                    pad_word = [Constants.PAD] * (self.args.max_u_len - len(document))
-                    document += pad_word
-                user_pos_list.append(document)
+            if self.user_context is not None or self.user_context_file is not None:
+                user_pos_list.append(self.get_user_context(user_pos))
             else:
                 user_pos_list.append(user_pos)
             score_pos_list.append(score_pos)
@@ -0,0 +1,136 @@
+import numpy as np
+import torch.utils.data as data
+
+
+class NegativeSampler:
+    '''
+    Draw lower-scored negative answers for the ranking datasets.
+    The inverse rank array is built once from vote_sort, so every draw is O(1)
+    instead of scanning the whole answer list.
+    '''
+    def __init__(self, answer_score, neg_size, id_offset=0, uniform=False):
+        '''
+
+        :param answer_score: vote of every answer, indexed by answer id - id_offset
+        :param neg_size: only draw from lower-scored answers when more than neg_size of them exist
+        :param id_offset: user_count + question_count, answer ids in the dataset start from it
+        :param uniform: ignore the rank and draw from all the answers
+        '''
+        self.answer_score = np.asarray(answer_score)
+        self.neg_size = neg_size
+        self.id_offset = id_offset
+        self.uniform = uniform
+        self.answer_count = len(self.answer_score)
+        # small in the begin
+        self.answer_index_sort = np.argsort(self.answer_score)
+        # answer_rank[answer] = position of answer in answer_index_sort
+        self.answer_rank = np.empty(self.answer_count, dtype=np.int64)
+        self.answer_rank[self.answer_index_sort] = np.arange(self.answer_count)
+
+    def sample(self, answerid):
+        '''
+
+        :param answerid: positive answer id (with offset)
+        :return: one negative answer id (with offset)
+        '''
+        locate = self.answer_rank[answerid - self.id_offset]
+        if locate > self.neg_size and self.uniform is False:
+            negative_answer = self.answer_index_sort[np.random.randint(locate)]
+        else:
+            negative_answer = np.random.randint(self.answer_count)
+        return int(negative_answer) + self.id_offset
+
+    def sample_batch(self, answer_id_list):
+        '''
+
+        :param answer_id_list: array of positive answer ids (with offset)
+        :return: array of negative answer ids (with offset), one for each positive answer
+        '''
+        answer_id_list = np.asarray(answer_id_list)
+        locate = self.answer_rank[answer_id_list - self.id_offset]
+        lower_rank = (np.random.random_sample(locate.shape) * locate).astype(np.int64)
+        negative_answer = self.answer_index_sort[lower_rank]
+        use_all = locate <= self.neg_size
+        if self.uniform:
+            use_all[:] = True
+        negative_answer[use_all] = np.random.randint(self.answer_count, size=int(np.sum(use_all)))
+        return negative_answer + self.id_offset
+
+
+class LengthBucketBatchSampler(data.Sampler):
+    '''
+    Batches of rows with similar length, so a packed LSTM pads each batch only up to a close length.
+    Rows are shuffled, cut into pools of pool_size batches, sorted by length inside a pool and split
+    into batches; the batch order is shuffled again so an epoch does not go from short to long posts.
+    '''
+    def __init__(self, length, batch_size, shuffle=True, pool_size=50, drop_last=False):
+        '''
+
+        :param length: sort key of every row, e.g. words of question + answer
+        :param pool_size: batches sorted together, larger pools give tighter batches but less randomness
+        '''
+        self.length = np.asarray(length)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = pool_size
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        row_count = len(self.length)
+        index = np.random.permutation(row_count) if self.shuffle else np.arange(row_count)
+        pool_rows = self.batch_size * self.pool_size
+        batch_list = []
+        for begin in range(0, row_count, pool_rows):
+            pool = index[begin:begin + pool_rows]
+            pool = pool[np.argsort(self.length[pool], kind='stable')]
+            for batch_begin in range(0, len(pool), self.batch_size):
+                batch_list.append(pool[batch_begin:batch_begin + self.batch_size])
+        if self.drop_last:
+            batch_list = [batch for batch in batch_list if len(batch) == self.batch_size]
+        order = np.random.permutation(len(batch_list)) if self.shuffle else np.arange(len(batch_list))
+        for batch_index in order:
+            yield batch_list[batch_index].tolist()
+
+    def __len__(self):
+        row_count = len(self.length)
+        pool_rows = self.batch_size * self.pool_size
+        full_pool, rest = divmod(row_count, pool_rows)
+        if self.drop_last:
+            return full_pool * self.pool_size + rest // self.batch_size
+        return full_pool * self.pool_size + (rest + self.batch_size - 1) // self.batch_size
+
+
+def data_loader(args, dataset, batch_size, shuffle=False, num_workers=0, collate_fn=None):
+    '''
+    Build the DataLoader of a dataset.
+    With args.batch_fetch the BatchSampler hands the whole index list to the dataset, which returns
+    ready-made tensors, otherwise rows are fetched one by one and merged by collate_fn.
+    With args.length_bucket, datasets that know their row lengths are batched by LengthBucketBatchSampler.
+    '''
+    batch_sampler = None
+    if args.length_bucket and hasattr(dataset, "sample_length"):
+        batch_sampler = LengthBucketBatchSampler(dataset.sample_length(), batch_size, shuffle, args.bucket_pool)
+    if args.batch_fetch and hasattr(dataset, "get_batch"):
+        if batch_sampler is None:
+            index_sampler = data.RandomSampler(dataset) if shuffle else data.SequentialSampler(dataset)
+            batch_sampler = data.BatchSampler(index_sampler, batch_size, drop_last=False)
+        return data.DataLoader(
+            dataset,
+            sampler=batch_sampler,
+            batch_size=None,
+            num_workers=num_workers
+        )
+    if batch_sampler is not None:
+        return data.DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            num_workers=num_workers,
+            collate_fn=collate_fn
+        )
+    return data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=num_workers,
+        collate_fn=collate_fn
+    )
@@ -0,0 +1,245 @@
+''' Columnar storage of the preprocessed data '''
+import os
+import json
+import numpy as np
+import torch
+from numpy.lib import recfunctions
+
+
+MANIFEST = "manifest.json"
+VOCAB = "vocab.json"
+FORMAT_VERSION = 1
+QA_FIELDS = ['question', 'answer', 'user', 'vote', 'cate']
+
+
+def pad_matrix(content, dtype=np.int32, pad=0):
+    # posts are already padded to max_len by shrink_clean_text, pad again in case they are ragged
+    max_len = max([len(line) for line in content]) if len(content) > 0 else 0
+    matrix = np.full((len(content), max_len), pad, dtype=dtype)
+    for index, line in enumerate(content):
+        matrix[index, :len(line)] = line
+    return matrix
+
+
+def content_length(content, pad=0):
+    # posts are padded at the end, the length is the position after the last real word
+    content = np.asarray(content)
+    if content.ndim != 2 or content.shape[1] == 0:
+        return np.zeros(len(content), dtype=np.int32)
+    not_pad = content != pad
+    length = content.shape[1] - np.argmax(not_pad[:, ::-1], axis=1)
+    length[~not_pad.any(axis=1)] = 0
+    return length.astype(np.int32)
+
+
+def qa_structured(question_answer_user_vote):
+    qa = np.asarray(question_answer_user_vote, dtype=np.int64)
+    if qa.ndim != 2:
+        qa = qa.reshape(-1, 4)
+    dtype = [(name, np.int64) for name in QA_FIELDS[:qa.shape[1]]]
+    return recfunctions.unstructured_to_structured(qa, dtype=np.dtype(dtype))
+
+
+def ragged_to_csr(ragged_dic, row_count):
+    '''
+    :param ragged_dic: {row: [value, ...]}, row in range(row_count)
+    :return: indptr (row_count + 1), indices
+    '''
+    length = np.zeros(row_count, dtype=np.int64)
+    for row, value_list in ragged_dic.items():
+        length[row] = len(value_list)
+    indptr = np.zeros(row_count + 1, dtype=np.int64)
+    np.cumsum(length, out=indptr[1:])
+    indices = np.zeros(indptr[-1], dtype=np.int64)
+    for row, value_list in ragged_dic.items():
+        indices[indptr[row]:indptr[row + 1]] = value_list
+    return indptr, indices
+
+
+def graph_to_csr(G):
+    '''
+    Undirected QA graph to CSR adjacency, every edge is stored in both directions
+    :return: dict of indptr, indices and the edge attributes aligned with indices
+    '''
+    edges = list(G.edges(data=True))
+    node_count = max(G.nodes()) + 1 if len(G) > 0 else 0
+    src = np.array([edge[0] for edge in edges], dtype=np.int64)
+    dst = np.array([edge[1] for edge in edges], dtype=np.int64)
+    answer = np.array([edge[2]['a_id'] for edge in edges], dtype=np.int64)
+    score = np.array([edge[2]['score'] for edge in edges], dtype=np.int64)
+    train_removed = np.array([edge[2]['train_removed'] for edge in edges], dtype=np.bool_)
+    return edges_to_csr(np.concatenate([src, dst]), np.concatenate([dst, src]), node_count,
+                        answer=np.concatenate([answer, answer]),
+                        score=np.concatenate([score, score]),
+                        train_removed=np.concatenate([train_removed, train_removed]))
+
+
+def edges_to_csr(src, dst, node_count, **edge_attr):
+    order = np.argsort(src, kind='stable')
+    indptr = np.zeros(node_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=node_count), out=indptr[1:])
+    csr = {'indptr': indptr, 'indices': dst[order]}
+    for key, value in edge_attr.items():
+        csr[key] = value[order]
+    return csr
+
+
+def csr_to_graph(csr):
+    import networkx as nx
+    G = nx.Graph()
+    src = np.repeat(np.arange(len(csr['indptr']) - 1), np.diff(csr['indptr']))
+    keep = src < csr['indices']
+    for u, v, a_id, score, train_removed in zip(src[keep].tolist(), csr['indices'][keep].tolist(),
+                                                csr['answer'][keep].tolist(), csr['score'][keep].tolist(),
+                                                csr['train_removed'][keep].tolist()):
+        G.add_edge(u, v, a_id=a_id, score=score, train_removed=train_removed)
+    return G
+
+
+def config_to_dic(config):
+    settings = {}
+    for key in dir(config):
+        if key.startswith('__'):
+            continue
+        value = getattr(config, key)
+        if isinstance(value, (bool, int, float, str)):
+            settings[key] = value
+    return settings
+
+
+def save_preprocessed(data, directory):
+    '''
+    Write the dict built by preprocess.main as a directory of .npy arrays and a JSON manifest
+    '''
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    arrays = {
+        'content': pad_matrix(data['content']),
+        'question_answer_user_train': qa_structured(data['question_answer_user_train']),
+        'question_answer_user_test': qa_structured(data['question_answer_user_test']),
+        'vote_sort': np.asarray(data['vote_sort']),
+    }
+    arrays['content_len'] = content_length(arrays['content'])
+    if 'title' in data:
+        arrays['title'] = pad_matrix(data['title'])
+    user_context_indptr, user_context_indices = ragged_to_csr(data['user_context'], data['user_count'])
+    arrays['user_context_indptr'] = user_context_indptr
+    arrays['user_context_indices'] = user_context_indices
+    answer_user = sorted(data['answer_user_dic'].items(), key=lambda x: x[0])
+    arrays['answer_user_key'] = np.array([item[0] for item in answer_user], dtype=np.int64)
+    arrays['answer_user_value'] = np.array([item[1] for item in answer_user], dtype=np.int64)
+    for key, value in graph_to_csr(data['G']).items():
+        arrays['graph_' + key] = value
+    love_list, love_count = data['love_list_count']
+    arrays['love_list'] = pad_matrix(love_list, dtype=np.int64)
+    arrays['love_count'] = np.asarray(love_count, dtype=np.int64)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, name + ".npy"), array)
+    with open(os.path.join(directory, VOCAB), 'w') as f:
+        json.dump(data['dict'], f)
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'user_count': int(data['user_count']),
+        'question_count': int(data['question_count']),
+        'settings': config_to_dic(data['settings']),
+        'arrays': {name: {'dtype': str(array.dtype), 'shape': list(array.shape)} for name, array in arrays.items()}
+    }
+    with open(os.path.join(directory, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+class CSRUserContext:
+    '''
+    Read only {user_id: [answer_id, ...]} view over the CSR arrays
+    '''
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, user_id):
+        return self.indices[self.indptr[user_id]:self.indptr[user_id + 1]].tolist()
+
+    def __contains__(self, user_id):
+        return 0 <= user_id < len(self)
+
+    def keys(self):
+        return range(len(self))
+
+    def items(self):
+        for user_id in range(len(self)):
+            yield user_id, self[user_id]
+
+
+class PreprocessedData:
+    '''
+    Dict-like loader of the columnar format, arrays are memory-mapped on first access
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        assert self.manifest['format_version'] == FORMAT_VERSION, \
+            "[ERROR] Unknown preprocessed format {}".format(self.manifest['format_version'])
+        self.cache = {}
+
+    def array(self, name):
+        return np.load(os.path.join(self.directory, name + ".npy"), mmap_mode='r')
+
+    def load(self, key):
+        if key in ('user_count', 'question_count'):
+            return self.manifest[key]
+        if key == 'settings':
+            return self.manifest['settings']
+        if key == 'dict':
+            with open(os.path.join(self.directory, VOCAB)) as f:
+                return json.load(f)
+        if key in ('question_answer_user_train', 'question_answer_user_test'):
+            # plain (n, field) view, rows index like the old lists of [q, a, u, vote(, cate)]
+            return recfunctions.structured_to_unstructured(self.array(key))
+        if key == 'user_context':
+            return CSRUserContext(self.array('user_context_indptr'), self.array('user_context_indices'))
+        if key == 'answer_user_dic':
+            return dict(zip(self.array('answer_user_key').tolist(), self.array('answer_user_value').tolist()))
+        if key == 'graph_csr':
+            return {name: self.array('graph_' + name)
+                    for name in ('indptr', 'indices', 'answer', 'score', 'train_removed')}
+        if key == 'G':
+            return csr_to_graph(self['graph_csr'])
+        if key == 'content_len' and key not in self.manifest['arrays']:
+            # written before lengths were stored
+            return content_length(self.array('content'))
+        if key == 'love_list_count':
+            return [self.array('love_list').tolist(), self.array('love_count').tolist()]
+        if key in self.manifest['arrays']:
+            return self.array(key)
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        if key not in self.cache:
+            self.cache[key] = self.load(key)
+        return self.cache[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+
+def load_preprocessed(path):
+    # directory: columnar format, file: the old torch pickle
+    # drivers name data/<name>.torchpickle, preprocess.py writes data/<name>/ for it with columnar on,
+    # so the directory is tried first and the pickle is the fallback
+    directory = os.path.splitext(path)[0]
+    if os.path.isdir(directory):
+        return PreprocessedData(directory)
+    if os.path.isdir(path):
+        return PreprocessedData(path)
+    if os.path.exists(path) is False:
+        raise FileNotFoundError("[ERROR] no preprocessed directory {} or pickle {}, run preprocess.py".format(directory, path))
+    return torch.load(path)
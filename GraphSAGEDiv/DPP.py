@@ -1,49 +1,95 @@
 # S: empty set contians nothing
 
 # id of each answer
-import copy
+# greedy MAP inference of the DPP with incremental Cholesky:
+# det(L_{S+i}) = det(L_S) * d_i^2, d_i^2 = L_ii - ||c_i||^2, every step updates c_i and d_i^2 of all candidates at once
 import numpy as np
-from scipy import spatial
 
 
 def diversity(featureMatrix, relevanceScore, rankList, early_stop):
+    return diversity_batch([featureMatrix], [relevanceScore], [rankList], early_stop)[0]
 
-    if type(rankList) is not list:
-        rankList = rankList.tolist()
-
-    S = [rankList[0]]
-    rankList.remove(S[0])
-    L = Lmatrix(featureMatrix, relevanceScore)
-    while len(rankList) > 0:
-        score = 0
-        candidate = -1
-        for i in rankList:
-            temp_list = copy.deepcopy(S)
-            temp_list.append(i)
-            temp_score = det(temp_list, L)
-            if (score < temp_score):
-                candidate = i
-                score = temp_score
-        if candidate != -1:
-            rankList.remove(candidate)
-        else:
+
+def diversity_batch(featureMatrix_list, relevanceScore_list, rankList_list, early_stop):
+    '''
+    Greedy DPP re-ranking of many questions at once, the candidates of each question are padded to the longest one
+    :param featureMatrix_list: feature matrix of the answers of every question
+    :param relevanceScore_list: relevance of the answers of every question
+    :param rankList_list: row ids of each question in their original rank, the first one is always kept first
+    :param early_stop: stop a question when adding an answer increases det(L_S) by no more than this
+    :return: list of reordered row ids, the unselected ids follow in their original rank
+    '''
+    rankList_list = [np.asarray(rankList, dtype=np.int64) for rankList in rankList_list]
+    question_count = len(rankList_list)
+    length = np.array([len(rankList) for rankList in rankList_list], dtype=np.int64)
+    size_n = int(length.max()) if question_count > 0 else 0
+    if size_n == 0:
+        return [[] for _ in range(question_count)]
+    feature_dim = np.shape(featureMatrix_list[0])[-1]
+    # candidates in rank order, so argmax breaks ties by rank like the original scan did
+    feature = np.zeros((question_count, size_n, feature_dim))
+    relevance = np.zeros((question_count, size_n))
+    for q, rankList in enumerate(rankList_list):
+        feature[q, :length[q]] = np.asarray(featureMatrix_list[q])[rankList]
+        relevance[q, :length[q]] = np.asarray(relevanceScore_list[q])[rankList]
+    L = Lmatrix(feature, relevance)
+
+    rows = np.arange(question_count)
+    available = np.arange(size_n)[None, :] < length[:, None]
+    cholesky = np.zeros((question_count, size_n, size_n))
+    d2 = np.diagonal(L, axis1=-2, axis2=-1).copy()
+    det_S = np.ones(question_count)
+    selected = np.zeros((question_count, size_n), dtype=np.int64)
+    selected_count = np.zeros(question_count, dtype=np.int64)
+    active = length > 0
+    # S starts with the top ranked answer
+    candidate = np.zeros(question_count, dtype=np.int64)
+    for step in range(size_n):
+        if not active.any():
             break
-        oldS = copy.deepcopy(S)
-        S.append(candidate)
-        if(det(S,L) - det(oldS,L) <= early_stop):
+        if step > 0:
+            score = np.where(available, d2, -np.inf)
+            candidate = np.argmax(score, axis=-1)
+            # no candidate raises det(L_S) above 0
+            active &= score[rows, candidate] > 0
+        gain = d2[rows, candidate]
+        for q in np.nonzero(active)[0]:
+            selected[q, selected_count[q]] = candidate[q]
+        selected_count += active
+        available[rows[active], candidate[active]] = False
+        old_det = det_S.copy()
+        det_S = np.where(active, det_S * gain, det_S)
+        if step > 0:
+            active &= det_S - old_det > early_stop
+        # the first answer is kept even when its own det is 0, no other answer can follow it then
+        active &= det_S > 0
+        # new Cholesky column of every active question
+        update = rows[active]
+        if len(update) == 0:
             break
-    if len(rankList) != 0 :
-        S += rankList
-    return S
+        j = candidate[update]
+        c_j = cholesky[update, j, :step]
+        e = (L[update, j, :] - np.einsum('bk,bnk->bn', c_j, cholesky[update, :, :step])) / np.sqrt(gain[update])[:, None]
+        cholesky[update, :, step] = e
+        d2[update] -= e ** 2
+
+    order_list = []
+    for q, rankList in enumerate(rankList_list):
+        picked = selected[q, :selected_count[q]]
+        rest = np.nonzero(available[q, :length[q]])[0]
+        order_list.append(rankList[np.concatenate([picked, rest])].tolist())
+    return order_list
+
 
 def Lmatrix(featureMatrix, relevanceScore):
-    size_n = len(featureMatrix)
-    L = np.zeros((size_n, size_n))
-    for i in range(size_n):
-        for j in range(size_n):
-            L[i][j] = relevanceScore[i]*relevanceScore[j]*\
-                    (1 - spatial.distance.cosine(featureMatrix[i,:], featureMatrix[j,:]))
-    return L
+    # L_ij = r_i * r_j * cos(f_i, f_j), works on one matrix or a batch of them
+    featureMatrix = np.asarray(featureMatrix, dtype=np.float64)
+    relevanceScore = np.asarray(relevanceScore, dtype=np.float64)
+    norm = np.linalg.norm(featureMatrix, axis=-1, keepdims=True)
+    feature_norm = featureMatrix / np.where(norm > 0, norm, 1)
+    similarity = np.matmul(feature_norm, np.swapaxes(feature_norm, -1, -2))
+    return relevanceScore[..., :, None] * relevanceScore[..., None, :] * similarity
+
 
 def det(ids, L):
     K = L[np.ix_(ids,ids)]
@@ -56,4 +102,4 @@ if __name__ == '__main__':
     L = Lmatrix(feature_matrix, rele)
     rankList = list(range(len(L)))
     th = diversity(feature_matrix, rele, rankList, 0.000001)
-    print(th)
\ No newline at end of file
+    print(th)
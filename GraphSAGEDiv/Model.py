@@ -29,7 +29,7 @@ class InducieveLearningQA(nn.Module):
         self.word2vec_embed = nn.Embedding.from_pretrained(word2vec)
 
 
-        self.sampler = UniformNeighborSampler(self.adj, self.adj_edge)
+        self.sampler = UniformNeighborSampler(self.adj, self.adj_edge, seed=args.sampler_seed)
         self.q_aggregate = AttentionAggregate(self.hidden_state_size, self.hidden_state_size, self.hidden_state_size)
         self.u_aggregate = AttentionAggregate(self.hidden_state_size, self.hidden_state_size, self.hidden_state_size)
         self.q_node_generate = NodeGenerate(self.hidden_state_size)
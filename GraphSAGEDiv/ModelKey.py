@@ -10,7 +10,8 @@ class InducieveLearningQA(nn.Module):
                  adj_edge,
                  content_embed,
                  user_context_embed,
-                 word2vec
+                 word2vec,
+                 adj_degree=None
                  ):
         super(InducieveLearningQA, self).__init__()
         self.args = args
@@ -32,7 +33,8 @@ class InducieveLearningQA(nn.Module):
         self.user_value_embed = nn.Embedding(user_count, self.value_dim)
         self.lstm = LSTM_MeanPool(args)
 
-        self.sampler = UniformNeighborSampler(self.adj, self.adj_edge)
+        self.sampler = UniformNeighborSampler(self.adj, self.adj_edge, seed=args.sampler_seed,
+                                              node_degree=adj_degree if args.degree_weighted_sample else None)
         # self.q_aggregate = AttentionAggregate_Weight(self.key_dim)
         self.q_aggregate = AttentionAggregate_Cos()
         # self.u_aggregate = AttentionAggregate_Weight(self.key_dim)
@@ -56,6 +58,10 @@ class InducieveLearningQA(nn.Module):
         self.cnn_lr = nn.Conv2d(1, self.key_dim, (3, args.embed_size))
         self.bn = nn.BatchNorm1d(self.args.lstm_hidden_size)
         self.dropout = nn.Dropout(args.drop_out_lstm)
+        #eval mode encodings of posts and user contexts, dropped on every train()/eval() switch
+        self.encode_cache = {}
+        #(key, value) of every node in inference mode, see build_node_table
+        self.node_table = None
 
 
 
@@ -76,6 +82,52 @@ class InducieveLearningQA(nn.Module):
 
 
 
+    def encode(self, index_list, embed, cache_name):
+        '''
+        content_cnn over the posts (or user contexts) of index_list, ids shared by several hops are encoded once
+        in eval mode; training keeps one encoding per hop, the batch norm statistics of a de-duplicated batch
+        differ from the per-hop ones and would change training
+        :param index_list: list of id tensors of any shape
+        :param embed: ContentEmbed holding the word ids of every post / user context
+        :param cache_name: key of the eval cache
+        :return: list of tensors shaped index.shape + (key_dim,)
+        '''
+        if not self.args.encode_dedup or self.training:
+            return [self.content_cnn(self.word2vec_embed(embed.content_embed(index))) for index in index_list]
+        flat_index = torch.cat([index.reshape(-1) for index in index_list])
+        unique_index, inverse = torch.unique(flat_index, return_inverse=True)
+        if not self.args.eval_encode_cache:
+            unique_key = self.content_cnn(self.word2vec_embed(embed.content_embed(unique_index)))
+        else:
+            unique_key = self.cached_encode(unique_index, embed, cache_name)
+        key_list = []
+        begin = 0
+        for index in index_list:
+            end = begin + index.numel()
+            key_list.append(unique_key[inverse[begin:end]].view(*index.shape, self.key_dim))
+            begin = end
+        return key_list
+
+    def cached_encode(self, unique_index, embed, cache_name):
+        # weights are fixed in eval mode, keep every encoding until the model goes back to train()
+        if cache_name not in self.encode_cache:
+            row_count = len(embed.content_list)
+            self.encode_cache[cache_name] = (
+                torch.zeros((row_count, self.key_dim), device=unique_index.device),
+                torch.zeros(row_count, dtype=torch.bool, device=unique_index.device)
+            )
+        cache, filled = self.encode_cache[cache_name]
+        missing = unique_index[~filled[unique_index]]
+        if len(missing) > 0:
+            cache[missing] = self.content_cnn(self.word2vec_embed(embed.content_embed(missing))).detach()
+            filled[missing] = True
+        return cache[unique_index]
+
+    def train(self, mode=True):
+        self.encode_cache = {}
+        self.node_table = None
+        return super(InducieveLearningQA, self).train(mode)
+
     def neighbor_sample(self, item, depth, neighbor_count_list):
         neighbor_node = []
         neighbor_edge = []
@@ -91,159 +143,94 @@ class InducieveLearningQA(nn.Module):
 
 
 
-    def forward(self, question, answer_edge, user, need_feature=False):
+    def represent(self, question=None, user=None, answer_edge=None):
+        '''
+        Sample and aggregate the question tower and the user tower, either side can be left out
+        :return: (key, value) of the question roots, (key, value) of the user roots, key of answer_edge
+        '''
         #sample neighbors
         # q <- a -> u <- a -> u
         # u <- a -> q <- a -> q
-        question_neighbors, question_neighbors_edge = self.neighbor_sample(question, self.args.graphsage_depth, self.args.neighbor_number_list)
-        user_neighbors, user_neigbor_edge = self.neighbor_sample(user, self.args.graphsage_depth, self.args.neighbor_number_list)
-        question_neighbors_value_list = []
-        user_neighbors_value_list = []
-        question_neighbors_edge_value_list = []
-        user_neighbors_edge_value_list = []
-
-        depth = len(question_neighbors)
-        #load embedding
-        for i in range(depth):
-            if i % 2 == 0:
-                #ATTENTION: key and value have the same init value
-                question_neighbors_value_list.append(self.content_value_embed(question_neighbors[i] - self.user_count))
-                # question_neighbors_value_list.append(self.content_cnn(self.word2vec_embed(self.content_embed.content_embed(question_neighbors[i] - self.user_count))))
-
-                question_embed = self.content_embed.content_embed(question_neighbors[i] - self.user_count)
-                question_embed_word2vec = self.word2vec_embed(question_embed)
-                question_lstm_embed = self.content_cnn(question_embed_word2vec)
-                question_neighbors[i] = question_lstm_embed
-
-                #ATTENTION: user context embedding
-                user_neighbors_value_list.append(self.user_value_embed(user_neighbors[i]))
-                # user_neighbors_value_list.append(self.content_cnn(self.word2vec_embed(self.user_context_embed.content_embed(user_neighbors[i]))))
-
-                user_embed = self.word2vec_embed(self.user_context_embed.content_embed(user_neighbors[i]))
-                user_embed = self.content_cnn(user_embed)
-                user_neighbors[i] = user_embed
-
-            else:
-                question_neighbors_value_list.append(self.user_value_embed(question_neighbors[i]))
-                # question_neighbors_value_list.append(self.content_cnn(self.word2vec_embed(self.user_context_embed.content_embed(question_neighbors[i]))))
-
-                user_embed = self.word2vec_embed(self.user_context_embed.content_embed(question_neighbors[i]))
-                user_embed = self.content_cnn(user_embed)
-                question_neighbors[i] = user_embed
-
-
-                user_neighbors_value_list.append(self.content_value_embed(user_neighbors[i] - self.user_count))
-                # user_neighbors_value_list.append(self.content_cnn(self.word2vec_embed(self.content_embed.content_embed(user_neighbors[i] - self.user_count))))
-
-                question_embed = self.content_embed.content_embed(user_neighbors[i] - self.user_count)
-                question_embed_word2vec = self.word2vec_embed(question_embed)
-                question_lstm_embed = self.content_cnn(question_embed_word2vec)
-                user_neighbors[i] = question_lstm_embed
-
-        for i in range(depth-1):
-            question_neighbors_edge_value_list.append(self.content_value_embed(question_neighbors_edge[i] - self.user_count))
-            # question_neighbors_edge_value_list.append(self.content_cnn(self.word2vec_embed(self.content_embed.content_embed()))self.content_value_embed())
-
-            question_edge_embed = self.content_embed.content_embed(question_neighbors_edge[i] - self.user_count)
-            question_edge_word2vec = self.word2vec_embed(question_edge_embed)
-            question_edge_lstm = self.content_cnn(question_edge_word2vec)
-            question_neighbors_edge[i] = question_edge_lstm
-
-
-            user_neighbors_edge_value_list.append(
-                self.content_value_embed(user_neigbor_edge[i] - self.user_count)
-            )
-            user_edge_embed = self.content_embed.content_embed(user_neigbor_edge[i] - self.user_count)
-            user_edge_word2vec = self.word2vec_embed(user_edge_embed)
-            user_edge_lstm = self.content_cnn(user_edge_word2vec)
-            user_neigbor_edge[i] = user_edge_lstm
-
-        answer_embed_layer = self.content_embed.content_embed(answer_edge - self.user_count)
-        answer_embed_word2vec = self.word2vec_embed(answer_embed_layer)
-        answer_lstm_embed = self.content_cnn(answer_embed_word2vec)
-
-        answer_value = self.content_value_embed(answer_edge - self.user_count)
-
-
-        #aggregate
+        tower_list = []
+        #post ids and user ids of every hop, edge and the target answer, each unique one is encoded once
+        content_index = []
+        user_index = []
+        for root, root_is_question in ((question, True), (user, False)):
+            if root is None:
+                tower_list.append(None)
+                continue
+            neighbors, neighbors_edge = self.neighbor_sample(root, self.args.graphsage_depth, self.args.neighbor_number_list)
+            tower_list.append((neighbors, neighbors_edge, root_is_question))
+            for i in range(len(neighbors)):
+                if (i % 2 == 0) == root_is_question:
+                    content_index.append(neighbors[i] - self.user_count)
+                else:
+                    user_index.append(neighbors[i])
+            content_index += [edge - self.user_count for edge in neighbors_edge]
+        if answer_edge is not None:
+            content_index.append(answer_edge - self.user_count)
+        content_key = iter(self.encode(content_index, self.content_embed, "content"))
+        user_key = iter(self.encode(user_index, self.user_context_embed, "user"))
+
+        result = []
+        for tower in tower_list:
+            if tower is None:
+                result.append(None)
+                continue
+            neighbors, neighbors_edge, root_is_question = tower
+            #load embedding
+            #ATTENTION: key and value have the same init value
+            key_list = []
+            value_list = []
+            for i in range(len(neighbors)):
+                if (i % 2 == 0) == root_is_question:
+                    value_list.append(self.content_value_embed(neighbors[i] - self.user_count))
+                    key_list.append(next(content_key))
+                else:
+                    #ATTENTION: user context embedding
+                    value_list.append(self.user_value_embed(neighbors[i]))
+                    key_list.append(next(user_key))
+            edge_key_list = []
+            edge_value_list = []
+            for edge in neighbors_edge:
+                edge_value_list.append(self.content_value_embed(edge - self.user_count))
+                edge_key_list.append(next(content_key))
+            result.append(self.aggregate(key_list, value_list, edge_key_list, edge_value_list, root_is_question))
+        answer_key = next(content_key) if answer_edge is not None else None
+        return result[0], result[1], answer_key
+
+    def aggregate(self, key_list, value_list, edge_key_list, edge_value_list, root_is_question):
+        depth = len(key_list)
         for i in range(depth - 1):
             layer_no = depth - i - 1
-            if layer_no % 2 == 0:
-                question_layer = question_neighbors[layer_no]
-                question_layer_value = question_neighbors_value_list[layer_no]
-                question_edge = question_neighbors_edge[layer_no - 1]
-                question_edge_value = question_neighbors_edge_value_list[layer_no - 1]
-                question_edge_value = self.a_edge_generate(
-                    question_layer, question_neighbors[layer_no - 1], question_edge,
-                    question_layer_value, question_neighbors_value_list[layer_no - 1], question_edge_value
-                )
-
-                question_neighbor_value = self.u_aggregate(
-                    self.Keymiddle(question_layer, question_edge),  question_neighbors[layer_no - 1],
-                    self.Valuemiddle(question_layer_value, question_edge_value))
-
-                question_neighbors_value_list[layer_no - 1] = \
-                    self.u_node_generate(question_neighbors_value_list[layer_no - 1], question_neighbor_value)
-
-
-                user_layer = user_neighbors[layer_no]
-                user_layer_value = user_neighbors_value_list[layer_no]
-                user_edge = user_neigbor_edge[layer_no - 1]
-                user_edge_value = user_neighbors_edge_value_list[layer_no - 1]
-                # update the edge based on two sides of nodes
-                user_edge_value = self.a_edge_generate(user_layer, user_neighbors[layer_no - 1], user_edge,
-                                                       user_layer_value, user_neighbors_value_list[layer_no - 1], user_edge_value
-                                                       )
-
-                user_neighbor_value = self.q_aggregate(self.Keymiddle(user_layer, user_edge), user_neighbors[layer_no - 1],
-                                                       self.Valuemiddle(user_layer_value, user_edge_value))
-                user_neighbors_value_list[layer_no - 1] = self.q_node_generate(user_neighbors_value_list[layer_no - 1], user_neighbor_value)
-
+            # update the edge based on two sides of nodes
+            edge_value = self.a_edge_generate(
+                key_list[layer_no], key_list[layer_no - 1], edge_key_list[layer_no - 1],
+                value_list[layer_no], value_list[layer_no - 1], edge_value_list[layer_no - 1]
+            )
+            if ((layer_no - 1) % 2 == 0) == root_is_question:
+                #questions collect from their users
+                aggregate_fn, generate_fn = self.q_aggregate, self.q_node_generate
             else:
-                #get key
-                user_layer = question_neighbors[layer_no]
-                #get value
-                user_layer_value = question_neighbors_value_list[layer_no]
-                user_edge = question_neighbors_edge[layer_no - 1]
-                user_edge_value = question_neighbors_edge_value_list[layer_no - 1]
-                user_edge_value = self.a_edge_generate(
-                    user_layer, question_neighbors[layer_no - 1], user_edge,
-                    user_layer_value, question_neighbors_value_list[layer_no - 1], user_edge_value
-                )
-
-                user_neighbor_value = self.q_aggregate(
-                    self.Keymiddle(user_layer, user_edge), question_neighbors[layer_no - 1],
-                    self.Valuemiddle(user_layer_value, user_edge_value)
-                )
-                question_neighbors_value_list[layer_no - 1] = self.q_node_generate(question_neighbors_value_list[layer_no - 1], user_neighbor_value)
-
-
-                question_layer = user_neighbors[layer_no]
-                question_layer_value = user_neighbors_value_list[layer_no]
-                question_edge = user_neigbor_edge[layer_no - 1]
-                question_edge_value = user_neighbors_edge_value_list[layer_no - 1]
-
-                question_edge_value = \
-                    self.a_edge_generate(
-                        question_layer, user_neighbors[layer_no - 1], question_edge,
-                        question_layer_value, user_neighbors_value_list[layer_no - 1], question_edge_value
-                    )
-
-
-                question_neighbor_feature = self.u_aggregate(
-                    self.Keymiddle(question_layer, question_edge), user_neighbors[layer_no -1],
-                    self.Valuemiddle(question_layer_value, question_edge_value))
-
-                user_neighbors_value_list[layer_no - 1] = self.u_node_generate(user_neighbors_value_list[layer_no - 1],
-                                                                               question_neighbor_feature )
+                aggregate_fn, generate_fn = self.u_aggregate, self.u_node_generate
+            neighbor_value = aggregate_fn(
+                self.Keymiddle(key_list[layer_no], edge_key_list[layer_no - 1]), key_list[layer_no - 1],
+                self.Valuemiddle(value_list[layer_no], edge_value))
+            value_list[layer_no - 1] = generate_fn(value_list[layer_no - 1], neighbor_value)
+        return key_list[0], value_list[0]
+
+    def score_edge(self, question_tower, user_tower, answer_lstm_embed, answer_edge, need_feature=False):
+        question_key, question_value = question_tower
+        user_key, user_value = user_tower
+        answer_value = self.content_value_embed(answer_edge - self.user_count)
         #score edge strength
         #ATTENTION: remove user feature
         answer_value = self.a_edge_generate(
-            question_neighbors[0], user_neighbors[0], answer_lstm_embed,
-            question_neighbors_value_list[0], user_neighbors_value_list[0], answer_value
+            question_key, user_key, answer_lstm_embed,
+            question_value, user_value, answer_value
         )
-        question_vec = torch.cat((question_neighbors[0], question_neighbors_value_list[0]), dim=-1)
-        user_vec = torch.cat((user_neighbors[0], user_neighbors_value_list[0]), dim=-1)
+        question_vec = torch.cat((question_key, question_value), dim=-1)
+        user_vec = torch.cat((user_key, user_value), dim=-1)
         answer_vec = torch.cat((answer_lstm_embed, answer_value), dim=-1)
         # question_vec = question_neighbors_value_list[0]
         # answer_vec = answer_value
@@ -259,11 +246,41 @@ class InducieveLearningQA(nn.Module):
             return_list = [score, predic]
         else:
             return_list = [score]
-        # if need_feature:
-        #     answer_vec = answer_edge_feaure.detach()
-        #     return_list.append(answer_vec)
+        if need_feature:
+            return_list.append(answer_vec.detach())
         return tuple(return_list)
 
+    def build_node_table(self, batch_size):
+        '''
+        Inference mode: run the towers once for every node of the graph and keep the final key/value,
+        forward in eval mode then only looks them up, cost scales with node count instead of edge count
+        '''
+        node_count = self.adj.shape[0]
+        device = self.adj.device
+        node_key = torch.zeros((node_count, self.key_dim), device=device)
+        node_value = torch.zeros((node_count, self.value_dim), device=device)
+        with torch.no_grad():
+            for node_list, is_question in ((torch.arange(self.user_count, node_count - 1, device=device), True),
+                                           (torch.arange(min(self.user_count, node_count - 1), device=device), False)):
+                for node in node_list.split(batch_size):
+                    if is_question:
+                        (key, value), _, _ = self.represent(question=node)
+                    else:
+                        _, (key, value), _ = self.represent(user=node)
+                    node_key[node] = key
+                    node_value[node] = value
+        self.node_table = (node_key, node_value)
+        print("[INFO] node table of {} nodes built".format(node_count - 1))
+
+    def forward(self, question, answer_edge, user, need_feature=False):
+        if self.node_table is not None and not self.training:
+            node_key, node_value = self.node_table
+            answer_lstm_embed = self.encode([answer_edge - self.user_count], self.content_embed, "content")[0]
+            return self.score_edge((node_key[question], node_value[question]), (node_key[user], node_value[user]),
+                                   answer_lstm_embed, answer_edge, need_feature)
+        question_tower, user_tower, answer_lstm_embed = self.represent(question, user, answer_edge)
+        return self.score_edge(question_tower, user_tower, answer_lstm_embed, answer_edge, need_feature)
+
 
         #
         # if self.training or not self.need_diversity:
@@ -1,13 +1,53 @@
-import numpy as np
+import torch
 class UniformNeighborSampler:
     '''
     Uniformly sample neighbors.
+    Every node draws its own columns of the padded adj table, then one gather on the flattened table
+    reads exactly batch * number entries instead of copying whole rows.
     TODO: Assume that adj lists are padded with random re-sampling
     '''
-    def __init__(self, adj_neighbor, adj_edge):
+    def __init__(self, adj_neighbor, adj_edge, seed=None, node_degree=None):
+        '''
+
+        :param adj_neighbor: (node_count + 1, max_degree) padded neighbor table
+        :param adj_edge: (node_count + 1, max_degree) answer id on each edge
+        :param seed: seed of the sampler's own generator, None uses the global torch random state
+        :param node_degree: (node_count + 1) degree of every node, if given neighbors are drawn
+        with probability proportional to their degree
+        '''
         self.neighbor_embed = adj_neighbor
         self.neighbot_count = adj_neighbor.shape[1]
         self.edge_embed = adj_edge
+        self.seed = seed
+        self.node_degree = node_degree
+        self.generator = None
+
+    def get_generator(self, device):
+        if self.seed is None:
+            return None
+        if self.generator is None or self.generator.device != device:
+            self.generator = torch.Generator(device=device)
+            self.generator.manual_seed(self.seed)
+        return self.generator
+
+    def sample_column(self, batch_ids, number):
+        '''
+
+        :param batch_ids: flat node ids
+        :return: (len(batch_ids), number) column of the adj table picked for every node
+        '''
+        device = self.neighbor_embed.device
+        generator = self.get_generator(device)
+        if self.node_degree is not None:
+            neighbor = self.neighbor_embed[batch_ids]
+            weight = self.node_degree[neighbor].float().clamp(min=1)
+            return torch.multinomial(weight, number, replacement=number > self.neighbot_count,
+                                     generator=generator)
+        if number > self.neighbot_count:
+            return torch.randint(self.neighbot_count, (len(batch_ids), number), device=device, generator=generator)
+        # number columns without replacement for every node
+        key = torch.rand((len(batch_ids), self.neighbot_count), device=device, generator=generator)
+        return key.topk(number, dim=-1)[1]
 
     def sample(self, batch_ids, number):
         '''
@@ -19,11 +59,10 @@ class UniformNeighborSampler:
         batch_ids_shape = [*batch_ids.shape]
         batch_ids_shape.append(number)
         batch_ids_shape = tuple(batch_ids_shape)
-        batch_ids_new = batch_ids.contiguous().view(-1)
-        chooseNeighbor = list(range(self.neighbot_count))
-        np.random.shuffle(chooseNeighbor)
-        chooseNeighbor = chooseNeighbor[:number]
-        neighbor_next_layer = (self.neighbor_embed[batch_ids_new][:, chooseNeighbor]).view(batch_ids_shape)
-        edge_next_layer =(self.edge_embed[batch_ids_new][:, chooseNeighbor]).view(batch_ids_shape)
+        batch_ids_new = batch_ids.contiguous().view(-1).to(self.neighbor_embed.device)
+        chooseNeighbor = self.sample_column(batch_ids_new, number)
+        flat_index = (batch_ids_new.unsqueeze(-1) * self.neighbot_count + chooseNeighbor).view(-1)
+        neighbor_next_layer = torch.gather(self.neighbor_embed.view(-1), 0, flat_index).view(batch_ids_shape)
+        edge_next_layer = torch.gather(self.edge_embed.view(-1), 0, flat_index).view(batch_ids_shape)
 
         return neighbor_next_layer, edge_next_layer
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from HybridAttention.Layer import UserGeneration, SelfAttention, HybridAttentionLayer,RatioLayer
+from Util import sequence_length, lstm_by_length
 
 
 
@@ -71,13 +72,20 @@ class HybridAttentionModel(nn.Module):
         # TODO: bidirectional lstm  vector pool
         bi = 2 if self.args.bidirectional else 1
         hiddena, hiddenb = self._init_lstm_hidden()
-        q_lstm, _ = self.lstm(q_embed, (hiddena, hiddenb))
+        if self.args.pack_sequence:
+            # padded back to max_q_len / max_a_len, the attention layers are built for the full length
+            q_lstm = lstm_by_length(self.lstm, q_embed, sequence_length(question), (hiddena, hiddenb), self.args.max_q_len)
+        else:
+            q_lstm, _ = self.lstm(q_embed, (hiddena, hiddenb))
         q_lstm = torch.mean(
             q_lstm.view(self.args.batch_size, self.args.max_q_len, bi, self.args.lstm_hidden_size),
             2
         )
         hiddena, hiddenb = self._init_lstm_hidden()
-        a_lstm, _ = self.lstm(a_embed, (hiddena, hiddenb))
+        if self.args.pack_sequence:
+            a_lstm = lstm_by_length(self.lstm, a_embed, sequence_length(answer), (hiddena, hiddenb), self.args.max_a_len)
+        else:
+            a_lstm, _ = self.lstm(a_embed, (hiddena, hiddenb))
         #bilstm
         a_lstm = torch.mean(
             a_lstm.view(self.args.batch_size, self.args.max_a_len, bi, self.args.lstm_hidden_size),
@@ -3,8 +3,8 @@ from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.metrics.pairwise import linear_kernel
 
 import numpy as np
+from scipy.sparse import csr_matrix
 from gensim.models import LdaModel
-from gensim.matutils import cossim
 from gensim.test.utils import datapath
 
 from joblib import dump, load
@@ -43,31 +43,40 @@ class TFIDFSimilar:
             self.saveModel(model_path)
 
     def get_idf(self, background_data):
-        item, count = np.unique(list(itertools.chain.from_iterable(background_data)), return_counts=True)
-        count = count.reshape(len(count), 1)
-        item = item.reshape(len(item), 1)
-        base = np.zeros((1, np.max(item) + 1))
-        for i, c  in zip(item, count):
-            base[0,i] = c
-        return base
+        # the whole background corpus counted as one row
+        item = np.concatenate([np.asarray(line, dtype=np.int64).reshape(-1) for line in background_data])
+        count = np.bincount(item)
+        return csr_matrix(count.reshape(1, -1).astype(np.float64))
+
+    def count_matrix(self, document_list):
+        '''
+        :param document_list: list of word id sequences
+        :return: (len(document_list), vocab) CSR term counts, ids outside the vocabulary are dropped
+        '''
+        vocab_size = self.n_features[1]
+        document_list = [np.asarray(document, dtype=np.int64).reshape(-1) for document in document_list]
+        length = np.array([len(document) for document in document_list], dtype=np.int64)
+        row = np.repeat(np.arange(len(document_list)), length)
+        column = np.concatenate(document_list) if len(document_list) > 0 else np.zeros(0, dtype=np.int64)
+        keep = (column >= 0) & (column < vocab_size)
+        # duplicate (row, column) entries are summed into counts
+        count = csr_matrix((np.ones(int(keep.sum())), (row[keep], column[keep])),
+                           shape=(len(document_list), vocab_size))
+        count.sum_duplicates()
+        return count
+
+    def similarity_batch(self, content_list, highRank_list):
+        '''
+        Cosine of the tf-idf vectors of every (content, highRank) pair, all pairs in one sparse pass
+        :return: array of len(content_list) scores
+        '''
+        i = self.tfModel.transform(self.count_matrix(content_list))
+        j = self.tfModel.transform(self.count_matrix(highRank_list))
+        # rows are l2 normalized, the row-wise dot product is the cosine
+        return np.asarray(i.multiply(j).sum(axis=1)).reshape(-1)
 
     def simiarity(self, content, highRank):
-        content_vec = np.zeros(self.n_features)
-        highRank_vec = np.zeros(self.n_features)
-        for index in content:
-            try:
-                content_vec[0][index] += 1
-            except:
-                continue
-        for index in highRank:
-            try:
-                highRank_vec[0][index] += 1
-            except:
-                continue
-        i = self.tfModel.transform(content_vec)
-        j = self.tfModel.transform(highRank_vec)
-        cosine_similarities = linear_kernel(i,j).flatten()
-        return cosine_similarities
+        return self.similarity_batch([content], [highRank])
 
     def saveModel(self,path):
         dump(self.tfModel, path)
@@ -79,6 +88,28 @@ class TFIDFSimilar:
 
 
 
+def lda_topic_matrix(lda, bow_list, chunk_size=2000):
+    '''
+    Topic distribution of many bags of words at once, same values as lda[bow] written densely
+    :param lda: gensim LdaModel
+    :param bow_list: list of [(word_id, count), ...], ids the model has not seen are dropped
+    :return: (len(bow_list), num_topics) float32 matrix
+    '''
+    bow_list = [[(word, count) for word, count in bow if word < lda.num_terms] for bow in bow_list]
+    topic = np.zeros((len(bow_list), lda.num_topics), dtype=np.float32)
+    for begin in range(0, len(bow_list), chunk_size):
+        gamma, _ = lda.inference(bow_list[begin:begin + chunk_size])
+        topic[begin:begin + len(gamma)] = gamma / gamma.sum(axis=1, keepdims=True)
+    # get_document_topics leaves out the topics under minimum_probability
+    topic[topic < max(lda.minimum_probability, 1e-8)] = 0
+    return topic
+
+
+def row_cosine(a, b):
+    norm = np.linalg.norm(a, axis=-1) * np.linalg.norm(b, axis=-1)
+    return np.where(norm > 0, np.sum(a * b, axis=-1) / np.where(norm > 0, norm, 1), 0.)
+
+
 class LDAsimilarity:
     def __init__(self, background_data, topic_count, load_pretrain, model_path):
         file_name = "lda.model"
@@ -107,16 +138,18 @@ class LDAsimilarity:
         lda = LdaModel.load(temp_file)
         return lda
 
+    def topic_matrix(self, document_list):
+        return lda_topic_matrix(self.lda, [self.list2tuple(document) for document in document_list])
+
+    def similarity_batch(self, content_list, highrank_list):
+        '''
+        Cosine of the topic vectors of every (content, highrank) pair, all bags inferred in one batch
+        '''
+        topic = self.topic_matrix(list(content_list) + list(highrank_list))
+        return row_cosine(topic[:len(content_list)], topic[len(content_list):])
+
     def similarity(self, content, highrank):
-        content_corpus = self.list2tuple(content)
-        highrank_corpus = self.list2tuple(highrank)
-        #TODO: index 8184 is out of bounds for axis 1 with size 8060
-        try:
-            lda_content_vec = self.lda[content_corpus]
-            highrank_content_vec = self.lda[highrank_corpus]
-        except:
-            return 0
-        return cossim(lda_content_vec, highrank_content_vec)
+        return self.similarity_batch([content], [highrank])[0]
 
 
 if __name__ == '__main__':
@@ -329,6 +329,225 @@ def Accuracy(label, predict):
     return target, zero_count, one_count
 
 
+class ConfusionAccumulator:
+    """Confusion counts updated per batch, replaces keeping every label and prediction for Accuracy/marcoF1
+
+    >>> confusion = ConfusionAccumulator()
+    >>> confusion.update([0, 1, 1], [0, 1, 0])
+    (2, 2, 1)
+    >>> confusion.update([1, 0], [1, 1])
+    (1, 0, 2)
+    >>> confusion.counts()
+    (3, 2, 3)
+    """
+    def __init__(self, num_class=2):
+        self.num_class = num_class
+        self.reset()
+
+    def reset(self):
+        # confusion[label, predict]
+        self.confusion = np.zeros((self.num_class, self.num_class), dtype=np.int64)
+
+    def update(self, label, predict):
+        '''
+        :return: the batch (target, zero_count, one_count) like Accuracy
+        '''
+        label = np.asarray(label, dtype=np.int64).reshape(-1)
+        predict = np.asarray(predict, dtype=np.int64).reshape(-1)
+        assert len(predict) == len(label), "[ERROR] Length not equal"
+        batch = np.bincount(label * self.num_class + predict,
+                            minlength=self.num_class * self.num_class).reshape(self.num_class, self.num_class)
+        self.confusion += batch
+        return self.to_counts(batch)
+
+    def to_counts(self, confusion):
+        predict_count = confusion.sum(axis=0)
+        return int(np.trace(confusion)), int(predict_count[0]), int(predict_count[1])
+
+    def counts(self):
+        '''
+        :return: (target, zero_count, one_count) of everything seen, same as Accuracy on the full lists
+        '''
+        return self.to_counts(self.confusion)
+
+    @property
+    def line_count(self):
+        return int(self.confusion.sum())
+
+    def accuracy(self):
+        return np.trace(self.confusion) * 1.0 / max(self.line_count, 1)
+
+    def macro_f1(self):
+        '''
+        Same as marcoF1, classes that never show up in label nor predict are left out of the average
+        '''
+        true_positive = np.diag(self.confusion).astype(np.float64)
+        label_count = self.confusion.sum(axis=1)
+        predict_count = self.confusion.sum(axis=0)
+        present = (label_count + predict_count) > 0
+        denominator = label_count + predict_count
+        f1 = np.where(denominator > 0, 2 * true_positive / np.maximum(denominator, 1), 0.)
+        return float(np.mean(f1[present])) if present.any() else 0.
+
+
+class GroupedRankingEvaluator:
+    """Ranking metrics of every question from flat (question_id, score, label) arrays
+
+    Rows are sorted once by (question_id, -score), ties keep their arrival order like sorted() did,
+    then every metric is a segment reduction over the questions. The metric methods return one value
+    per question in question id order, sum or average them as needed.
+
+    >>> evaluator = GroupedRankingEvaluator()
+    >>> evaluator.update([1, 1, 1, 2, 2], [0.2, 0.9, 0.5, 0.1, 0.3], [0, 0, 1, 1, 0])
+    >>> evaluator.mean_reciprocal_rank()
+    array([0.5, 0.5])
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.question_id_list = []
+        self.score_list = []
+        self.label_list = []
+        self.answer_id_list = []
+        self.sorted = None
+
+    def update(self, question_id, score, label, answer_id=None):
+        '''
+        Only these columns are kept, so memory does not depend on the content length
+        :param question_id: question of each row, numpy array, list or tensor
+        :param score: predicted score of each row, bigger is ranked higher
+        :param label: relevance of each row
+        :param answer_id: answer of each row, optional, give it on every update or on none
+        '''
+        self.question_id_list.append(self.to_numpy(question_id).reshape(-1).astype(np.int64))
+        self.score_list.append(self.to_numpy(score).reshape(-1))
+        self.label_list.append(self.to_numpy(label).reshape(-1))
+        if answer_id is not None:
+            self.answer_id_list.append(self.to_numpy(answer_id).reshape(-1).astype(np.int64))
+        self.sorted = None
+
+    @staticmethod
+    def to_numpy(value):
+        if hasattr(value, "detach"):
+            value = value.detach().cpu().numpy()
+        return np.asarray(value)
+
+    def group(self):
+        if self.sorted is None:
+            question_id = np.concatenate(self.question_id_list) if self.question_id_list else np.zeros(0, dtype=np.int64)
+            score = np.concatenate(self.score_list) if self.score_list else np.zeros(0)
+            label = np.concatenate(self.label_list) if self.label_list else np.zeros(0)
+            # lexsort is stable, the last key is the primary one
+            order = np.lexsort((-score.astype(np.float64), question_id))
+            question_id = question_id[order]
+            start = np.concatenate([[True], question_id[1:] != question_id[:-1]]) if len(order) else np.zeros(0, bool)
+            indptr = np.append(np.nonzero(start)[0], len(order))
+            group_id = np.cumsum(start) - 1
+            position = np.arange(len(order)) - indptr[group_id]
+            self.sorted = {'order': order, 'indptr': indptr, 'group_id': group_id, 'position': position,
+                           'label': label[order].astype(np.float64), 'question_id': question_id[indptr[:-1]]}
+        return self.sorted
+
+    @property
+    def question_count(self):
+        return len(self.group()['indptr']) - 1
+
+    def question_id(self):
+        return self.group()['question_id']
+
+    def scores(self):
+        '''
+        :return: score of every row, concatenated in update order like the values given to split
+        '''
+        return np.concatenate(self.score_list) if self.score_list else np.zeros(0)
+
+    def ranked_answer_id(self):
+        '''
+        :return: list of the answer ids of every question in rank order, answer_id must be given to update
+        '''
+        assert len(self.answer_id_list) == len(self.question_id_list), "answer_id was not given to every update"
+        return self.split(np.concatenate(self.answer_id_list) if self.answer_id_list else np.zeros(0, dtype=np.int64))
+
+    def group_index(self):
+        '''
+        :return: row order sorted by (question_id, -score) and the indptr of every question inside it
+        '''
+        group = self.group()
+        return group['order'], group['indptr']
+
+    def split(self, value):
+        '''
+        :param value: per row values concatenated in update order
+        :return: list of the values of every question, rows in rank order
+        '''
+        order, indptr = self.group_index()
+        value = np.asarray(value)[order]
+        return [value[indptr[i]:indptr[i + 1]] for i in range(self.question_count)]
+
+    def segment_sum(self, value):
+        group = self.group()
+        return np.bincount(group['group_id'], weights=value, minlength=self.question_count)
+
+    def group_size(self):
+        return np.diff(self.group()['indptr'])
+
+    def average_precision(self):
+        group = self.group()
+        relevant = (group['label'] != 0).astype(np.float64)
+        cumulative = np.cumsum(relevant)
+        # relevant count above each row inside its own question
+        before = np.concatenate([[0.], cumulative])[group['indptr'][:-1]][group['group_id']]
+        precision = (cumulative - before) / (group['position'] + 1)
+        relevant_count = self.segment_sum(relevant)
+        precision_sum = self.segment_sum(precision * relevant)
+        return np.where(relevant_count > 0, precision_sum / np.maximum(relevant_count, 1), 0.)
+
+    def mean_reciprocal_rank(self):
+        group = self.group()
+        if self.question_count == 0:
+            return np.zeros(0)
+        size = len(group['position'])
+        first = np.minimum.reduceat(np.where(group['label'] != 0, group['position'], size), group['indptr'][:-1])
+        return np.where(first < size, 1. / (first + 1), 0.)
+
+    def precision_at_k(self, k):
+        assert k >= 1
+        group = self.group()
+        if np.any(self.group_size() < k):
+            raise ValueError('Relevance score length < k')
+        hit = (group['label'] != 0) & (group['position'] < k)
+        return self.segment_sum(hit.astype(np.float64)) / k
+
+    def dcg_weight(self, position, k, method):
+        if method == 0:
+            weight = 1. / np.log2(np.maximum(position + 1, 2))
+        elif method == 1:
+            weight = 1. / np.log2(position + 2)
+        else:
+            raise ValueError('method must be 0 or 1.')
+        return np.where(position < k, weight, 0.)
+
+    def ndcg_at_k(self, k, method=0):
+        group = self.group()
+        weight = self.dcg_weight(group['position'], k, method)
+        dcg = self.segment_sum(group['label'] * weight)
+        # ideal order: labels sorted descending inside every question
+        ideal_label = group['label'][np.lexsort((-group['label'], group['group_id']))]
+        dcg_max = self.segment_sum(ideal_label * weight)
+        return np.where(dcg_max != 0, dcg / np.where(dcg_max != 0, dcg_max, 1), 0.)
+
+    def top_is_best(self):
+        '''
+        1 for the questions whose top scored answer has the biggest label, np.argmax(rank_gt) == 0
+        '''
+        group = self.group()
+        if self.question_count == 0:
+            return np.zeros(0)
+        best = np.maximum.reduceat(group['label'], group['indptr'][:-1])
+        return (group['label'][group['indptr'][:-1]] == best).astype(np.float64)
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -2,6 +2,7 @@
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from Util import lstm_by_length
 
 
 class LSTM_Hidden_List(nn.Module):
@@ -24,12 +25,18 @@ class LSTM_Hidden_List(nn.Module):
                               dtype=torch.float, device=self.args.device)
         return hiddena, hiddenb
 
-    def forward(self, input):
+    def forward(self, input, length=None, total_length=None):
+        '''
+        :param length: real length of every post, the output is then cut at the longest post of the batch
+        (or padded to total_length) and zero after the end of each post
+        '''
         shape = [*input.shape]
         input = input.view(-1, shape[-2], shape[-1])
         shape[-1] = self.args.lstm_hidden_size
         del shape[-2]
         hiddena, hiddenb = self.lstm_init(input.shape[0])
+        if length is not None:
+            return lstm_by_length(self.lstm, input, length, (hiddena, hiddenb), total_length)
         output, _ = self.lstm(input, (hiddena, hiddenb))
         return output
 
@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
 from MultihopAttention.Layer import *
-from Util import ContentEmbed
+from Util import ContentEmbed, sequence_length, masked_mean
 
 
 class MultihopAttention(nn.Module):
@@ -31,11 +31,15 @@ class MultihopAttention(nn.Module):
         question_embed = self.word_embed(question)
         answer_embed = self.word_embed(answer)
 
-        lstm_list_question = self.lstm(question_embed)
-        lstm_list_answer = self.lstm(answer_embed)
+        question_length, answer_length = None, None
+        if self.args.pack_sequence:
+            question_length = sequence_length(question)
+            answer_length = sequence_length(answer)
+        lstm_list_question = self.lstm(question_embed, question_length)
+        lstm_list_answer = self.lstm(answer_embed, answer_length)
 
         score = 0
-        m_q = torch.mean(lstm_list_question, dim=-2)
+        m_q = masked_mean(lstm_list_question, question_length)
         for i in range(self.attention_layers):
             o_q, m_q = self.question_model(lstm_list_question, m_q)
             # o_a_bilinear = self.answer_model_bilinear(o_q, lstm_list_answer)
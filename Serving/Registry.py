@@ -0,0 +1,108 @@
+import os
+import numpy as np
+import torch
+from Util import ContentEmbed, UserContextEmbed, userContextFile, config_copy
+
+from CNTN.Model import CNTN
+from AMRNL.Model import AMRNL
+from AILSTM.Model import AILSTM
+from biLSTM_CNN.Model import BiLstMCNN
+from MultihopAttention.Model import MultihopAttention
+from HybridAttention.Model import HybridAttentionModel
+
+
+# model name -> builder(args, data, word2vec, content_embed) returning (model, score_fn)
+# score_fn(question, answer, user) scores every (question, answer) row with the score eval_epoch ranks by
+MODEL_REGISTRY = {}
+
+
+def register_model(name):
+    def register(builder):
+        MODEL_REGISTRY[name] = builder
+        return builder
+    return register
+
+
+@register_model("CNTN")
+def build_CNTN(args, data, word2vec, content_embed):
+    model = CNTN(args, word2vec)
+
+    def score_fn(question, answer, user):
+        return model(question, answer)[1 if args.is_classification else 0].view(-1)
+    return model, score_fn
+
+
+@register_model("AMRNL")
+def build_AMRNL(args, data, word2vec, content_embed):
+    love_list_count = data['love_list_count']
+    love_adj_embed = ContentEmbed(torch.LongTensor(love_list_count[0]).to(args.device))
+    love_weight = ContentEmbed(torch.FloatTensor(love_list_count[1]).to(args.device))
+    model = AMRNL(args, data['user_count'], word2vec, love_adj_embed, love_weight)
+
+    def score_fn(question, answer, user):
+        score = model(question, answer, user)[0]
+        return score[:, 1] if args.is_classification else score.view(-1)
+    return model, score_fn
+
+
+@register_model("AILSTM")
+def build_AILSTM(args, data, word2vec, content_embed):
+    model = AILSTM(args, word2vec)
+
+    def score_fn(question, answer, user):
+        score = model(question, answer)
+        return score[0][:, 1] if args.is_classification else score.view(-1)
+    return model, score_fn
+
+
+@register_model("BiLstMCNN")
+def build_BiLstMCNN(args, data, word2vec, content_embed):
+    model = BiLstMCNN(args, word2vec)
+
+    def score_fn(question, answer, user):
+        if args.is_classification:
+            return model(question, answer, is_training=False)[0][:, 1]
+        return model(question, answer, is_training=False)
+    return model, score_fn
+
+
+@register_model("Multihop")
+def build_Multihop(args, data, word2vec, content_embed):
+    model = MultihopAttention(args, word2vec)
+
+    def score_fn(question, answer, user):
+        return model(question, answer)
+    return model, score_fn
+
+
+@register_model("Hybrid")
+def build_Hybrid(args, data, word2vec, content_embed):
+    # the model sizes its lstm hidden state by args.batch_size, it gets its own copy of the config
+    # so that score_fn never writes the shared config_model
+    args = config_copy(args)
+    model = HybridAttentionModel(args, word2vec)
+    user_context_file = userContextFile(args.data, args.max_u_len)
+    if os.path.exists(user_context_file) is False:
+        UserContextEmbed(content_embed, args, data['user_count']).buildUserContextEmbed(data['user_context'], user_context_file)
+    user_context = torch.from_numpy(np.load(user_context_file).astype(np.int64)).to(args.device)
+
+    def score_fn(question, answer, user):
+        # batches run one at a time in the server worker thread
+        args.batch_size = question.shape[0]
+        return model(question, answer, user_context[user])[1 if args.is_classification else 0].view(-1)
+    return model, score_fn
+
+
+def build_model(name, args, data, word2vec, content_embed, model_file=None):
+    '''
+    :param model_file: state dict of the trained model, None keeps the initial weights
+    :return: model in eval mode on args.device, score_fn
+    '''
+    if name not in MODEL_REGISTRY:
+        raise ValueError("[ERROR] no serving support for model {}, registered: {}".format(name, sorted(MODEL_REGISTRY.keys())))
+    model, score_fn = MODEL_REGISTRY[name](args, data, word2vec, content_embed)
+    if model_file is not None:
+        model.load_state_dict(torch.load(model_file, map_location=args.device))
+    model.to(args.device)
+    model.eval()
+    return model, score_fn
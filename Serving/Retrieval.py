@@ -0,0 +1,222 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+from Constants import Constants
+from DataSet.store import content_length
+
+
+def array_digest(digest, array):
+    array = np.ascontiguousarray(array)
+    digest.update("{}{}".format(array.dtype, array.shape).encode("utf-8"))
+    digest.update(array.tobytes())
+
+
+def state_fingerprint(model):
+    '''
+    sha1 of every tensor of the state dict, a retrained model never matches the cache of the old one
+    '''
+    digest = hashlib.sha1()
+    for name, value in model.state_dict().items():
+        digest.update(name.encode("utf-8"))
+        array_digest(digest, value.detach().cpu().numpy())
+    return digest.hexdigest()
+
+
+def pad_question(question_list, max_len):
+    '''
+    :param question_list: list of word id lists of any length
+    :return: Q * max_len int64 matrix, cut or padded at the end like shrink_clean_text
+    '''
+    matrix = np.full((len(question_list), max_len), Constants.PAD, dtype=np.int64)
+    for index, question in enumerate(question_list):
+        question = list(question)[:max_len]
+        matrix[index, :len(question)] = question
+    return matrix
+
+
+class AnswerRetrieval:
+    '''
+    top-K answers of new questions out of the whole answer pool
+    models with question_representation / answer_representation / score_representation (CNTN, AMRNL) keep
+    the answer half of their score for every answer, a question then costs one encoding and one batched
+    scoring over the pool
+    other models get candidate answers from an annoy index (SimQues.Layer.NeighborLocation) over the mean
+    word vector of every answer, and score_fn re-scores the candidates in one batch
+    '''
+    def __init__(self, model, args, answer_content, answer_id=None, answer_user=None, word2vec=None,
+                 score_fn=None, cache_file=None, candidate_count=None, use_annoy=False, batch_size=512):
+        '''
+
+        :param answer_content: N * max_len word ids of the answer pool
+        :param answer_id: id returned for every row of answer_content, default the row number
+        :param answer_user: N, author of every answer, for models that score the user (AMRNL)
+        :param word2vec: vocab_size * embed_size, needed by the annoy index
+        :param score_fn: score_fn(question, answer, user) -> score of every row, for models without representations
+        :param cache_file: prefix of the answer representation .npy and the annoy index
+        :param candidate_count: answers taken from the annoy index for every question
+        :param use_annoy: only re-score the annoy candidates even when the model can score the whole pool
+        :param batch_size: answers encoded / scored at a time
+        '''
+        self.model = model
+        self.args = args
+        self.answer_content = np.asarray(answer_content, dtype=np.int64)
+        self.answer_id = np.arange(len(self.answer_content)) if answer_id is None else np.asarray(answer_id)
+        self.answer_user = None if answer_user is None else np.asarray(answer_user, dtype=np.int64)
+        self.word2vec = word2vec
+        self.score_fn = score_fn
+        self.cache_file = cache_file
+        self.candidate_count = candidate_count
+        self.batch_size = batch_size
+        self.separable = hasattr(model, "answer_representation")
+        self.use_annoy = use_annoy or not self.separable
+        assert self.separable or score_fn is not None, "[ERROR] model has no answer_representation, give a score_fn"
+        self.answer_rep = None
+        self.neighbor = None
+
+    def answer_batch(self, index):
+        answer = torch.from_numpy(self.answer_content[index]).to(self.args.device)
+        user = None
+        if self.answer_user is not None:
+            user = torch.from_numpy(self.answer_user[index]).to(self.args.device)
+        return answer, user
+
+    def build(self, load_cache=False):
+        '''
+        encode the answer pool once, the model has to stay fixed (eval mode, same weights) while serving
+        :param load_cache: reuse the representations / annoy index stored under cache_file, when the
+        fingerprint saved with them matches the current weights and answer pool
+        '''
+        self.model.eval()
+        if self.separable:
+            rep_file = None if self.cache_file is None else self.cache_file + "_answer_rep.npy"
+            rep_key = self.cache_key(state_fingerprint(self.model))
+            if load_cache and self.cache_valid("answer_rep", rep_key, rep_file):
+                answer_rep = np.load(rep_file)
+            else:
+                rep_list = []
+                with torch.no_grad():
+                    for begin in range(0, len(self.answer_content), self.batch_size):
+                        answer, user = self.answer_batch(np.arange(begin, min(begin + self.batch_size, len(self.answer_content))))
+                        rep = self.model.answer_representation(answer) if user is None else self.model.answer_representation(answer, user)
+                        rep_list.append(rep.cpu().numpy().astype(np.float32))
+                answer_rep = np.concatenate(rep_list)
+                if rep_file is not None:
+                    np.save(rep_file, answer_rep)
+                    self.save_cache_key("answer_rep", rep_key)
+            self.answer_rep = torch.from_numpy(answer_rep).to(self.args.device)
+            print("[INFO] {} answer representations of size {}".format(*answer_rep.shape))
+        if self.use_annoy:
+            from SimQues.Layer import NeighborLocation
+            assert self.cache_file is not None and self.word2vec is not None, "[ERROR] annoy index needs cache_file and word2vec"
+            index_file = self.cache_file + "_answer.annoy"
+            word2vec = self.word2vec.detach().cpu().numpy() if torch.is_tensor(self.word2vec) else np.asarray(self.word2vec)
+            index_key = self.cache_key(hashlib.sha1(np.ascontiguousarray(word2vec).tobytes()).hexdigest())
+            if load_cache and self.cache_valid("annoy", index_key, index_file):
+                self.neighbor = NeighborLocation(self.word2vec.shape[1], index_file, load_file=True)
+            else:
+                self.neighbor = NeighborLocation(self.word2vec.shape[1], index_file, self.mean_word_vector(self.answer_content))
+                self.save_cache_key("annoy", index_key)
+        return self
+
+    def cache_key(self, weight_fingerprint):
+        # the weights the cache is computed from and the answer pool it covers, row by row
+        digest = hashlib.sha1(weight_fingerprint.encode("utf-8"))
+        array_digest(digest, self.answer_content)
+        if self.answer_user is not None:
+            array_digest(digest, self.answer_user)
+        return digest.hexdigest()
+
+    def cache_valid(self, name, key, file):
+        # a stale or foreign cache is rebuilt instead of served
+        key_file = self.cache_file + "_fingerprint.json"
+        if os.path.exists(file) is False or os.path.exists(key_file) is False:
+            return False
+        with open(key_file) as f:
+            valid = json.load(f).get(name) == key
+        if valid is False:
+            print("[WARNING] {} cache {} does not match the model / answer pool, rebuilding it".format(name, file))
+        return valid
+
+    def save_cache_key(self, name, key):
+        key_file = self.cache_file + "_fingerprint.json"
+        key_dic = {}
+        if os.path.exists(key_file):
+            with open(key_file) as f:
+                key_dic = json.load(f)
+        key_dic[name] = key
+        with open(key_file + ".tmp", "w") as f:
+            json.dump(key_dic, f)
+        os.replace(key_file + ".tmp", key_file)
+
+    def mean_word_vector(self, content):
+        '''
+        mean word vector of the real words of every post, the key of the annoy index
+        '''
+        word2vec = np.asarray(self.word2vec.cpu() if torch.is_tensor(self.word2vec) else self.word2vec, dtype=np.float32)
+        length = np.maximum(content_length(content), 1)
+        vector = np.zeros((len(content), word2vec.shape[1]), dtype=np.float32)
+        for begin in range(0, len(content), self.batch_size):
+            block = content[begin:begin + self.batch_size]
+            vector[begin:begin + len(block)] = word2vec[block].sum(axis=1)
+        # pads are word 0, take their vectors out again
+        vector -= np.outer(content.shape[1] - length, word2vec[Constants.PAD])
+        return vector / length[:, None]
+
+    def score_all(self, question):
+        # Q * N scores over the whole pool, answers scored batch_size at a time
+        question_rep = self.model.question_representation(question)
+        score_list = [self.model.score_representation(question_rep, self.answer_rep[begin:begin + self.batch_size])
+                      for begin in range(0, len(self.answer_rep), self.batch_size)]
+        return torch.cat(score_list, dim=1)
+
+    def score_candidate(self, question, candidate):
+        '''
+        :param question: Q * L
+        :param candidate: Q * C rows of the answer pool
+        :return: Q * C scores
+        '''
+        question_count, candidate_count = candidate.shape
+        if self.separable:
+            question_rep = self.model.question_representation(question)
+            answer_rep = self.answer_rep[torch.from_numpy(candidate.reshape(-1)).to(self.args.device)]
+            answer_rep = answer_rep.view(question_count, candidate_count, -1)
+            return torch.stack([self.model.score_representation(question_rep[i:i + 1], answer_rep[i])[0]
+                                for i in range(question_count)])
+        answer, user = self.answer_batch(candidate.reshape(-1))
+        question = question.unsqueeze(1).expand(-1, candidate_count, -1).reshape(question_count * candidate_count, -1)
+        return self.score_fn(question, answer, user).view(question_count, candidate_count)
+
+    def rank_batch(self, question_list, k=10):
+        '''
+        :param question_list: list of word id lists
+        :return: answer ids Q * k and their scores Q * k, best first
+        '''
+        question_matrix = pad_question(question_list, self.answer_content.shape[1])
+        question = torch.from_numpy(question_matrix).to(self.args.device)
+        with torch.no_grad():
+            if self.use_annoy:
+                candidate_count = self.candidate_count or max(10 * k, 100)
+                question_vector = self.mean_word_vector(question_matrix)
+                candidate_list = [self.neighbor.find_by_vector(vector, candidate_count) for vector in question_vector]
+                # every question keeps the same number of candidates, annoy can return fewer than asked
+                width = min(len(candidate) for candidate in candidate_list)
+                candidate = np.array([candidate[:width] for candidate in candidate_list], dtype=np.int64)
+                score = self.score_candidate(question, candidate)
+            else:
+                candidate = None
+                score = self.score_all(question)
+            score, top_index = torch.topk(score, min(k, score.shape[1]), dim=-1)
+        top_index = top_index.cpu().numpy()
+        if candidate is not None:
+            top_index = np.take_along_axis(candidate, top_index, axis=1)
+        return self.answer_id[top_index], score.cpu().numpy()
+
+    def rank(self, question, k=10):
+        '''
+        :param question: word id list of one question
+        :return: list of (answer id, score), best first
+        '''
+        answer_id, score = self.rank_batch([question], k)
+        return list(zip(answer_id[0].tolist(), score[0].tolist()))
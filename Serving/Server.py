@@ -0,0 +1,264 @@
+import asyncio
+import collections
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from Serving.Retrieval import pad_question
+
+
+class ScoreRequest:
+    def __init__(self, question, answer_list, user_list, future):
+        self.question = question
+        self.answer_list = answer_list
+        self.user_list = user_list
+        self.future = future
+        self.arrive = time.perf_counter()
+
+
+class ScoringServer:
+    '''
+    scores (question, candidate answers, users) requests with a score_fn of Serving.Registry
+    concurrent requests are merged into one forward of at most max_batch_rows rows; a batch is closed when it is
+    full or max_wait_ms after its first request arrived, the model runs in one worker thread under
+    torch.inference_mode so the event loop keeps accepting requests
+    the protocol is one json object per line over a unix socket (or tcp):
+    {"question": [word id], "answers": [[word id]], "users": [user id]} -> {"score": [float]}
+    {"stats": true} -> latency percentiles of the last requests
+    requests are validated before they join a batch, and a batch that still fails is scored again one
+    request at a time, so a bad request only fails itself
+    '''
+    def __init__(self, score_fn, args, max_batch_rows=256, max_wait_ms=5, question_len=None, answer_len=None,
+                 latency_window=10000, word_count=None, user_count=None):
+        '''
+
+        :param word_count: size of the word embedding, word ids must be below it
+        :param user_count: number of users, user ids must be below it
+        '''
+        self.score_fn = score_fn
+        self.word_count = word_count
+        self.user_count = user_count
+        self.args = args
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait_ms / 1000.0
+        self.question_len = question_len or args.max_q_len
+        self.answer_len = answer_len or args.max_a_len
+        self.latency = collections.deque(maxlen=latency_window)
+        self.batch_rows = collections.deque(maxlen=latency_window)
+        self.request_count = 0
+        self.queue = None
+        self.batch_task = None
+        self.server = None
+        # one thread, torch already uses all the cores inside a forward
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def run_batch(self, request_list):
+        '''
+        :return: numpy scores of every request, in request order
+        '''
+        row_count = [len(request.answer_list) for request in request_list]
+        question = np.repeat(pad_question([request.question for request in request_list], self.question_len),
+                             row_count, axis=0)
+        answer = pad_question([answer for request in request_list for answer in request.answer_list], self.answer_len)
+        user = np.concatenate([np.asarray(request.user_list, dtype=np.int64) for request in request_list])
+        with torch.inference_mode():
+            score = self.score_fn(torch.from_numpy(question).to(self.args.device),
+                                  torch.from_numpy(answer).to(self.args.device),
+                                  torch.from_numpy(user).to(self.args.device))
+        score = score.float().cpu().numpy().reshape(-1)
+        return np.split(score, np.cumsum(row_count)[:-1])
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            request_list = [await self.queue.get()]
+            rows = len(request_list[0].answer_list)
+            deadline = loop.time() + self.max_wait
+            while rows < self.max_batch_rows:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                request_list.append(request)
+                rows += len(request.answer_list)
+            self.batch_rows.append(rows)
+            try:
+                score_list = await loop.run_in_executor(self.executor, self.run_batch, request_list)
+            except Exception as error:
+                if len(request_list) == 1:
+                    self.set_exception(request_list[0], error)
+                    continue
+                # find the request that broke the batch, the others still get their scores
+                for request in request_list:
+                    try:
+                        score = (await loop.run_in_executor(self.executor, self.run_batch, [request]))[0]
+                    except Exception as request_error:
+                        self.set_exception(request, request_error)
+                        continue
+                    if not request.future.done():
+                        request.future.set_result(score.tolist())
+                continue
+            for request, score in zip(request_list, score_list):
+                if not request.future.done():
+                    request.future.set_result(score.tolist())
+
+    @staticmethod
+    def set_exception(request, error):
+        if not request.future.done():
+            request.future.set_exception(error)
+
+    def check_ids(self, name, id_list, limit):
+        id_array = np.asarray(id_list)
+        if id_array.size == 0:
+            return
+        if id_array.dtype.kind not in "iu":
+            raise ValueError("[ERROR] {} must be integer ids".format(name))
+        if id_array.min() < 0 or (limit is not None and id_array.max() >= limit):
+            raise ValueError("[ERROR] {} id out of range [0, {}): {}".format(name, limit, int(id_array.min() if id_array.min() < 0 else id_array.max())))
+
+    def validate(self, question, answer_list, user_list):
+        if len(answer_list) == 0:
+            raise ValueError("[ERROR] no answers to score")
+        if len(user_list) != len(answer_list):
+            raise ValueError("[ERROR] {} users for {} answers".format(len(user_list), len(answer_list)))
+        self.check_ids("question word", question, self.word_count)
+        for answer in answer_list:
+            self.check_ids("answer word", answer, self.word_count)
+        self.check_ids("user", user_list, self.user_count)
+
+    def ensure_started(self):
+        if self.batch_task is None:
+            self.queue = asyncio.Queue()
+            self.batch_task = asyncio.get_running_loop().create_task(self.batch_loop())
+
+    async def score(self, question, answer_list, user_list=None):
+        '''
+        score one question against its candidate answers, merged with the other pending requests
+        :return: list of scores, one for every answer
+        '''
+        self.ensure_started()
+        if user_list is None:
+            user_list = [0] * len(answer_list)
+        # raised to this caller only, nothing is queued
+        self.validate(question, answer_list, user_list)
+        request = ScoreRequest(question, answer_list, user_list, asyncio.get_running_loop().create_future())
+        await self.queue.put(request)
+        score = await request.future
+        self.latency.append(time.perf_counter() - request.arrive)
+        self.request_count += 1
+        return score
+
+    def stats(self):
+        '''
+        latency percentiles in ms over the last latency_window requests and the mean rows of a batch
+        '''
+        if len(self.latency) == 0:
+            return {"request": self.request_count}
+        latency = np.array(self.latency) * 1000
+        p50, p90, p99 = np.percentile(latency, [50, 90, 99])
+        return {"request": self.request_count, "p50_ms": float(p50), "p90_ms": float(p90), "p99_ms": float(p99),
+                "mean_ms": float(latency.mean()), "batch_rows": float(np.mean(self.batch_rows))}
+
+    async def handle_connection(self, reader, writer):
+        # requests of one connection are answered in order, clients open several connections for concurrency
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                message = json.loads(line)
+                if message.get("stats"):
+                    reply = self.stats()
+                else:
+                    reply = {"score": await self.score(message["question"], message["answers"], message.get("users"))}
+            except Exception as error:
+                reply = {"error": "{}: {}".format(type(error).__name__, error)}
+            writer.write((json.dumps(reply) + "\n").encode())
+            await writer.drain()
+        writer.close()
+
+    async def start(self, path=None, host="127.0.0.1", port=None):
+        '''
+        listen on the unix socket path, or on host:port when path is None
+        '''
+        self.ensure_started()
+        if path is not None:
+            if os.path.exists(path):
+                os.remove(path)
+            self.server = await asyncio.start_unix_server(self.handle_connection, path=path)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host=host, port=port)
+        print("[INFO] scoring server listening on {}".format(path if path is not None else "{}:{}".format(host, port)))
+        return self.server
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.batch_task is not None:
+            self.batch_task.cancel()
+        self.executor.shutdown(wait=False)
+
+
+class ScoringClient:
+    '''
+    one connection to a ScoringServer, requests are sent one after the other
+    '''
+    def __init__(self, path=None, host="127.0.0.1", port=None):
+        self.path = path
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        if self.path is not None:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        return self
+
+    async def request(self, message):
+        self.writer.write((json.dumps(message) + "\n").encode())
+        await self.writer.drain()
+        reply = json.loads(await self.reader.readline())
+        if "error" in reply:
+            raise RuntimeError(reply["error"])
+        return reply
+
+    async def score(self, question, answer_list, user_list=None):
+        message = {"question": list(question), "answers": [list(answer) for answer in answer_list]}
+        if user_list is not None:
+            message["users"] = list(user_list)
+        return (await self.request(message))["score"]
+
+    async def stats(self):
+        return await self.request({"stats": True})
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+
+
+async def local_benchmark(server, request_list, concurrency=16, path=None, host="127.0.0.1", port=None):
+    '''
+    send request_list = [(question, answer_list, user_list)] from concurrency clients to a started server
+    :return: scores in request order, server stats
+    '''
+    result = [None] * len(request_list)
+    next_request = iter(range(len(request_list)))
+
+    async def worker():
+        client = await ScoringClient(path, host, port).connect()
+        for index in next_request:
+            result[index] = await client.score(*request_list[index])
+        await client.close()
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return result, server.stats()
@@ -6,6 +6,7 @@ import numpy as np
 from gensim.models import LdaModel
 from gensim.test.utils import datapath
 from joblib import dump, load
+from Metric.coverage_metric import lda_topic_matrix
 
 class NeighborLocation:
     def __init__(self, feature_length, file_path, key_vector_list=None, build_tree=100, load_file=False):
@@ -38,6 +39,71 @@ class NeighborLocation:
     def get_distance(self, index1, index2):
         return self.annoy.get_distance(index1, index2)
 
+    def key_matrix(self):
+        item_count = self.annoy.get_n_items()
+        return np.array([self.annoy.get_item_vector(i) for i in range(item_count)], dtype=np.float32)
+
+
+class CategoryNeighbor:
+    '''
+    Offline top-k same category neighbors of every question.
+    The (question_count, k) neighbor matrix and the key vector matrix are stored next to the annoy index,
+    so the dataset only indexes into them.
+    Similarities are computed a tile of at most block_elements scores at a time, a large category gets
+    fewer than block_size rows per tile.
+    '''
+    def __init__(self, file_path, question_neighbor_finder=None, question_answer_user_vote_cate=None,
+                 user_count=None, k=None, block_size=1024, load_file=False, block_elements=1 << 22):
+        neighbor_file = file_path + "_neighbor.npy"
+        key_file = file_path + "_key.npy"
+        if load_file:
+            self.neighbor = np.load(neighbor_file, mmap_mode='r')
+            self.key_vector = np.load(key_file, mmap_mode='r')
+        else:
+            self.key_vector = question_neighbor_finder.key_matrix()
+            self.neighbor = self.build(question_neighbor_finder, question_answer_user_vote_cate, user_count, k,
+                                       block_size, block_elements)
+            np.save(neighbor_file, self.neighbor)
+            np.save(key_file, self.key_vector)
+        self.k = self.neighbor.shape[1]
+
+    def build(self, question_neighbor_finder, question_answer_user_vote_cate, user_count, k, block_size,
+              block_elements=1 << 22):
+        question_answer_user_vote_cate = np.asarray(question_answer_user_vote_cate)
+        question_cate = np.unique(question_answer_user_vote_cate[:, [0, -1]], axis=0)
+        question_index = question_cate[:, 0] - user_count
+        cate_list = question_cate[:, 1]
+        # annoy angular distance is monotone in cosine, so rank by normalized dot product
+        norm = np.linalg.norm(self.key_vector, axis=-1, keepdims=True)
+        key_norm = self.key_vector / np.maximum(norm, 1e-12)
+        neighbor = np.full((len(self.key_vector), k), -1, dtype=np.int64)
+        for cate in np.unique(cate_list):
+            same_cate = question_index[cate_list == cate]
+            same_cate_key = key_norm[same_cate]
+            top = min(k, len(same_cate))
+            # rows * len(same_cate) scores per tile, about 16MB of float32
+            rows = max(1, min(block_size, block_elements // len(same_cate)))
+            for begin in range(0, len(same_cate), rows):
+                block = same_cate[begin:begin + rows]
+                similar = np.dot(key_norm[block], same_cate_key.T)
+                top_index = np.argpartition(-similar, top - 1, axis=-1)[:, :top]
+                top_similar = np.take_along_axis(similar, top_index, axis=-1)
+                top_index = np.take_along_axis(top_index, np.argsort(-top_similar, axis=-1), axis=-1)
+                neighbor[block, :top] = same_cate[top_index]
+            if top < k:
+                # not enough questions in the category, fill with the global nearest neighbors
+                for index in same_cate:
+                    more = question_neighbor_finder.find_by_index(int(index), k - top)
+                    more = more + [index] * (k - top - len(more))
+                    neighbor[index, top:] = more
+        return neighbor
+
+    def find_by_index(self, index, k):
+        return self.neighbor[index, :k]
+
+    def get_item(self, index):
+        return self.key_vector[index]
+
 
 class LDAKey:
     def __init__(self, background_data, topic_count, model_path, load_pretrain=False):
@@ -45,6 +111,7 @@ class LDAKey:
         self.corpus = [self.list2tuple(line) for line in background_data]
         if not os.path.exists(model_path):
             os.makedirs(model_path)
+        topic_file = os.path.join(os.path.abspath(model_path), "lda_topic.npy")
         model_path = os.path.join(os.path.abspath(model_path), file_name)
         if load_pretrain:
             self.lda = self.loadModel(model_path)
@@ -53,6 +120,16 @@ class LDAKey:
 
             self.lda = LdaModel(self.corpus, num_topics=topic_count)
             self.saveModel(model_path)
+        # dense topic vector of every document, inferred once
+        self.topic_cache = None
+        if load_pretrain and os.path.exists(topic_file) and os.path.getmtime(topic_file) >= os.path.getmtime(model_path):
+            topic_cache = np.load(topic_file, mmap_mode='r')
+            # written for another corpus or another number of topics
+            if topic_cache.shape == (len(self.corpus), self.lda.num_topics):
+                self.topic_cache = topic_cache
+        if self.topic_cache is None:
+            self.topic_cache = lda_topic_matrix(self.lda, self.corpus)
+            np.save(topic_file, self.topic_cache)
 
     def list2tuple(self, data_list):
         data_list = np.array(data_list)
@@ -70,15 +147,18 @@ class LDAKey:
         lda = LdaModel.load(temp_file)
         return lda
 
+    def to_tuple(self, topic_vec):
+        return [(topic, float(value)) for topic, value in enumerate(topic_vec) if value > 0]
+
+    def lda_matrix(self, index=None):
+        return self.topic_cache if index is None else self.topic_cache[index]
+
     def lda_by_index(self, index):
-        corpus_vect = self.corpus[index]
-        lda_vec = self.lda[corpus_vect]
-        return lda_vec
+        return self.to_tuple(self.topic_cache[index])
 
     def lda_by_vec(self, document):
         corpus_vect = self.list2tuple(document)
-        lda_vec = self.lda[corpus_vect]
-        return lda_vec
+        return self.to_tuple(lda_topic_matrix(self.lda, [corpus_vect])[0])
 
 class TFIDFKey:
     def __init__(self, background_data, model_path, load_pretrain=False):
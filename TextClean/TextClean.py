@@ -1,4 +1,6 @@
 import re
+from functools import lru_cache, partial
+from operator import methodcaller
 from nltk.corpus import stopwords
 from nltk.tokenize import word_tokenize
 from nltk.stem.snowball import SnowballStemmer
@@ -7,60 +9,99 @@ from Constants import Constants
 
 stemmer = SnowballStemmer("english")
 
-def cleanText(text):
-    #TODO: consider each pragraph as an sentence or heriarchy lstm
-    #TODO: remove most frquent/unfrequent word
-    #convert
-    text = re.sub(r"<[^>]+>", "", text)
-    text = re.sub(r"[^A-Za-z0-9^,!.\/'+-=]", " ", text)
-    text = re.sub(r"what's", "what is ", text)
-    text = re.sub(r"\'s", " ", text)
-    text = re.sub(r"\'ve", " have ", text)
-    text = re.sub(r"can't", "cannot ", text)
-    text = re.sub(r"n't", " not ", text)
-    text = re.sub(r"ur", "your ", text)
-    text = re.sub(r"i'm", "i am ", text)
-    text = re.sub(r"\'re", " are ", text)
-    text = re.sub(r"\'d", " would ", text)
-    text = re.sub(r"\'ll", " will ", text)
-    text = re.sub(r",", " ", text)
-    text = re.sub(r"\.", " ", text)
-    text = re.sub(r"!", " ! ", text)
-    text = re.sub(r"\/", " ", text)
-    text = re.sub(r"\^", " ^ ", text)
-    text = re.sub(r"\+", " + ", text)
-    text = re.sub(r"\-", " - ", text)
-    text = re.sub(r"\=", " = ", text)
-    text = re.sub(r"'", " ", text)
-    text = re.sub(r"(\d+)(k)", r"\g<1>000", text)
-    text = re.sub(r":", " : ", text)
-    text = re.sub(r" e g ", " egcontent_list.pickle ", text)
-    text = re.sub(r" b g ", " bg ", text)
-    text = re.sub(r" u s ", " american ", text)
-    text = re.sub(r"\0s", "0", text)
-    text = re.sub(r" 9 11 ", "911", text)
-    text = re.sub(r"e - mail", "email", text)
-    text = re.sub(r"j k", "jk", text)
-    text = re.sub(r"\s{2,}", " ", text)
-    text = re.sub(r"(\s)&[a-zA-Z0-9_#]", r'\1', text)
-
-
-
-    #remove alphabet is not a-z, A-Z
-    # text = re.sub(r"[^a-zA-Z]",' ', text)
-
-    #lower case
-    text = text.lower()
-
-    #drop stop words
-    word_tokens = word_tokenize(text)
-    stop_words = set(stopwords.words('english'))
-    filtered_sentence = [w for w in word_tokens if not w in stop_words]
-
-    #stem words
-    #loving -> love
-    stem_words = [stemmer.stem(word) for word in filtered_sentence]
-
-
-    return stem_words
+# single characters replaced in one str.translate pass, none of them produces another one
+CHAR_REPLACE = str.maketrans({
+    ",": " ",
+    ".": " ",
+    "!": " ! ",
+    "/": " ",
+    "^": " ^ ",
+    "+": " + ",
+    "-": " - ",
+    "=": " = ",
+    "'": " ",
+})
+
+# applied in order, literal patterns use str.replace and the rest compiled regex
+SUBSTITUTION = [
+    partial(re.compile(r"<[^>]+>").sub, ""),
+    partial(re.compile(r"[^A-Za-z0-9^,!.\/'+-=]").sub, " "),
+    methodcaller("replace", "what's", "what is "),
+    methodcaller("replace", "'s", " "),
+    methodcaller("replace", "'ve", " have "),
+    methodcaller("replace", "can't", "cannot "),
+    methodcaller("replace", "n't", " not "),
+    methodcaller("replace", "ur", "your "),
+    methodcaller("replace", "i'm", "i am "),
+    methodcaller("replace", "'re", " are "),
+    methodcaller("replace", "'d", " would "),
+    methodcaller("replace", "'ll", " will "),
+    methodcaller("translate", CHAR_REPLACE),
+    partial(re.compile(r"(\d+)(k)").sub, r"\g<1>000"),
+    methodcaller("replace", ":", " : "),
+    methodcaller("replace", " e g ", " egcontent_list.pickle "),
+    methodcaller("replace", " b g ", " bg "),
+    methodcaller("replace", " u s ", " american "),
+    methodcaller("replace", "\0s", "0"),
+    methodcaller("replace", " 9 11 ", "911"),
+    methodcaller("replace", "e - mail", "email"),
+    methodcaller("replace", "j k", "jk"),
+    partial(re.compile(r"\s{2,}").sub, " "),
+    partial(re.compile(r"(\s)&[a-zA-Z0-9_#]").sub, r'\1'),
+]
+
+stop_words = None
+
+
+def get_stop_words():
+    # the stop word set is built once per process instead of once per post
+    global stop_words
+    if stop_words is None:
+        stop_words = set(stopwords.words('english'))
+    return stop_words
+
+
+class TextCleaner:
+    '''
+    Same output as the original chain of re.sub + stop words + stemming.
+    Stemming goes through an LRU cache, the vocabulary is Zipfian so most tokens hit it.
+    '''
+    def __init__(self, stem_cache_size=2 ** 17):
+        self.substitution = SUBSTITUTION
+        self.stem = lru_cache(maxsize=stem_cache_size)(stemmer.stem)
+
+    def normalize(self, text):
+        for substitute in self.substitution:
+            text = substitute(text)
+        return text
+
+    def clean(self, text):
+        #TODO: consider each pragraph as an sentence or heriarchy lstm
+        #TODO: remove most frquent/unfrequent word
+        #convert
+        text = self.normalize(text)
 
+        #lower case
+        text = text.lower()
+
+        #drop stop words
+        word_tokens = word_tokenize(text)
+        stop_words = get_stop_words()
+
+        #stem words
+        #loving -> love
+        stem = self.stem
+        return [stem(w) for w in word_tokens if not w in stop_words]
+
+    def stem_info(self):
+        info = self.stem.cache_info()
+        lookup = info.hits + info.misses
+        return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize,
+                'hit_rate': info.hits * 1.0 / lookup if lookup else 0.}
+
+
+cleaner = TextCleaner()
+
+
+def cleanText(text):
+    return cleaner.clean(text)
@@ -2,9 +2,9 @@
 import torch.nn as nn
 import torch
 import numpy as np
-import gensim
 import os
-from gensim.scripts.glove2word2vec import glove2word2vec
+import json
+import hashlib
 from sklearn.model_selection import train_test_split
 import collections
 import matplotlib.pyplot as plt
@@ -12,7 +12,18 @@ import logging
 import torch.nn.functional as F
 from sklearn.model_selection import ParameterGrid
 from Constants import Constants
+from DataSet.store import content_length
+from DataSet.dataset import content_matrix
 import random
+import copy
+import csv
+import time
+import traceback
+import types
+import re
+import fcntl
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 class PairWiseHingeLoss(nn.Module):
@@ -40,23 +51,464 @@ def grid_search(params_dic):
     return parameter_list
 
 
-def diversity_evaluation(diversity_answer_recommendation, topK, tfidf, lda):
+def config_copy(config, **overrides):
+    '''
+    snapshot of a config class (or namespace) so a trial can change it without touching the others
+    :param config: config_model or an object with the same attributes
+    :param overrides: attributes replaced in the copy
+    :return: SimpleNamespace holding a deep copy of every public attribute
+    '''
+    attrs = {}
+    for key, value in vars(config).items():
+        if key.startswith("__") or callable(value) or isinstance(value, (staticmethod, classmethod)):
+            continue
+        try:
+            attrs[key] = copy.deepcopy(value)
+        except Exception:
+            attrs[key] = value
+    attrs.update(overrides)
+    return types.SimpleNamespace(**attrs)
+
+
+# set before the worker processes are forked, so the trial function can be a closure over loaded data
+_grid_trial_fn = None
+
+
+def _grid_worker_init(thread_count):
+    torch.set_num_threads(thread_count)
+
+
+def _grid_run_trial(trial_id, trial_args):
+    start = time.time()
+    error = ""
+    try:
+        trial_args.eval_info = {}
+        _grid_trial_fn(trial_args)
+        metric = dict(trial_args.eval_info)
+    except Exception:
+        metric = {}
+        error = traceback.format_exc()
+    return trial_id, metric, time.time() - start, error
+
+
+def run_grid_search(trial_fn, params_dic, args, worker_count=1, result_file=None, checkpoint=None):
+    '''
+    run every configuration of the grid, worker_count trials at a time
+    each trial gets its own copy of args with the grid values set; the metrics the driver stores
+    in trial_args.eval_info are written to result_file as one csv row per trial
+    workers are forked, so data loaded by load_preprocessed is shared through its memory maps
+    :param trial_fn: trial_fn(trial_args), trains and evaluates one configuration
+    :param params_dic: same as grid_search
+    :param args: config the trials are copied from
+    :param worker_count: trials running at the same time, cpu threads are split among them
+    :param result_file: csv file of the trial results, None to only print them
+    :param checkpoint: CheckpointManager of the trials, trials it recorded as ended are not run again
+    :return: list of (paragram, metric) in grid order
+    '''
+    global _grid_trial_fn
+    pragram_list = grid_search(params_dic)
+    trial_list = [config_copy(args, trial_name=trialName(paragram), **paragram) for paragram in pragram_list]
+    if worker_count > 1 and torch.cuda.is_available() and torch.cuda.is_initialized():
+        print("[WARNING] cuda is already initialized in this process, grid search runs sequentially")
+        worker_count = 1
+
+    # rows of earlier sweeps stay in the table
+    row_list = []
+    if result_file is not None:
+        if os.path.dirname(result_file) != "" and os.path.isdir(os.path.dirname(result_file)) is False:
+            os.makedirs(os.path.dirname(result_file))
+        if os.path.exists(result_file):
+            with open(result_file, newline="") as f:
+                row_list = list(csv.DictReader(f))
+    result_list = [None] * len(trial_list)
+    if checkpoint is not None:
+        for trial_id, trial_args in enumerate(trial_list):
+            state = checkpoint.load_state(trial_args)
+            if state is not None and state["status"] != "running":
+                # its csv row was written by the run that ended it
+                print("[WARNING] trial {} {} NOT trained, restored from {} ({} at epoch {}): {}".format(
+                    trial_id, pragram_list[trial_id], checkpoint.run_dir(trial_args), state["status"], state["epoch"], state["metric"]))
+                result_list[trial_id] = (pragram_list[trial_id], state["metric"])
+        restored_count = sum(result is not None for result in result_list)
+        if restored_count > 0:
+            print("[WARNING] {} of {} trials restored from {} instead of trained, clear it to rerun them".format(
+                restored_count, len(trial_list), checkpoint.checkpoint_dir))
+    pending_list = [trial_id for trial_id in range(len(trial_list)) if result_list[trial_id] is None]
+    worker_count = max(1, min(worker_count, len(pending_list)))
+
+    def record(trial_id, metric, seconds, error):
+        paragram = pragram_list[trial_id]
+        result_list[trial_id] = (paragram, metric)
+        if error != "":
+            print("[WARNING] trial {} {} failed\n{}".format(trial_id, paragram, error))
+        else:
+            print("[INFO] trial {} {} finished in {:.1f}s: {}".format(trial_id, paragram, seconds, metric))
+        if result_file is None:
+            return
+        row = {"trial": trial_id}
+        row.update(paragram)
+        row.update(metric)
+        row["seconds"] = round(seconds, 1)
+        row["error"] = error.strip().split("\n")[-1] if error != "" else ""
+        row_list.append(row)
+        writeResultTable(result_file, row_list)
+
+    _grid_trial_fn = trial_fn
+    try:
+        if worker_count == 1:
+            for trial_id in pending_list:
+                trial_args = trial_list[trial_id]
+                print("[INFO] trial {}: {}".format(trial_id, pragram_list[trial_id]))
+                record(*_grid_run_trial(trial_id, trial_args))
+        else:
+            thread_count = max(1, multiprocessing.cpu_count() // worker_count)
+            print("[INFO] grid search: {} trials, {} workers, {} threads each".format(len(pending_list), worker_count, thread_count))
+            #ProcessPoolExecutor workers are not daemonic, so the DataLoader inside a trial can still start its own workers
+            with ProcessPoolExecutor(max_workers=worker_count, mp_context=multiprocessing.get_context("fork"),
+                                     initializer=_grid_worker_init, initargs=(thread_count,)) as executor:
+                futures = [executor.submit(_grid_run_trial, trial_id, trial_list[trial_id]) for trial_id in pending_list]
+                for future in as_completed(futures):
+                    record(*future.result())
+    finally:
+        _grid_trial_fn = None
+    return result_list
+
+
+def writeResultTable(result_file, row_list):
+    '''
+    rewrite the csv table with the union of the columns of every row, a failed trial or one that
+    reports fewer metrics does not decide the header; seconds and error stay the last columns
+    '''
+    fieldnames = []
+    for row in row_list:
+        fieldnames += [key for key in row.keys() if key not in fieldnames and key not in ("seconds", "error")]
+    fieldnames += ["seconds", "error"]
+    temp_file = result_file + ".tmp"
+    with open(temp_file, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, restval="")
+        writer.writeheader()
+        writer.writerows(row_list)
+    os.replace(temp_file, result_file)
+
+
+def trialName(paragram):
+    '''
+    file name friendly key of one grid point, {"lr": 0.001, "neighbor_number_list": [2, 5]} -> lr=0.001_neighbor_number_list=-2-5-
+    '''
+    name = "_".join("{}={}".format(key, value) for key, value in sorted(paragram.items()))
+    return re.sub(r"[^\w.=]+", "-", name)
+
+
+class HalvingScheduler:
+    '''
+    asynchronous successive halving (ASHA) over the epochs of grid search trials
+    a trial reaching a rung epoch (min_epoch * reduction^k) is stopped when its metric is not in the
+    top 1/reduction of the values other trials reported at that rung, so a sweep spends the full epoch
+    budget only on promising configurations
+    the rung records live in work_dir and are shared by the workers of run_grid_search, checkpoints and
+    resuming of the trials are left to CheckpointManager
+    '''
+    def __init__(self, work_dir, metric="P@1", min_epoch=2, reduction=3, max_epoch=40, higher_better=True):
+        self.work_dir = work_dir
+        self.metric = metric
+        self.reduction = reduction
+        self.max_epoch = max_epoch
+        self.higher_better = higher_better
+        self.rungs = []
+        rung = min_epoch
+        while rung < max_epoch:
+            self.rungs.append(rung)
+            rung *= reduction
+        self.state_file = os.path.join(work_dir, "halving_state.json")
+        if os.path.isdir(work_dir) is False:
+            os.makedirs(work_dir, exist_ok=True)
+        print("[INFO] successive halving on {}, rungs at epoch {}".format(metric, self.rungs))
+
+    def _update_state(self, update_fn):
+        # the json file is read and rewritten under an exclusive lock, workers of the pool share it
+        with open(self.state_file + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = {"rung": {}}
+                if os.path.exists(self.state_file):
+                    with open(self.state_file) as f:
+                        state = json.load(f)
+                result = update_fn(state)
+                temp_file = self.state_file + ".tmp"
+                with open(temp_file, "w") as f:
+                    json.dump(state, f)
+                os.replace(temp_file, self.state_file)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return result
+
+    def report(self, args, epoch):
+        '''
+        record the metric in args.eval_info after epoch epochs of training
+        :return: False when the trial should stop
+        '''
+        if epoch not in self.rungs:
+            return True
+        if self.metric not in args.eval_info:
+            raise KeyError("metric {} is not reported by eval_epoch, found {}".format(self.metric, list(args.eval_info.keys())))
+        value = float(args.eval_info[self.metric])
+
+        def decide(state):
+            record = state["rung"].setdefault(str(epoch), {})
+            record[args.trial_name] = value
+            score = np.array(list(record.values()))
+            value_sign = value
+            if self.higher_better is False:
+                score, value_sign = -score, -value
+            cutoff = np.percentile(score, (1 - 1.0 / self.reduction) * 100)
+            return bool(value_sign >= cutoff)
+
+        go_on = self._update_state(decide)
+        if go_on is False:
+            print("[INFO] trial {} stopped at epoch {}, {} = {}".format(args.trial_name, epoch, self.metric, value))
+        return go_on
+
+
+def rngState(model=None):
+    '''
+    python / numpy / torch (and cuda) random states, plus the torch.Generator of every object of the model that
+    owns one (UniformNeighborSampler of the graph models), in types torch.load reads back with weights_only
+    '''
+    numpy_state = np.random.get_state()
+    state = {"python": random.getstate(),
+             "numpy": (numpy_state[0], torch.from_numpy(numpy_state[1].astype(np.int64)), int(numpy_state[2]),
+                       int(numpy_state[3]), float(numpy_state[4])),
+             "torch": torch.get_rng_state(),
+             "generator": {}}
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    if model is not None:
+        for name, owner in _model_generators(model):
+            state["generator"][name] = (str(owner.generator.device), owner.generator.get_state())
+    return state
+
+
+def setRngState(state, model=None):
+    random.setstate(state["python"])
+    name, keys, pos, has_gauss, cached_gaussian = state["numpy"]
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+    if model is not None:
+        owner_dic = dict(_model_generators(model, created_only=False))
+        for name, (device, generator_state) in state["generator"].items():
+            if name not in owner_dic:
+                continue
+            owner = owner_dic[name]
+            if owner.generator is None or str(owner.generator.device) != device:
+                owner.generator = torch.Generator(device=device)
+            owner.generator.set_state(generator_state)
+
+
+def _model_generators(model, created_only=True):
+    # attributes of the modules holding a torch.Generator in .generator, created lazily by the sampler
+    for module_name, module in model.named_modules():
+        for key, owner in vars(module).items():
+            if hasattr(owner, "generator") is False or isinstance(owner, (torch.Tensor, nn.Module)):
+                continue
+            if isinstance(owner.generator, torch.Generator) or (created_only is False and owner.generator is None):
+                yield module_name + "." + key, owner
+
+
+def _atomic_save(obj, file):
+    temp_file = file + ".tmp"
+    torch.save(obj, temp_file)
+    os.replace(temp_file, file)
+
+
+class CheckpointManager:
+    '''
+    periodic checkpoints of the training runs of a driver, one sub directory of checkpoint_dir per run
+    (args.trial_name given by run_grid_search, "default" outside a grid search)
+    last.ckpt holds the model, the optimizer, the random states of rngState and the extra state of the driver,
+    so a resumed run draws the same shuffles, negative samples and dropout masks as an uninterrupted one;
+    the best_k checkpoints by metric are kept next to it as best_<epoch>.ckpt
+    state.json records the status of the run, run_grid_search skips the trials that already ended
+    every file is written to a temporary file and moved in place with os.replace
+    '''
+    def __init__(self, checkpoint_dir, metric="P@1", best_k=3, save_every=1, higher_better=True, scheduler=None):
+        '''
+
+        :param save_every: epochs between two saves of last.ckpt, the last epoch is always saved
+        :param scheduler: HalvingScheduler deciding whether a run goes on, None trains every run to the end
+        '''
+        self.checkpoint_dir = checkpoint_dir
+        self.metric = metric
+        self.best_k = best_k
+        self.save_every = max(1, save_every)
+        self.higher_better = higher_better
+        self.scheduler = scheduler
+        self.metric_warned = False
+
+    def run_dir(self, args):
+        return os.path.join(self.checkpoint_dir, getattr(args, "trial_name", "default"))
+
+    def load_state(self, args):
+        '''
+        :return: {"status": running / finished / stopped, "epoch", "metric", "best": [[epoch, value]]} or None
+        '''
+        state_file = os.path.join(self.run_dir(args), "state.json")
+        if os.path.exists(state_file) is False:
+            return None
+        with open(state_file) as f:
+            return json.load(f)
+
+    def _save_state(self, args, state):
+        state_file = os.path.join(self.run_dir(args), "state.json")
+        with open(state_file + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(state_file + ".tmp", state_file)
+
+    def restore(self, args, model, optimizer, extra=None):
+        '''
+        resume a run from its last checkpoint
+        :return: (first epoch to train, extra saved with the checkpoint), the first epoch is args.epoch
+        when the run already ended, args.eval_info then holds its last metrics
+        '''
+        state = self.load_state(args)
+        if state is not None and state["status"] != "running":
+            args.eval_info = dict(state["metric"])
+            print("[WARNING] run {} NOT trained, already {} at epoch {}, its stored metrics are reported: {}".format(
+                self.run_dir(args), state["status"], state["epoch"], state["metric"]))
+            return args.epoch, extra
+        checkpoint_file = os.path.join(self.run_dir(args), "last.ckpt")
+        if os.path.exists(checkpoint_file) is False:
+            return 0, extra
+        # random states have to stay on the cpu, load_state_dict moves the rest to the model's device
+        checkpoint = torch.load(checkpoint_file, map_location="cpu")
+        model.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        setRngState(checkpoint["rng"], model)
+        args.eval_info = dict(checkpoint["metric"])
+        print("[INFO] run {} resumed from epoch {}".format(self.run_dir(args), checkpoint["epoch"]))
+        return checkpoint["epoch"], checkpoint["extra"]
+
+    def report(self, args, epoch, model, optimizer, extra=None):
+        '''
+        checkpoint the run after epoch epochs of training, the metrics in args.eval_info rank the kept checkpoints
+        :param extra: any state the driver needs back from restore, made of tensors / numbers / strings / lists / dicts
+        :return: False when the run should stop
+        '''
+        go_on = True if self.scheduler is None else self.scheduler.report(args, epoch)
+        status = "running"
+        if go_on is False:
+            status = "stopped"
+        elif epoch >= args.epoch:
+            status = "finished"
+        metric = {key: float(value) for key, value in args.eval_info.items()}
+        run_dir = self.run_dir(args)
+        if os.path.isdir(run_dir) is False:
+            os.makedirs(run_dir, exist_ok=True)
+        state = self.load_state(args) or {"best": []}
+        best = state["best"]
+
+        value = metric.get(self.metric)
+        if value is None and self.best_k > 0 and self.metric_warned is False:
+            print("[WARNING] metric {} is not reported by eval_epoch, no best checkpoints are kept".format(self.metric))
+            self.metric_warned = True
+        sign = 1 if self.higher_better else -1
+        keep_best = value is not None and self.best_k > 0 and \
+            (len(best) < self.best_k or sign * value > min(sign * item[1] for item in best))
+        save_last = status == "finished" or (status == "running" and epoch % self.save_every == 0)
+        if save_last or keep_best:
+            checkpoint = {"epoch": epoch, "model": model.state_dict(), "optimizer": optimizer.state_dict(),
+                          "rng": rngState(model), "metric": metric, "extra": extra}
+            if save_last:
+                _atomic_save(checkpoint, os.path.join(run_dir, "last.ckpt"))
+            if keep_best:
+                _atomic_save(checkpoint, os.path.join(run_dir, "best_{}.ckpt".format(epoch)))
+                best = sorted([item for item in best if item[0] != epoch] + [[epoch, value]],
+                              key=lambda item: -sign * item[1])
+                for drop_epoch, _ in best[self.best_k:]:
+                    drop_file = os.path.join(run_dir, "best_{}.ckpt".format(drop_epoch))
+                    if os.path.exists(drop_file):
+                        os.remove(drop_file)
+                best = best[:self.best_k]
+
+        state.update(status=status, epoch=epoch, metric=metric, best=best)
+        self._save_state(args, state)
+        if status == "stopped" and os.path.exists(os.path.join(run_dir, "last.ckpt")):
+            # a stopped run is never resumed, only its best checkpoints are worth the disk
+            os.remove(os.path.join(run_dir, "last.ckpt"))
+        return go_on
+
+
+def diversity_evaluation(answer_id_recommendation, topK, tfidf, lda, content, user_count, chunk_size=2000):
+    '''
+    :param answer_id_recommendation: answer ids of every question in rank order, GroupedRankingEvaluator.ranked_answer_id
+    :param content: ContentEmbed, answer content is gathered from its content matrix only for a chunk of questions at a time
+    :param user_count: answer id - user_count is the row of the content matrix
+    '''
     #init evaluate class
+    question_count = len(answer_id_recommendation)
+    matrix = content_matrix(content)
     tf_idf_score = 0
     lda_score = 0
-    question_count = len(diversity_answer_recommendation)
-    for candidate_answer_list in diversity_answer_recommendation:
-        candidate_word_space = []
-        top_word_space = []
-        for answer_content in candidate_answer_list:
-            candidate_word_space += answer_content.tolist()
-        for top_answer_content in candidate_answer_list[:topK]:
-            top_word_space += top_answer_content.tolist()
-
-        tf_idf_score += tfidf.simiarity(candidate_word_space, top_word_space)
-        lda_score += lda.similarity(candidate_word_space, top_word_space)
+    for begin in range(0, question_count, chunk_size):
+        candidate_word_space_list = []
+        top_word_space_list = []
+        for answer_id in answer_id_recommendation[begin:begin + chunk_size]:
+            answer_content = matrix[np.asarray(answer_id, dtype=np.int64) - user_count]
+            candidate_word_space_list.append(answer_content.reshape(-1))
+            top_word_space_list.append(answer_content[:topK].reshape(-1))
+        # every question of the chunk scored in one sparse pass / one batched topic inference
+        tf_idf_score += np.sum(tfidf.similarity_batch(candidate_word_space_list, top_word_space_list))
+        lda_score += np.sum(lda.similarity_batch(candidate_word_space_list, top_word_space_list))
     return (tf_idf_score * 1.0) / question_count, (lda_score * 1.0) / question_count
 
+def sequence_length(content, pad=Constants.PAD):
+    '''
+    :param content: word ids padded at the end, any shape (..., max_len)
+    :return: position after the last real word, at least 1 so that empty posts can still be packed
+    '''
+    position = torch.arange(1, content.shape[-1] + 1, device=content.device)
+    return ((content != pad).long() * position).max(dim=-1)[0].clamp(min=1)
+
+
+def lstm_by_length(lstm, input, length, hidden=None, total_length=None):
+    '''
+    run a batch_first lstm over the real words only
+    a one-direction lstm runs on the batch cut at its longest post and the later steps are zeroed, its
+    outputs before the end of a post do not depend on the padding, and the dense kernel is much faster
+    than a packed sequence on cpu; a bidirectional lstm needs pack_padded_sequence for the backward pass
+    :param input: N * L * embed_size
+    :param length: N, from sequence_length
+    :param total_length: pad the output back to this length, default the longest post of the batch
+    :return: N * L' * hidden, steps after the end of a post are zero
+    '''
+    length = length.reshape(-1)
+    if lstm.bidirectional:
+        packed = nn.utils.rnn.pack_padded_sequence(input, length.cpu(), batch_first=True, enforce_sorted=False)
+        output, _ = lstm(packed, hidden)
+        output, _ = nn.utils.rnn.pad_packed_sequence(output, batch_first=True, total_length=total_length)
+        return output
+    max_len = int(length.max())
+    output, _ = lstm(input[:, :max_len], hidden)
+    mask = torch.arange(max_len, device=length.device).unsqueeze(0) < length.unsqueeze(1)
+    output = output * mask.unsqueeze(-1).to(output.dtype)
+    if total_length is not None and total_length > max_len:
+        output = F.pad(output, (0, 0, 0, total_length - max_len))
+    return output
+
+
+def masked_mean(output, length=None, keepdim=False):
+    '''
+    mean over the time dimension (-2) of an lstm output, only over the first length steps when length is given
+    the steps after length have to be zero, as in the output of lstm_by_length
+    '''
+    if length is None:
+        return torch.mean(output, dim=-2, keepdim=keepdim)
+    length = length.to(output.dtype).unsqueeze(-1)
+    output = torch.sum(output, dim=-2) / length
+    return output.unsqueeze(-2) if keepdim else output
+
+
 class LSTM_MeanPool(nn.Module):
     def __init__(self, args):
         super(LSTM_MeanPool, self).__init__()
@@ -75,25 +527,40 @@ class LSTM_MeanPool(nn.Module):
                               dtype=torch.float, device=self.args.device)
         return hiddena, hiddenb
 
-    def forward(self, input):
+    def forward(self, input, length=None):
+        '''
+        :param length: real length of every post (input.shape[:-2]), None runs over the padding too
+        '''
         shape = [*input.shape]
         input = input.view(-1, shape[-2], shape[-1])
         shape[-1] = 2 if self.args.bidirectional else 1
         shape[-1] = shape[-1] * self.args.lstm_hidden_size
         del shape[-2]
         hiddena, hiddenb = self.lstm_init(input.shape[0])
-        output, _ = self.lstm(input, (hiddena, hiddenb))
-        output = torch.mean(output, dim = -2)
+        if length is None:
+            output, _ = self.lstm(input, (hiddena, hiddenb))
+            output = torch.mean(output, dim = -2)
+        else:
+            length = length.reshape(-1)
+            output = masked_mean(lstm_by_length(self.lstm, input, length, (hiddena, hiddenb)), length)
         output = output.view(tuple(shape))
         return output
 
 class ContentEmbed:
-    def __init__(self, content):
+    def __init__(self, content, length=None):
         self.content = content
+        # real number of words of every post, see DataSet.store.content_length
+        self.length = length
 
     @property
     def content_list(self):
         return self.content
+
+    @property
+    def length_list(self):
+        if self.length is None:
+            self.length = content_length(np.asarray(self.content))
+        return self.length
     def content_embed(self, batch_id):
         if type(batch_id) is np.int or np.int64:
             content = self.content[batch_id]
@@ -126,50 +593,149 @@ class UserContextEmbed:
             document += pad_word
         return document
 
-    def buildUserContextEmbed(self, userContext):
-        userEmbed = []
+    def buildUserContextEmbed(self, userContext, file_path=None):
+        '''
+
+        :param userContext: {user_id: [answer_id, ...]}
+        :param file_path: if given, write the (user_count, max_u_len) int32 matrix to this .npy file
+        and return it memory-mapped instead of a list of lists
+        '''
         sorted_ = sorted(userContext.items(), key=lambda x: x[0])
+        if file_path is not None:
+            userEmbed = np.lib.format.open_memmap(file_path, mode='w+', dtype=np.int32,
+                                                  shape=(len(sorted_), self.args.max_u_len))
+        else:
+            userEmbed = []
         for id, (user_id, context_list) in enumerate(sorted_):
             assert id == user_id, "Not equal"
-            userEmbed.append(self.getUserContext(context_list))
+            if file_path is not None:
+                userEmbed[id] = self.getUserContext(context_list)
+            else:
+                userEmbed.append(self.getUserContext(context_list))
+        if file_path is not None:
+            userEmbed.flush()
+            del userEmbed
+            userEmbed = loadUserContextMatrix(file_path)
         return userEmbed
 
 
+def userContextFile(data_path, max_u_len):
+    '''
+    .npy cache of the padded user documents next to the data, keyed on the data so a rebuilt data set
+    does not silently reuse the matrix of the old one
+    :param data_path: preprocessed directory (its manifest is fingerprinted) or old torch pickle
+    '''
+    # resolved like load_preprocessed, data/<name>.torchpickle stands for the directory data/<name>/ when it exists
+    prefix = os.path.splitext(data_path.rstrip("/"))[0]
+    key_file = os.path.join(prefix, "manifest.json") if os.path.isdir(prefix) else data_path
+    return prefix + "_user_context_{}_{}.npy".format(max_u_len, fileFingerprint(key_file)[:12])
+
+
+def loadUserContextMatrix(file_path):
+    # read only memory map, DataLoader workers share the pages instead of copying the matrix
+    return np.load(file_path, mmap_mode='r')
+
 
 
 
+
+class CSRAdjacency:
+    '''
+    Neighbor table of the QA graph kept as CSR arrays.
+    sample() draws the padded (node_count + 1, max_degree) tables with one vectorized resample,
+    so it can be called again every epoch without rebuilding anything.
+    '''
+    def __init__(self, indptr, indices, edge_answer, edge_score):
+        self.indptr = np.asarray(indptr)
+        self.indices = np.asarray(indices)
+        self.edge_answer = np.asarray(edge_answer)
+        self.edge_score = np.asarray(edge_score)
+        self.node_count = len(self.indptr) - 1
+        self.degree = np.diff(self.indptr)
+
+    def sample(self, max_degree):
+        node_count = self.node_count
+        edge_count = len(self.indices)
+        degree = self.degree
+        adj = np.zeros((node_count + 1, max_degree), dtype=np.int64)
+        adj_edge = np.zeros_like(adj, dtype=np.int64)
+        adj_score = np.zeros_like(adj, dtype=np.float64)
+
+        # degree < max_degree: sample with replacement
+        small = np.nonzero((degree > 0) & (degree < max_degree))[0]
+        offset = (np.random.random_sample((len(small), max_degree)) * degree[small, None]).astype(np.int64)
+        small_edge = self.indptr[small, None] + offset
+
+        # degree >= max_degree: shuffle the edges of every node with random keys, keep the first max_degree
+        edge_node = np.repeat(np.arange(node_count), degree)
+        order = np.lexsort((np.random.random_sample(edge_count), edge_node))
+        rank = np.arange(edge_count) - self.indptr[edge_node]
+        keep = (rank < max_degree) & (degree[edge_node] >= max_degree)
+        large = edge_node[keep].reshape(-1, max_degree)[:, 0]
+        large_edge = order[keep].reshape(-1, max_degree)
+
+        for node, edge in ((small, small_edge), (large, large_edge)):
+            adj[node] = self.indices[edge]
+            adj_edge[node] = self.edge_answer[edge]
+            adj_score[node] = self.edge_score[edge]
+        adj = torch.LongTensor(adj)
+        adj_edge = torch.LongTensor(adj_edge)
+        adj_score = torch.IntTensor(adj_score)
+        #all the return are tensor
+        return adj, adj_edge, adj_score
+
+
+def graphAdjacency(G):
+    from DataSet.store import graph_to_csr
+    csr = graph_to_csr(G)
+    return CSRAdjacency(csr['indptr'], csr['indices'], csr['answer'], csr['score'])
+
+
 def Adjance(G, max_degree):
-    nodes_count = len(G.nodes())
-    adj = np.zeros((nodes_count + 1, max_degree), dtype=np.int64)
-    adj_edge = np.zeros_like(adj, dtype=np.int64)
-    adj_score = np.zeros_like(adj, dtype=np.float)
-    adj_degree = np.zeros(nodes_count + 1,)
-    for node in G.nodes():
-        assert not isinstance(node, str), "[ERROR] Argument of node should be int"
-        neighbors = np.array([neighbor for neighbor in G.neighbors(node)])
-        adj_degree[node] = len(neighbors)
-
-        if len(neighbors) == 0:
-            continue
-        if len(neighbors) < max_degree:
-            neighbors = np.random.choice(neighbors, max_degree, replace=True)
-        else:
-            neighbors = np.random.choice(neighbors, max_degree, replace=False)
+    return graphAdjacency(G).sample(max_degree)
+
 
-        for index, neigh_node in enumerate(neighbors):
-            adj_edge[node, index] = G[node][neigh_node]['a_id']
-            adj_score[node, index] = G[node][neigh_node]['score']
+def fileFingerprint(file, block_size=1 << 20):
+    # size, mtime and the first/last block, hashing the whole multi-GB text file would cost as much as parsing it
+    stat = os.stat(file)
+    digest = hashlib.sha1("{}:{}".format(stat.st_size, int(stat.st_mtime)).encode("utf-8"))
+    with open(file, "rb") as f:
+        digest.update(f.read(block_size))
+        f.seek(max(stat.st_size - block_size, 0))
+        digest.update(f.read(block_size))
+    return digest.hexdigest()
 
-        adj[node, :] = neighbors
-    adj = torch.LongTensor(adj)
-    adj_edge = torch.LongTensor(adj_edge)
-    adj_score = torch.IntTensor(adj_score)
-    #all the return are tensor
-    return adj, adj_edge, adj_score
 
+def embedCacheFile(cache_dir, file, embed_size, word2idx):
+    vocab = json.dumps(sorted(word2idx.items(), key=lambda x: x[1]), ensure_ascii=False)
+    vocab_hash = hashlib.sha1(vocab.encode("utf-8")).hexdigest()
+    key = hashlib.sha1("{}-{}-{}".format(fileFingerprint(file), vocab_hash, embed_size).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, "embed_{}_{}.npy".format(os.path.basename(file).split(".txt")[0], key[:16]))
 
 
-def loadEmbed(file, embed_size, vocab_size, word2idx=None, Debug=True):
+def readTextEmbed(file, embed_size, word2idx):
+    '''
+    Stream a glove / word2vec text file and keep only the rows of the vocabulary
+    '''
+    embed_matrix = np.zeros([len(word2idx), embed_size], dtype=np.float32)
+    found = 0
+    with open(file, encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            word, _, vector = line.rstrip().partition(" ")
+            i = word2idx.get(word)
+            if i is None:
+                continue
+            vector = np.array(vector.split(" "), dtype=np.float32)
+            # word2vec header "count dim" never matches a vocabulary word with a full vector
+            if len(vector) != embed_size:
+                continue
+            embed_matrix[i] = vector
+            found += 1
+    print("[Info] {} of {} words found in {}".format(found, len(word2idx), file))
+    return embed_matrix
+
+
+def loadEmbed(file, embed_size, vocab_size, word2idx=None, Debug=True, cache_dir=None):
     # read pretrained word2vec, convert to floattensor
     if(Debug):
         print("[WARN] load randn embedding for DEBUG")
@@ -178,24 +744,24 @@ def loadEmbed(file, embed_size, vocab_size, word2idx=None, Debug=True):
 
     #load pretrained model
     else:
-        embed_matrix = np.zeros([len(word2idx), embed_size])
+        cache_file = None
+        if cache_dir is not None:
+            cache_file = embedCacheFile(cache_dir, file, embed_size, word2idx)
+            if os.path.exists(cache_file):
+                print("[Info] load cached embedding {}".format(cache_file))
+                return torch.from_numpy(np.array(np.load(cache_file, mmap_mode='r')))
         print("[Info] load pre-trained word2vec embedding")
-        sub_dir = "/".join(file.split("/")[:-1])
-        if "glove" in file:
-            word2vec_file = ".".join(file.split("/")[-1].split(".")[:-1])+"word2vec"+".txt"
-            if word2vec_file not in os.listdir(sub_dir):
-                glove2word2vec(file, os.path.join(sub_dir, word2vec_file))
-            file = os.path.join(sub_dir, word2vec_file)
-
-        model = gensim.models.KeyedVectors.load_word2vec_format(file,
-                                                                binary=False)
+        embed_matrix = readTextEmbed(file, embed_size, word2idx)
         print("[Info] Load glove finish")
-
-        for word, i in word2idx.items():
-            if word in model.vocab:
-                embed_matrix[i] = model.word_vec(word)
-
-        weights = torch.FloatTensor(embed_matrix)
+        if cache_file is not None:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            # write then rename, a crashed run never leaves half a cache behind
+            temp_file = cache_file + ".tmp.npy"
+            np.save(temp_file, embed_matrix)
+            os.replace(temp_file, cache_file)
+
+        weights = torch.from_numpy(embed_matrix)
 
         return weights
 
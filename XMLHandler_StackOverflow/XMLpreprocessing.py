@@ -1,16 +1,42 @@
 """This module provides preprocessing routines for SemEval Task 3, Subtask B datasets."""
 
 from lxml import etree
-
-def parse_post(xmlfile):
+import time
+
+
+def iter_row(xmlfile, report_every=1000000):
+    '''
+    Stream the <row> elements of a StackExchange dump with iterparse.
+    Every row is cleared once the caller moves on, so memory does not grow with the file size.
+    '''
+    begin = time.time()
+    row_count = 0
+    for _, row in etree.iterparse(xmlfile, events=("end",), tag="row"):
+        yield row
+        row.clear()
+        # drop the processed siblings kept by the root
+        while row.getprevious() is not None:
+            del row.getparent()[0]
+        row_count += 1
+        if row_count % report_every == 0:
+            print("[INFO] {} rows in {}, {:.0f} rows/s".format(row_count, xmlfile, row_count / (time.time() - begin)))
+    print("[INFO] {} rows in {}, {:.0f} rows/s".format(row_count, xmlfile, row_count / max(time.time() - begin, 1e-6)))
+
+
+def read_row(xmlfile, streaming):
+    if streaming:
+        return iter_row(xmlfile)
+    return etree.parse(xmlfile).iterfind("row")
+
+
+def parse_post(xmlfile, streaming=False):
     content_dic = {}
     title_dic = {}
     user_context = {}
     accept_answer_dic = {}
-    tree = etree.parse(xmlfile)
     quesition_answer_user = {}
 
-    for row in tree.iterfind("row"):
+    for row in read_row(xmlfile, streaming):
         post_id = int(row.attrib['Id'])
         if post_id in content_dic:
             continue
@@ -53,12 +79,11 @@ def parse_post(xmlfile):
 
     return quesition_answer_user, content_dic, title_dic, accept_answer_dic, user_context
 
-def parse_vote(xmlfile):
+def parse_vote(xmlfile, streaming=False):
     vote_dic = {}
     love_dic = {}
-    tree = etree.parse(xmlfile)
     anoymous_user = 0
-    for row in tree.iterfind('row'):
+    for row in read_row(xmlfile, streaming):
         post_id = int(row.attrib['PostId'])
         vote_type_id = row.attrib['VoteTypeId']
         if vote_type_id == '2':
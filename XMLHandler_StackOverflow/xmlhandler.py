@@ -213,9 +213,9 @@ def read_xml_data(path):
     #TODO: handle multiple problem
     post_file = os.path.join(path, "Posts.xml")
     vote_file = os.path.join(path, "Votes.xml")
-    quesition_answer_user_dic, body_dic, title_dic, accept_answer_dic, user_context = parse_post(post_file)
+    quesition_answer_user_dic, body_dic, title_dic, accept_answer_dic, user_context = parse_post(post_file, config_data_preprocess.xml_streaming)
 
-    vote_dic, love_dic = parse_vote(vote_file)
+    vote_dic, love_dic = parse_vote(vote_file, config_data_preprocess.xml_streaming)
 
 
     for post_id, vote_count in vote_dic.items():
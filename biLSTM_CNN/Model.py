@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from MultihopAttention.Layer import LSTM_Hidden_List
+from Util import sequence_length, masked_mean
 #LSTM-BASED DEEP LEARNING MODELS FOR NONFACTOID ANSWER SELECTION
 class BiLstMCNN(torch.nn.Module):
     def __init__(self,
@@ -22,11 +23,15 @@ class BiLstMCNN(torch.nn.Module):
         good_answer_emebed = self.word_embed(good_answer)
 
 
-        question_lstm = self.lstm_bi(question_embed)
-        good_answer_lstm = self.lstm_bi(good_answer_emebed)
+        question_length, answer_length = None, None
+        if self.args.pack_sequence:
+            question_length = sequence_length(question)
+            answer_length = sequence_length(good_answer)
+        question_lstm = self.lstm_bi(question_embed, question_length)
+        good_answer_lstm = self.lstm_bi(good_answer_emebed, answer_length)
 
         #mean pooling
-        output_q = torch.mean(question_lstm, dim=-2, keepdim=True)
+        output_q = masked_mean(question_lstm, question_length, keepdim=True)
 
         m_good = torch.tanh(self.atten_weight_a(good_answer_lstm) + self.atten_weight_q(output_q))
 
@@ -38,7 +43,7 @@ class BiLstMCNN(torch.nn.Module):
         atten_good_answer = s_good * good_answer_lstm
 
         #mean pooling
-        pool_good_answer = torch.mean(atten_good_answer, dim=-2)
+        pool_good_answer = masked_mean(atten_good_answer, answer_length)
 
         output_q1 = output_q.squeeze()
         # drop_output_q1 = F.dropout(output_q1, 0.5)
@@ -13,9 +13,28 @@ from Util import createLogHandler
 from XMLHandler_StackOverflow import xmlhandler as stack_xmlhandler
 from XMLHandler_SemEval import xmlhandler as sem_xmlhandler
 from networkx import connected_components
-
-
-def shrink_clean_text(content, max_sent_len):
+from DataSet.store import save_preprocessed
+import os
+from multiprocessing import Pool
+
+
+def clean_worker_init():
+    # load the stop words once in every worker
+    TextClean.get_stop_words()
+
+def clean_text_list(content, worker_count, chunk_size):
+    ''' Clean every post, split into chunks over a pool of workers
+        The output keeps the order of content
+    '''
+    if worker_count <= 1:
+        word_insts = [TextClean.cleanText(sent) for sent in content]
+        print('[Info] Stem cache {}'.format(TextClean.cleaner.stem_info()))
+        return word_insts
+    with Pool(worker_count, initializer=clean_worker_init) as pool:
+        return pool.map(TextClean.cleanText, content, chunksize=chunk_size)
+
+def shrink_clean_text(content, max_sent_len, worker_count=config_data_preprocess.clean_worker,
+                      chunk_size=config_data_preprocess.clean_chunk_size):
     ''' Convert file into word seq lists and vocab
         Pad all element in sequence in the static length
      '''
@@ -24,9 +43,8 @@ def shrink_clean_text(content, max_sent_len):
     trimmed_sent_count = 0
     i = 0
     j = 0
-    for sent in content:
+    for words in clean_text_list(content, worker_count, chunk_size):
         i += 1
-        words = TextClean.cleanText(sent)
         if len(words) > max_sent_len:
             trimmed_sent_count += 1
         elif len(words) < max_sent_len:
@@ -264,8 +282,13 @@ def main():
     else:
         data["love_list_count"] = [[],[]]
         # config.save_data="data/store_SemEval.torchpickle"
-    print("Dumping the processed data to pickle file: {}".format(config.save_data))
-    torch.save(data, config.save_data)
+    if config.columnar:
+        save_dir = os.path.splitext(config.save_data)[0]
+        print("Dumping the processed data to directory: {}".format(save_dir))
+        save_preprocessed(data, save_dir)
+    else:
+        print("Dumping the processed data to pickle file: {}".format(config.save_data))
+        torch.save(data, config.save_data)
     print("Finish text extraction, storing")
 
 
@@ -0,0 +1,60 @@
+import sys
+import time
+#pytorch import
+from Util import *
+
+from DataSet.store import load_preprocessed
+from Serving.Retrieval import AnswerRetrieval
+from Serving.Registry import build_model
+from TextClean import TextClean
+from Config import config_model, config_data_preprocess
+
+
+def answer_pool(data):
+    '''
+    :return: answer ids (with offset) of every answer in the data set and the user who wrote it
+    '''
+    answer_user_dic = data['answer_user_dic']
+    answer_id = np.array(sorted(answer_user_dic.keys()), dtype=np.int64)
+    answer_user = np.array([answer_user_dic[i] for i in answer_id.tolist()], dtype=np.int64)
+    return answer_id, answer_user
+
+
+def main():
+    args = config_model
+    print("cuda : {}".format(args.cuda))
+    data = load_preprocessed(args.data)
+    word2ix = data['dict']
+    user_count = data['user_count']
+    content_embed = ContentEmbed(data['content'], data['content_len'] if 'content_len' in data else None)
+    pre_trained_word2vec = loadEmbed(args.embed_fileName, args.embed_size, args.vocab_size, word2ix, args.DEBUG,
+                                     cache_dir=args.embed_cache_dir).to(args.device)
+    model, score_fn = build_model(args.serve_model, args, data, pre_trained_word2vec, content_embed, args.serve_model_file)
+
+    answer_id, answer_user = answer_pool(data)
+    answer_content = np.asarray(content_embed.content_list)[answer_id - user_count]
+    if os.path.isdir(os.path.dirname(args.serve_cache)) is False:
+        os.makedirs(os.path.dirname(args.serve_cache))
+    start = time.time()
+    service = AnswerRetrieval(model, args, answer_content, answer_id=answer_id, answer_user=answer_user,
+                              word2vec=pre_trained_word2vec, score_fn=score_fn,
+                              cache_file=args.serve_cache + "_" + args.serve_model,
+                              candidate_count=args.serve_candidate, use_annoy=args.serve_use_annoy).build(args.serve_load_cache)
+    print("[INFO] {} answers indexed in {:.1f}s".format(len(answer_id), time.time() - start))
+
+    # one question per line on stdin, the top answers are written back as "answer_id:score"
+    for line in sys.stdin:
+        line = line.strip()
+        if line == "":
+            continue
+        start = time.time()
+        words = TextClean.cleanText(line)[:config_data_preprocess.max_len]
+        question = [word2ix.get(word, Constants.UNK) for word in words]
+        result = service.rank(question, args.serve_top_k)
+        print(" ".join("{}:{:.4f}".format(answer, score) for answer, score in result))
+        print("[INFO] ranked in {:.1f}ms".format((time.time() - start) * 1000))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
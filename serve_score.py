@@ -0,0 +1,52 @@
+import asyncio
+#pytorch import
+from Util import *
+
+from DataSet.store import load_preprocessed
+from Serving.Registry import build_model
+from Serving.Server import ScoringServer, local_benchmark
+from Config import config_model
+
+
+def benchmark_requests(data, user_count, request_count, answer_count):
+    '''
+    (question, candidate answers, users) requests built from the test split, every question with its own answers
+    '''
+    content = np.asarray(data['content'])
+    test_data = np.asarray(data['question_answer_user_test'])
+    request_list = []
+    for question_id in np.unique(test_data[:, 0])[:request_count]:
+        lines = test_data[test_data[:, 0] == question_id][:answer_count]
+        request_list.append((content[question_id - user_count].tolist(),
+                             content[lines[:, 1] - user_count].tolist(),
+                             lines[:, 2].tolist()))
+    return request_list
+
+
+async def serve(args, server, data):
+    await server.start(path=args.score_socket)
+    if args.score_bench:
+        request_list = benchmark_requests(data, data['user_count'], args.score_bench_request, args.serve_top_k)
+        _, stats = await local_benchmark(server, request_list, args.score_bench_client, path=args.score_socket)
+        print("[INFO] {}".format(stats))
+        await server.close()
+        return
+    await server.server.serve_forever()
+
+
+def main():
+    args = config_model
+    print("cuda : {}".format(args.cuda))
+    data = load_preprocessed(args.data)
+    word2ix = data['dict']
+    content_embed = ContentEmbed(data['content'], data['content_len'] if 'content_len' in data else None)
+    pre_trained_word2vec = loadEmbed(args.embed_fileName, args.embed_size, args.vocab_size, word2ix, args.DEBUG,
+                                     cache_dir=args.embed_cache_dir).to(args.device)
+    model, score_fn = build_model(args.serve_model, args, data, pre_trained_word2vec, content_embed, args.serve_model_file)
+    server = ScoringServer(score_fn, args, max_batch_rows=args.score_batch_rows, max_wait_ms=args.score_wait_ms,
+                           word_count=pre_trained_word2vec.shape[0], user_count=data['user_count'])
+    asyncio.run(serve(args, server, data))
+
+
+if __name__ == '__main__':
+    main()
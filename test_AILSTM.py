@@ -6,8 +6,10 @@ from Util import *
 from AILSTM.Model import AILSTM
 
 from DataSet.dataset import rankDataOrdinary, classifyDataOrdinary, my_collect_fn_test, my_clloect_fn_train, classify_collect_fn
+from DataSet.store import load_preprocessed
+from DataSet.sampler import data_loader
 from Metric.coverage_metric import *
-from Metric.rank_metrics import ndcg_at_k, average_precision, precision_at_k, mean_reciprocal_rank, Accuracy, marcoF1
+from Metric.rank_metrics import GroupedRankingEvaluator, ConfusionAccumulator
 from Config import config_model
 import os
 os.chdir("/home/yichuan/course/induceiveAnswer")
@@ -44,12 +46,12 @@ def prepare_dataloaders(data, args):
     test_data = data['question_answer_user_test']
     question_count = data['question_count']
     user_count = data['user_count']
-    content_embed = ContentEmbed(data['content'])
+    content_embed = ContentEmbed(data['content'], data['content_len'] if 'content_len' in data else None)
     answer_score = data['vote_sort']
 
     if args.is_classification:
 
-        train_loader = torch.utils.data.DataLoader(
+        train_loader = data_loader(args,
             classifyDataOrdinary(
                            args=args,
                         question_answer_user_vote=train_data,
@@ -62,7 +64,7 @@ def prepare_dataloaders(data, args):
         shuffle=True
         )
 
-        val_loader = torch.utils.data.DataLoader(
+        val_loader = data_loader(args,
         classifyDataOrdinary(
             args=args,
             question_answer_user_vote=test_data,
@@ -75,7 +77,7 @@ def prepare_dataloaders(data, args):
         shuffle=True
         )
     else:
-        train_loader = torch.utils.data.DataLoader(
+        train_loader = data_loader(args,
             rankDataOrdinary(
                 args=args,
                 question_answer_user_vote=train_data,
@@ -91,7 +93,7 @@ def prepare_dataloaders(data, args):
             collate_fn= my_clloect_fn_train
         )
 
-        val_loader = torch.utils.data.DataLoader(
+        val_loader = data_loader(args,
             rankDataOrdinary(
                 args=args,
                 question_answer_user_vote=test_data,
@@ -159,7 +161,7 @@ def train_epoch(model, data, optimizer, args, train_epoch_count):
 def eval_epoch(model, data, args, eval_epoch_count, tfidf_model, lda_model):
     model.eval()
     diversity_answer_recommendation = []
-    questionid_answer_score_gt_dic = {}
+    evaluator = GroupedRankingEvaluator()
     info_test = {}
     accuracy = 0
     one_count = 0
@@ -167,8 +169,7 @@ def eval_epoch(model, data, args, eval_epoch_count, tfidf_model, lda_model):
     line_count = 0
     loss_fn = nn.NLLLoss()
     loss = 0
-    predic_list = []
-    gt_list = []
+    confusion = ConfusionAccumulator()
     with torch.no_grad():
         for batch in tqdm(
             data, mininterval=2, desc="  ----(validation)----  ", leave=True
@@ -189,23 +190,17 @@ def eval_epoch(model, data, args, eval_epoch_count, tfidf_model, lda_model):
                 question_id_list = tensorTonumpy(question_id_list, args.cuda)
                 predic = tensorTonumpy(predic, args.cuda)
                 # biggest in the beginning
-                accuracy_temp, zero_count_temp, one_count_temp = Accuracy(gt_val, predic)
-                predic_list += predic.tolist()
-                gt_list += gt_val.tolist()
+                accuracy_temp, zero_count_temp, one_count_temp = confusion.update(gt_val, predic)
                 accuracy += accuracy_temp
                 zero_count += zero_count_temp
                 one_count += one_count_temp
                 assert one_count_temp + zero_count_temp == args.batch_size,"one count + zero count is not eqaul to batch size {} != {}".format(one_count_temp + zero_count_temp, args.batch_size)
 
-                for questionid, gt, pred_score in zip(question_id_list, gt_val, score):
-                    if questionid in questionid_answer_score_gt_dic:
-                        questionid_answer_score_gt_dic[questionid].append([pred_score, gt])
-                    else:
-                        questionid_answer_score_gt_dic[questionid] = [[pred_score, gt]]
+                evaluator.update(question_id_list, score, gt_val)
 
 
             else:
-                q_val, a_val, gt_val, question_id_list = map(lambda x: x.to(args.device), batch)
+                q_val, a_val, gt_val, question_id_list, answer_id_list = map(lambda x: x.to(args.device), batch)
                 args.batch_size = gt_val.shape[0]
                 line_count += args.batch_size
                 assert args.batch_size == gt_val.shape[0], "batch size is not eqaul {} != {}".format(args.batch_size, gt_val.shape[0])
@@ -213,12 +208,8 @@ def eval_epoch(model, data, args, eval_epoch_count, tfidf_model, lda_model):
                 score = tensorTonumpy(score, args.cuda)
                 gt_val = tensorTonumpy(gt_val, args.cuda)
                 question_id_list = tensorTonumpy(question_id_list, args.cuda)
-                a_val = tensorTonumpy(a_val, args.cuda)
-                for questionid, answer_content, gt, pred_score in zip(question_id_list, a_val, gt_val, score):
-                    if questionid in questionid_answer_score_gt_dic:
-                        questionid_answer_score_gt_dic[questionid].append([answer_content, pred_score, gt])
-                    else:
-                        questionid_answer_score_gt_dic[questionid] = [[answer_content, pred_score, gt]]
+                answer_id_list = tensorTonumpy(answer_id_list, args.cuda)
+                evaluator.update(question_id_list, score, gt_val, answer_id_list)
 
     mAP = 0
     mRP = 0
@@ -226,23 +217,19 @@ def eval_epoch(model, data, args, eval_epoch_count, tfidf_model, lda_model):
     ndcg_loss = 0
     tf_idf_score = 0
     lda_score = 0
-    for _, values in questionid_answer_score_gt_dic.items():
-        #biggest in the begining
-        answer_score_gt_reorder = sorted(values, key=lambda x: -x[-2])
-        rank_gt = [line[-1] for line in answer_score_gt_reorder]
-        if args.is_classification:
-           mAP += average_precision(rank_gt)
-           mRP += mean_reciprocal_rank([rank_gt])
-           p_at_one += precision_at_k([rank_gt], args.precesion_at_k)
-        else:
-            rank_answer_content = [line[0] for line in answer_score_gt_reorder]
-            tfidf_cov, lda_cov = diversity_evaluation([rank_answer_content], args.div_topK, tfidf_model, lda_model)
-            tf_idf_score += tfidf_cov
-            lda_score += lda_cov
-            ndcg_loss += ndcg_at_k(rank_gt, args.ndcg_k)
-            if np.argmax(rank_gt) == 0:
-                p_at_one += 1
-    question_count = len(questionid_answer_score_gt_dic)
+    question_count = evaluator.question_count
+    if args.is_classification:
+        mAP = evaluator.average_precision().sum()
+        mRP = evaluator.mean_reciprocal_rank().sum()
+        p_at_one = evaluator.precision_at_k(args.precesion_at_k).sum()
+    else:
+        ndcg_loss = evaluator.ndcg_at_k(args.ndcg_k).sum()
+        p_at_one = evaluator.top_is_best().sum()
+        #answer content is gathered by id for the diversity metric
+        tfidf_cov, lda_cov = diversity_evaluation(evaluator.ranked_answer_id(), args.div_topK, tfidf_model, lda_model,
+                                                  data.dataset.content_embed, data.dataset.user_count)
+        tf_idf_score = tfidf_cov * question_count
+        lda_score = lda_cov * question_count
 
 
     if args.is_classification:
@@ -251,7 +238,7 @@ def eval_epoch(model, data, args, eval_epoch_count, tfidf_model, lda_model):
         mRP = mRP *1.0 / question_count
         accuracy = accuracy * 1.0 / line_count
         loss = loss / question_count
-        f1_score = marcoF1(y_gt = gt_list, y_pred=predic_list)
+        f1_score = confusion.macro_f1()
         # visualize the data
         info_test['mAP'] = mAP
         info_test['P@1'] = p_at_one
@@ -278,13 +265,15 @@ def eval_epoch(model, data, args, eval_epoch_count, tfidf_model, lda_model):
 
 
 
+    #metrics of the last epoch rank the kept checkpoints
+    args.eval_info = dict(info_test)
     for tag, value in info_test.items():
         logger.scalar_summary(tag, value, eval_epoch_count)
 
     return diversity_answer_recommendation
 
 
-def train(args, train_data, val_data ,pre_trained_word2vec, content):
+def train(args, train_data, val_data ,pre_trained_word2vec, content, checkpoint=None):
     model = AILSTM(args, pre_trained_word2vec)
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
 
@@ -297,12 +286,16 @@ def train(args, train_data, val_data ,pre_trained_word2vec, content):
         tfidf = TFIDFSimilar(content, args.cov_pretrain, cov_model_path)
         lda = LDAsimilarity(content, args.lda_topic, args.cov_pretrain, cov_model_path)
     info_val = {}
-
-    for epoch_i in range(args.epoch):
+    start_epoch = 0
+    if checkpoint is not None:
+        start_epoch, _ = checkpoint.restore(args, model, optimizer)
+    for epoch_i in range(start_epoch, args.epoch):
 
         train_epoch(model, train_data, optimizer, args, epoch_i)
 
         eval_epoch(model, val_data, args, epoch_i, tfidf_model=tfidf, lda_model=lda)
+        if checkpoint is not None and checkpoint.report(args, epoch_i + 1, model, optimizer) is False:
+            break
         # for tag, value in info_val.items():
         #     logger.scalar_summary(tag, value, epoch_i)
 
@@ -316,18 +309,23 @@ def main():
     #,"tex.torchpickle", "apple.torchpickle","math.torchpickle"
     datasetname = [ "store_SemEval.torchpickle"]
     args = config_model
-    for datan in datasetname:
+    for run_i, datan in enumerate(datasetname):
         args.is_classification = True if "SemEval" in datan else False
         args.num_class = 2 if args.is_classification else 1
         args.data = datafoler + datan
         print("[FILE] Data file {}".format(datan))
         print("cuda : {}".format(args.cuda))
-        data = torch.load(args.data)
+        data = load_preprocessed(args.data)
         word2ix = data['dict']
         content = data['content']
         train_data, val_data = prepare_dataloaders(data, args)
-        pre_trained_word2vec = loadEmbed(args.embed_fileName, args.embed_size, args.vocab_size, word2ix, args.DEBUG).to(args.device)
-        train(args, train_data, val_data, pre_trained_word2vec, content)
+        pre_trained_word2vec = loadEmbed(args.embed_fileName, args.embed_size, args.vocab_size, word2ix, args.DEBUG,
+                                         cache_dir=args.embed_cache_dir).to(args.device)
+        # every run of the list keeps its own checkpoints, a restarted script skips the runs that ended
+        args.trial_name = "run{}".format(run_i)
+        checkpoint = CheckpointManager(args.checkpoint_dir.format(os.path.splitext(datan)[0]), args.checkpoint_metric,
+                                       args.checkpoint_best, args.checkpoint_every) if args.checkpoint else None
+        train(args, train_data, val_data, pre_trained_word2vec, content, checkpoint=checkpoint)
         args.cov_pretrain = False
 if __name__ == '__main__':
     main()
@@ -6,8 +6,10 @@ from Util import *
 from AMRNL.Model import AMRNL
 
 from DataSet.dataset import classifyDataSetUserContext, rankDataSetUserContext, my_collect_fn_test_hybrid, my_collect_fn_train_hybrid, classify_collect_fn_hybrid
+from DataSet.store import load_preprocessed
+from DataSet.sampler import data_loader
 from Metric.coverage_metric import *
-from Metric.rank_metrics import ndcg_at_k, average_precision, precision_at_k, mean_reciprocal_rank, Accuracy, marcoF1
+from Metric.rank_metrics import GroupedRankingEvaluator, ConfusionAccumulator
 from Config import config_model
 import os
 os.chdir("/home/yichuan/course/induceiveAnswer")
@@ -37,12 +39,12 @@ def prepare_dataloaders(data, args):
     test_data = data['question_answer_user_test']
     question_count = data['question_count']
     user_count = data['user_count']
-    content_embed = ContentEmbed(data['content'])
+    content_embed = ContentEmbed(data['content'], data['content_len'] if 'content_len' in data else None)
     answer_score = data['vote_sort']
     answer_user_dic = data['answer_user_dic']
 
     if args.is_classification:
-        train_loader = torch.utils.data.DataLoader(
+        train_loader = data_loader(args,
             classifyDataSetUserContext(
                 args=args,
                 question_answer_user_vote=train_data,
@@ -56,7 +58,7 @@ def prepare_dataloaders(data, args):
             collate_fn=classify_collect_fn_hybrid
         )
 
-        val_loader = torch.utils.data.DataLoader(
+        val_loader = data_loader(args,
             classifyDataSetUserContext(
                 args=args,
                 question_answer_user_vote=test_data,
@@ -113,17 +115,17 @@ def train_epoch(model, data, optimizer, args, train_epoch_count):
 def eval_epoch(model, data, args, eval_epoch_count):
     model.eval()
     diversity_answer_recommendation = []
-    questionid_answer_score_gt_dic = {}
+    evaluator = GroupedRankingEvaluator()
     info_test = {}
     line_count = 0
-    gt_list = []
-    predic_list = []
+    confusion = ConfusionAccumulator()
     with torch.no_grad():
         for batch in tqdm(
             data, mininterval=2, desc="  ----(validation)----  ", leave=True
         ):
 
-            q_val, a_val, user_val, gt_val, question_id_list = map(lambda x: x.to(args.device), batch)
+            # ranking batches end with the answer ids
+            q_val, a_val, user_val, gt_val, question_id_list = map(lambda x: x.to(args.device), batch[:5])
             args.batch_size = gt_val.shape[0]
             line_count += gt_val.shape[0]
             score, predic = model(q_val, a_val, user_val)
@@ -131,56 +133,42 @@ def eval_epoch(model, data, args, eval_epoch_count):
             score = score[:, 1]
             gt_val = tensorTonumpy(gt_val, args.cuda)
             predic = tensorTonumpy(predic, args.cuda)
-            gt_list += gt_val.tolist()
-            predic_list += predic.tolist()
+            confusion.update(gt_val, predic)
             question_id_list = tensorTonumpy(question_id_list, args.cuda)
 
             if args.is_classification:
-                for questionid, gt, pred_score in zip(question_id_list, gt_val, score):
-                    if questionid in questionid_answer_score_gt_dic:
-                        questionid_answer_score_gt_dic[questionid].append([pred_score, gt])
-                    else:
-                        questionid_answer_score_gt_dic[questionid] = [[pred_score, gt]]
+                evaluator.update(question_id_list, score, gt_val)
 
 
             else:
                 print("[WARNNING] DID NOT SUPPORT RANKING")
                 exit()
-                a_val = tensorTonumpy(a_val, args.cuda)
-                for questionid, answer_content, gt, pred_score in zip(question_id_list, a_val, gt_val, score):
-                    if questionid in questionid_answer_score_gt_dic:
-                        questionid_answer_score_gt_dic[questionid].append([answer_content, pred_score, gt])
-                    else:
-                        questionid_answer_score_gt_dic[questionid] = [[answer_content, pred_score, gt]]
+                answer_id_list = tensorTonumpy(batch[5], False)
+                evaluator.update(question_id_list, score, gt_val, answer_id_list)
 
     mAP = 0
     mRP = 0
     p_at_one = 0
     ndcg_loss = 0
 
-    for _, values in questionid_answer_score_gt_dic.items():
-        #biggest in the begining
-        answer_score_gt_reorder = sorted(values, key=lambda x: -x[-2])
-        rank_gt = [line[-1] for line in answer_score_gt_reorder]
-        if args.is_classification:
-           mAP += average_precision(rank_gt)
-           mRP += mean_reciprocal_rank([rank_gt])
-           p_at_one += precision_at_k([rank_gt], args.precesion_at_k)
-        else:
-            rank_answer_content = [line[0] for line in answer_score_gt_reorder]
-            diversity_answer_recommendation.append(rank_answer_content)
-            ndcg_loss += ndcg_at_k(rank_gt, args.ndcg_k)
-            if np.argmax(rank_gt) == 0:
-                p_at_one += 1
-    question_count = len(questionid_answer_score_gt_dic)
+    question_count = evaluator.question_count
+    if args.is_classification:
+        mAP = evaluator.average_precision().sum()
+        mRP = evaluator.mean_reciprocal_rank().sum()
+        p_at_one = evaluator.precision_at_k(args.precesion_at_k).sum()
+    else:
+        ndcg_loss = evaluator.ndcg_at_k(args.ndcg_k).sum()
+        p_at_one = evaluator.top_is_best().sum()
+        #answer ids of every question in rank order
+        diversity_answer_recommendation = evaluator.ranked_answer_id()
 
 
     if args.is_classification:
         mAP = mAP*1.0 / question_count
         p_at_one = p_at_one*1.0 / question_count
         mRP = mRP *1.0 / question_count
-        f1_score = marcoF1(y_gt=gt_list, y_pred=predic_list)
-        accuracy, one_count, zero_count = Accuracy(label=gt_list, predict=predic_list)
+        f1_score = confusion.macro_f1()
+        accuracy, one_count, zero_count = confusion.counts()
         accuracy  = accuracy*1.0 / (one_count + zero_count)
         # visualize the data
         info_test['mAP'] = mAP
@@ -200,6 +188,8 @@ def eval_epoch(model, data, args, eval_epoch_count):
     eval_epoch_count += 1
 
 
+    #metrics of the last epoch go to the grid search result table
+    args.eval_info = dict(info_test)
     for tag, value in info_test.items():
         logger.scalar_summary(tag, value, eval_epoch_count)
 
@@ -212,7 +202,7 @@ def eval_epoch(model, data, args, eval_epoch_count):
 
 
 
-def train(args, train_data, val_data ,pre_trained_word2vec, content, love_list_count,user_count):
+def train(args, train_data, val_data ,pre_trained_word2vec, content, love_list_count,user_count, checkpoint=None):
     love_adj_embed = ContentEmbed(torch.LongTensor(love_list_count[0]))
     love_weight = ContentEmbed(torch.FloatTensor(love_list_count[1]))
     model = AMRNL(args, user_count, pre_trained_word2vec, love_adj_embed, love_weight)
@@ -226,19 +216,26 @@ def train(args, train_data, val_data ,pre_trained_word2vec, content, love_list_c
         lda = LDAsimilarity(content, args.lda_topic, False, cov_model_path)
     info_val = {}
     diversity_answer_recommendation = []
-    for epoch_i in range(args.epoch):
+    start_epoch = 0
+    if checkpoint is not None:
+        start_epoch, _ = checkpoint.restore(args, model, optimizer)
+    for epoch_i in range(start_epoch, args.epoch):
 
         train_epoch(model, train_data, optimizer, args, epoch_i)
 
         diversity_answer_recommendation = eval_epoch(model, val_data, args, eval_epoch_count)
         if args.is_classification is False:
-            tfidf_cov, lda_cov = diversity_evaluation(diversity_answer_recommendation, args.div_topK, tfidf, lda)
+            tfidf_cov, lda_cov = diversity_evaluation(diversity_answer_recommendation, args.div_topK, tfidf, lda,
+                                                      val_data.dataset.content_embed, val_data.dataset.user_count)
 
             info_val['tfidf_cov'] = tfidf_cov
             info_val['lda_cov'] = lda_cov
             print("[INFO] tfidf coverage {}, lda coverage {}".format(tfidf_cov, lda_cov))
+        args.eval_info.update(info_val)
         for tag, value in info_val.items():
             logger.scalar_summary(tag, value, eval_epoch_count)
+        if checkpoint is not None and checkpoint.report(args, epoch_i + 1, model, optimizer) is False:
+            break
 
 
 
@@ -253,13 +250,14 @@ def main():
         args.data = datafoler + datan
         print("[FILE] Data file {}".format(args.data))
         print("cuda : {}".format(args.cuda))
-        data = torch.load(args.data)
+        data = load_preprocessed(args.data)
         word2ix = data['dict']
         content = data['content']
         love_list_count = data['love_list_count']
         user_count = data['user_count']
         train_data, val_data = prepare_dataloaders(data, args)
-        pre_trained_word2vec = loadEmbed(args.embed_fileName, args.embed_size, args.vocab_size, word2ix, args.DEBUG).to(args.device)
+        pre_trained_word2vec = loadEmbed(args.embed_fileName, args.embed_size, args.vocab_size, word2ix, args.DEBUG,
+                                         cache_dir=args.embed_cache_dir).to(args.device)
 
         paragram_dic = {"lstm_hidden_size": [128],
                         "lstm_num_layers": [2],
@@ -268,11 +266,13 @@ def main():
                         "nothing":[1, 2, 3, 4, 5]
                         # "margin": [0.1, 0.2, 0.3]
                         }
-        pragram_list = grid_search(paragram_dic)
-        for paragram in pragram_list:
-            for key, value in paragram.items():
-                print("Key: {}, Value: {}".format(key, value))
-                setattr(args, key, value)
-            train(args, train_data, val_data, pre_trained_word2vec, content, love_list_count, user_count)
+        scheduler = HalvingScheduler(args.halving_dir.format(os.path.splitext(datan)[0]), args.halving_metric,
+                                     args.halving_min_epoch, args.halving_reduction, args.epoch) if args.halving else None
+        checkpoint = CheckpointManager(args.checkpoint_dir.format(os.path.splitext(datan)[0]), args.checkpoint_metric, args.checkpoint_best,
+                                       args.checkpoint_every, scheduler=scheduler) if args.checkpoint or args.halving else None
+        def trial(trial_args):
+            train(trial_args, train_data, val_data, pre_trained_word2vec, content, love_list_count, user_count, checkpoint=checkpoint)
+        run_grid_search(trial, paragram_dic, args, worker_count=args.grid_worker,
+                        result_file=args.grid_result_file.format(os.path.splitext(datan)[0]), checkpoint=checkpoint)
 if __name__ == '__main__':
     main()
@@ -5,9 +5,11 @@ from Util import *
 
 from biLSTM_CNN.Model import BiLstMCNN
 
-from DataSet.dataset import rankDataOrdinary, my_clloect_fn_train, classify_collect_fn, classifyDataOrdinary
+from DataSet.dataset import rankDataOrdinary, my_clloect_fn_train, my_collect_fn_test, classify_collect_fn, classifyDataOrdinary
+from DataSet.store import load_preprocessed
+from DataSet.sampler import data_loader
 from Metric.coverage_metric import *
-from Metric.rank_metrics import ndcg_at_k, average_precision, precision_at_k, mean_reciprocal_rank, Accuracy, marcoF1
+from Metric.rank_metrics import GroupedRankingEvaluator, ConfusionAccumulator
 from Config import config_model
 import os
 # os.chdir("/home/yichuan/course/induceiveAnswer")
@@ -40,12 +42,12 @@ def prepare_dataloaders(data, args):
     test_data = data['question_answer_user_test']
     question_count = data['question_count']
     user_count = data['user_count']
-    content_embed = ContentEmbed(data['content'])
+    content_embed = ContentEmbed(data['content'], data['content_len'] if 'content_len' in data else None)
     answer_score = data['vote_sort']
     answer_user_dic = data['answer_user_dic']
 
     if args.is_classification:
-        train_loader = torch.utils.data.DataLoader(
+        train_loader = data_loader(args,
             classifyDataOrdinary(
                 args=args,
                 question_answer_user_vote=train_data,
@@ -58,7 +60,7 @@ def prepare_dataloaders(data, args):
             shuffle=True
         )
 
-        val_loader = torch.utils.data.DataLoader(
+        val_loader = data_loader(args,
             classifyDataOrdinary(
                 args=args,
                 question_answer_user_vote=test_data,
@@ -71,7 +73,7 @@ def prepare_dataloaders(data, args):
             shuffle=True
         )
     else:
-        train_loader = torch.utils.data.DataLoader(
+        train_loader = data_loader(args,
         rankDataOrdinary(
                 args=args,
                 question_answer_user_vote=train_data,
@@ -87,7 +89,7 @@ def prepare_dataloaders(data, args):
         collate_fn = my_clloect_fn_train
         )
 
-        val_loader = torch.utils.data.DataLoader(
+        val_loader = data_loader(args,
         rankDataOrdinary(
                 args=args,
                 question_answer_user_vote=test_data,
@@ -100,7 +102,7 @@ def prepare_dataloaders(data, args):
             num_workers=4,
             batch_size=args.batch_size,
             shuffle=True,
-            collate_fn = classify_collect_fn
+            collate_fn = my_collect_fn_test
         )
 
     return train_loader, val_loader
@@ -151,17 +153,17 @@ def train_epoch(model, data, optimizer, args, train_epoch_count):
 def eval_epoch(model, data, args, eval_epoch_count):
     model.eval()
     diversity_answer_recommendation = []
-    questionid_answer_score_gt_dic = {}
+    evaluator = GroupedRankingEvaluator()
     info_test = {}
     line_count = 0
-    predic_list = []
-    gt_list = []
+    confusion = ConfusionAccumulator()
     with torch.no_grad():
         for batch in tqdm(
             data, mininterval=2, desc="  ----(validation)----  ", leave=True
         ):
 
-            q_val, a_val, gt_val, question_id_list = map(lambda x: x.to(args.device), batch)
+            # ranking batches end with the answer ids
+            q_val, a_val, gt_val, question_id_list = map(lambda x: x.to(args.device), batch[:4])
             args.batch_size = gt_val.shape[0]
             line_count += gt_val.shape[0]
 
@@ -172,54 +174,40 @@ def eval_epoch(model, data, args, eval_epoch_count):
                 score = tensorTonumpy(score[:,1], args.cuda)
                 gt_val = tensorTonumpy(gt_val, args.cuda)
                 predic = tensorTonumpy(predic, args.cuda)
-                gt_list += gt_val.tolist()
-                predic_list += predic.tolist()
-                for questionid, gt, pred_score in zip(question_id_list, gt_val, score):
-                    if questionid in questionid_answer_score_gt_dic:
-                        questionid_answer_score_gt_dic[questionid].append([pred_score, gt])
-                    else:
-                        questionid_answer_score_gt_dic[questionid] = [[pred_score, gt]]
+                confusion.update(gt_val, predic)
+                evaluator.update(question_id_list, score, gt_val)
 
 
             else:
                 score = model(q_val, a_val, is_training=False)
                 score = tensorTonumpy(score, args.cuda)
                 gt_val = tensorTonumpy(gt_val, args.cuda)
-                a_val = tensorTonumpy(a_val, args.cuda)
-                for questionid, answer_content, gt, pred_score in zip(question_id_list, a_val, gt_val, score):
-                    if questionid in questionid_answer_score_gt_dic:
-                        questionid_answer_score_gt_dic[questionid].append([answer_content, pred_score, gt])
-                    else:
-                        questionid_answer_score_gt_dic[questionid] = [[answer_content, pred_score, gt]]
+                answer_id_list = tensorTonumpy(batch[4], False)
+                evaluator.update(question_id_list, score, gt_val, answer_id_list)
 
     mAP = 0
     mRP = 0
     p_at_one = 0
     ndcg_loss = 0
 
-    for _, values in questionid_answer_score_gt_dic.items():
-        #biggest in the begining
-        answer_score_gt_reorder = sorted(values, key=lambda x: -x[-2])
-        rank_gt = [line[-1] for line in answer_score_gt_reorder]
-        if args.is_classification:
-           mAP += average_precision(rank_gt)
-           mRP += mean_reciprocal_rank([rank_gt])
-           p_at_one += precision_at_k([rank_gt], args.precesion_at_k)
-        else:
-            rank_answer_content = [line[0] for line in answer_score_gt_reorder]
-            diversity_answer_recommendation.append(rank_answer_content)
-            ndcg_loss += ndcg_at_k(rank_gt, args.ndcg_k)
-            if np.argmax(rank_gt) == 0:
-                p_at_one += 1
-    question_count = len(questionid_answer_score_gt_dic)
+    question_count = evaluator.question_count
+    if args.is_classification:
+        mAP = evaluator.average_precision().sum()
+        mRP = evaluator.mean_reciprocal_rank().sum()
+        p_at_one = evaluator.precision_at_k(args.precesion_at_k).sum()
+    else:
+        ndcg_loss = evaluator.ndcg_at_k(args.ndcg_k).sum()
+        p_at_one = evaluator.top_is_best().sum()
+        #answer ids of every question in rank order
+        diversity_answer_recommendation = evaluator.ranked_answer_id()
 
 
     if args.is_classification:
         mAP = mAP*1.0 / question_count
         p_at_one = p_at_one*1.0 / question_count
         mRP = mRP *1.0 / question_count
-        f1_score = marcoF1(y_gt=gt_list, y_pred=predic_list)
-        accuracy, one_count, zero_count = Accuracy(label=gt_list, predict=predic_list)
+        f1_score = confusion.macro_f1()
+        accuracy, one_count, zero_count = confusion.counts()
         accuracy = accuracy * 1.0 / (one_count + zero_count)
         # visualize the data
         info_test['mAP'] = mAP
@@ -239,6 +227,8 @@ def eval_epoch(model, data, args, eval_epoch_count):
     eval_epoch_count += 1
 
 
+    #metrics of the last epoch go to the grid search result table
+    args.eval_info = dict(info_test)
     for tag, value in info_test.items():
         logger.scalar_summary(tag, value, eval_epoch_count)
 
@@ -251,7 +241,7 @@ def eval_epoch(model, data, args, eval_epoch_count):
 
 
 
-def train(args, train_data, val_data ,pre_trained_word2vec, content):
+def train(args, train_data, val_data ,pre_trained_word2vec, content, checkpoint=None):
     model = BiLstMCNN(args, pre_trained_word2vec)
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
 
@@ -262,19 +252,26 @@ def train(args, train_data, val_data ,pre_trained_word2vec, content):
         tfidf = TFIDFSimilar(content, False, cov_model_path)
         lda = LDAsimilarity(content, args.lda_topic, False, cov_model_path)
     info_val = {}
-    for epoch_i in range(args.epoch):
+    start_epoch = 0
+    if checkpoint is not None:
+        start_epoch, _ = checkpoint.restore(args, model, optimizer)
+    for epoch_i in range(start_epoch, args.epoch):
 
         train_epoch(model, train_data, optimizer, args, epoch_i)
 
         diversity_answer_recommendation = eval_epoch(model, val_data, args, eval_epoch_count)
         if args.is_classification is False:
-            tfidf_cov, lda_cov = diversity_evaluation(diversity_answer_recommendation, args.div_topK, tfidf, lda)
+            tfidf_cov, lda_cov = diversity_evaluation(diversity_answer_recommendation, args.div_topK, tfidf, lda,
+                                                      val_data.dataset.content_embed, val_data.dataset.user_count)
 
             info_val['tfidf_cov'] = tfidf_cov
             info_val['lda_cov'] = lda_cov
             print("[INFO] tfidf coverage {}, lda coverage {}".format(tfidf_cov, lda_cov))
+        args.eval_info.update(info_val)
         for tag, value in info_val.items():
             logger.scalar_summary(tag, value, eval_epoch_count)
+        if checkpoint is not None and checkpoint.report(args, epoch_i + 1, model, optimizer) is False:
+            break
 
 
 
@@ -290,25 +287,28 @@ def main():
         args.data = datafoler + datan
         print("[FILE] Data file {}".format(args.data))
         print("cuda : {}".format(args.cuda))
-        data = torch.load(args.data)
+        data = load_preprocessed(args.data)
         word2ix = data['dict']
         content = data['content']
         love_list_count = data['love_list_count']
         user_count = data['user_count']
         print(user_count)
         train_data, val_data = prepare_dataloaders(data, args)
-        pre_trained_word2vec = loadEmbed(args.embed_fileName, args.embed_size, args.vocab_size, word2ix, args.DEBUG).to(args.device)
+        pre_trained_word2vec = loadEmbed(args.embed_fileName, args.embed_size, args.vocab_size, word2ix, args.DEBUG,
+                                         cache_dir=args.embed_cache_dir).to(args.device)
         paragram_dic = {"lstm_hidden_size": [128],
                         "lstm_num_layers": [1, 2],
                         "drop_out_lstm": [0, 0.3],
                         "lr": [1e-4, 5e-4],
                         "run times":[1, 2, 3, 4, 5]
                         }
-        pragram_list = grid_search(paragram_dic)
-        for paragram in pragram_list:
-            for key, value in paragram.items():
-                print("Key: {}, Value: {}".format(key, value))
-                setattr(args, key, value)
-            train(args, train_data, val_data, pre_trained_word2vec, content)
+        scheduler = HalvingScheduler(args.halving_dir.format(os.path.splitext(datan)[0]), args.halving_metric,
+                                     args.halving_min_epoch, args.halving_reduction, args.epoch) if args.halving else None
+        checkpoint = CheckpointManager(args.checkpoint_dir.format(os.path.splitext(datan)[0]), args.checkpoint_metric, args.checkpoint_best,
+                                       args.checkpoint_every, scheduler=scheduler) if args.checkpoint or args.halving else None
+        def trial(trial_args):
+            train(trial_args, train_data, val_data, pre_trained_word2vec, content, checkpoint=checkpoint)
+        run_grid_search(trial, paragram_dic, args, worker_count=args.grid_worker,
+                        result_file=args.grid_result_file.format(os.path.splitext(datan)[0]), checkpoint=checkpoint)
 if __name__ == '__main__':
     main()
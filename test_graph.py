@@ -4,9 +4,10 @@ from tqdm import tqdm
 from Util import *
 
 from DataSet.dataset import classifyDataNei,classifyDataSetEdge, rankDataSetEdge, classify_collect_fn_hybrid, my_collect_fn_test_hybrid, my_collect_fn_test
+from DataSet.store import load_preprocessed
 from GraphSAGEDiv.DPP import *
 from Metric.coverage_metric import *
-from Metric.rank_metrics import ndcg_at_k, average_precision, precision_at_k, mean_reciprocal_rank, Accuracy, marcoF1
+from Metric.rank_metrics import GroupedRankingEvaluator, ConfusionAccumulator
 from Config import config_model
 from GraphSAGEDiv.ModelKey import InducieveLearningQA
 from Visualization.logger import Logger
@@ -133,9 +134,13 @@ def train_epoch(model, data, optimizer, args, train_epoch_count):
 
 def eval_epoch(model, data, args, eval_epoch_count):
     model.eval()
+    if args.eval_node_table:
+        model.build_node_table(args.node_table_batch)
     # 0.5917252146760343　random init
     diversity_answer_recommendation = []
-    questionid_answer_score_gt_dic = {}
+    evaluator = GroupedRankingEvaluator()
+    answer_id_list = []
+    answer_feature_list = []
     info_test = {}
     accuracy = 0
     one_count = 0
@@ -143,8 +148,7 @@ def eval_epoch(model, data, args, eval_epoch_count):
     line_count = 0
     loss_fn = nn.NLLLoss()
     loss = 0
-    gt_list = []
-    predic_list = []
+    confusion = ConfusionAccumulator()
     with torch.no_grad():
         for batch in tqdm(
             data, mininterval=2, desc="  ----(validation)----  ", leave=True
@@ -162,21 +166,15 @@ def eval_epoch(model, data, args, eval_epoch_count):
                 score = score[:,1]
                 gt_val = tensorTonumpy(gt_val, args.cuda)
                 predic = tensorTonumpy(predic, args.cuda)
-                gt_list += gt_val.tolist()
-                predic_list += predic.tolist()
                 question_id_list = tensorTonumpy(q_val, args.cuda)
                 # biggest in the beginning
-                accuracy_temp, zero_count_temp, one_count_temp = Accuracy(gt_val, predic)
+                accuracy_temp, zero_count_temp, one_count_temp = confusion.update(gt_val, predic)
                 accuracy += accuracy_temp
                 zero_count += zero_count_temp
                 one_count += one_count_temp
                 assert one_count_temp + zero_count_temp == args.batch_size,"one count + zero count is not eqaul to batch size{} != {}".format(one_count_temp + zero_count_temp, args.batch_size)
 
-                for questionid, gt, pred_score in zip(question_id_list, gt_val, score):
-                    if questionid in questionid_answer_score_gt_dic:
-                        questionid_answer_score_gt_dic[questionid].append([pred_score, gt])
-                    else:
-                        questionid_answer_score_gt_dic[questionid] = [[pred_score, gt]]
+                evaluator.update(question_id_list, score, gt_val)
 
 
             else:
@@ -184,41 +182,37 @@ def eval_epoch(model, data, args, eval_epoch_count):
                 args.batch_size = gt_val.shape[0]
                 line_count += args.batch_size
                 assert args.batch_size == gt_val.shape[0], "batch size is not eqaul {} != {}".format(args.batch_size, gt_val.shape[0])
-                score = model(q_val, a_val, u_val,need_feature=True)[0]
+                score, answer_feature = model(q_val, a_val, u_val,need_feature=True)
                 score = tensorTonumpy(score, args.cuda)
                 gt_val = tensorTonumpy(gt_val, args.cuda)
                 question_id_list = tensorTonumpy(q_val, args.cuda)
-                # a_val = tensorTonumpy(answer_feature, args.cuda)
-                for questionid, answer_content, gt, pred_score in zip(question_id_list, a_val, gt_val, score):
-                    if questionid in questionid_answer_score_gt_dic:
-                        questionid_answer_score_gt_dic[questionid].append([answer_content, pred_score, gt])
-                    else:
-                        questionid_answer_score_gt_dic[questionid] = [[answer_content, pred_score, gt]]
+                evaluator.update(question_id_list, score, gt_val)
+                if args.use_dpp:
+                    answer_id_list.append(tensorTonumpy(a_val, args.cuda))
+                    answer_feature_list.append(tensorTonumpy(answer_feature, args.cuda))
 
     mAP = 0
     mRP = 0
     p_at_one = 0
     ndcg_loss = 0
 
-    for _, values in questionid_answer_score_gt_dic.items():
-        #biggest in the begining
-        answer_score_gt_reorder = sorted(values,  key=lambda x: -x[-2])
-        rank_gt = [line[-1] for line in answer_score_gt_reorder]
-        if args.is_classification:
-           mAP += average_precision(rank_gt)
-           mRP += mean_reciprocal_rank([rank_gt])
-           p_at_one += precision_at_k([rank_gt], args.precesion_at_k)
-        else:
-
-            # rank_answer_content = np.array([line[0] for line in answer_score_gt_reorder])
-            # rank_relevance_score = [line[-1] for line in answer_score_gt_reorder]
-            # rank_list = list(range(len(rank_relevance_score)))
-            # rank_order = diversity(featureMatrix=rank_answer_content, rankList=rank_list, relevanceScore=rank_relevance_score, early_stop=args.dpp_early_stop)
-            # diversity_answer_recommendation.append(rank_order)
-            ndcg_loss += ndcg_at_k(rank_gt, args.ndcg_k)
-            if np.argmax(rank_gt) == 0:
-                p_at_one += 1
-    question_count = len(questionid_answer_score_gt_dic)
+    question_count = evaluator.question_count
+    if args.is_classification:
+        mAP = evaluator.average_precision().sum()
+        mRP = evaluator.mean_reciprocal_rank().sum()
+        p_at_one = evaluator.precision_at_k(args.precesion_at_k).sum()
+    else:
+        ndcg_loss = evaluator.ndcg_at_k(args.ndcg_k).sum()
+        p_at_one = evaluator.top_is_best().sum()
+        if args.use_dpp:
+            #greedy DPP re-ranking of all the questions in one batch, answer ids turned into content rows
+            rank_answer_list = evaluator.split(np.concatenate(answer_id_list))
+            rank_order_list = diversity_batch(evaluator.split(np.concatenate(answer_feature_list)),
+                                              evaluator.split(evaluator.scores()),
+                                              [list(range(len(answer_list))) for answer_list in rank_answer_list],
+                                              args.dpp_early_stop)
+            for answer_list, rank_order in zip(rank_answer_list, rank_order_list):
+                diversity_answer_recommendation.append(answer_list[rank_order])
 
 
     if args.is_classification:
@@ -227,7 +221,7 @@ def eval_epoch(model, data, args, eval_epoch_count):
         mRP = mRP * 1.0 / question_count
         accuracy = accuracy * 1.0 / line_count
         loss = loss / line_count
-        marco_f1 = marcoF1(y_gt=gt_list, y_pred=predic_list)
+        marco_f1 = confusion.macro_f1()
         # visualize the data
         info_test['mAP'] = mAP
         info_test['P@1'] = p_at_one
@@ -247,24 +241,29 @@ def eval_epoch(model, data, args, eval_epoch_count):
         print("[INFO] Ranking Porblem nDCGG: {}, p@1 is {}".format(ndcg_loss, p_at_one))
 
 
+    #metrics of the last epoch go to the grid search result table
+    args.eval_info = dict(info_test)
     for tag, value in info_test.items():
         logger.scalar_summary(tag, value, eval_epoch_count)
 
     return diversity_answer_recommendation
 
 
-def train(args, train_data, val_data, user_count, pre_trained_word2vec, G, content_numpy, context, epoch_count):
+def train(args, train_data, val_data, user_count, pre_trained_word2vec, G, content_numpy, context, epoch_count, checkpoint=None):
     content_embed = ContentEmbed(torch.LongTensor(content_numpy).to(args.device))
     content_numpy_embed = ContentEmbed(content_numpy)
     content_count = len(content_numpy)
     user_embed_model = UserContextEmbed(content_numpy_embed, args, user_count)
     user_embed_matrix = user_embed_model.buildUserContextEmbed(context)
     user_embed_matrix = ContentEmbed(torch.LongTensor(user_embed_matrix).to(args.device))
-    adj, adj_edge, _ = Adjance(G, args.max_degree)
+    adjacency = graphAdjacency(G)
+    adj, adj_edge, _ = adjacency.sample(args.max_degree)
     adj = adj.to(args.device)
     adj_edge = adj_edge.to(args.device)
+    # the padding row node_count has no neighbor
+    adj_degree = torch.LongTensor(np.append(adjacency.degree, 0)).to(args.device)
     model = InducieveLearningQA(args, user_count, content_count, adj, adj_edge, content_embed, user_embed_matrix,
-                                pre_trained_word2vec)
+                                pre_trained_word2vec, adj_degree=adj_degree)
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
 
     model.to(args.device)
@@ -273,30 +272,33 @@ def train(args, train_data, val_data, user_count, pre_trained_word2vec, G, conte
     tfidf = TFIDFSimilar(content_numpy, False, model_path)
     lda = LDAsimilarity(content_numpy, args.lda_topic, False, model_path)
     info_val = {}
-    for epoch_i in range(args.epoch):
+    start_epoch = 0
+    if checkpoint is not None:
+        start_epoch, epoch_count = checkpoint.restore(args, model, optimizer, epoch_count)
+    for epoch_i in range(start_epoch, args.epoch):
+        if args.resample_adj and epoch_i > 0:
+            adj, adj_edge, _ = adjacency.sample(args.max_degree)
+            model.sampler.neighbor_embed = adj.to(args.device)
+            model.sampler.edge_embed = adj_edge.to(args.device)
 
         train_epoch(model, train_data, optimizer, args, epoch_count)
 
-        eval_epoch(model, val_data, args, epoch_count)
+        diversity_answer_recommendation = eval_epoch(model, val_data, args, epoch_count)
 
         epoch_count += 1
-        # if args.is_classification is False:
-        #     lda_cov = 0
-        #     tfidf_cov = 0
-        #     for answer_id_list in diversity_answer_recommendation:
-        #         answer_content = content_numpy_embed.content_embed(answer_id_list)
-        #         temp_lda, temp_tfidf = diversity_evaluation(answer_content, args.div_topK, tfidf, lda)
-        #         lda_cov += temp_lda
-        #         tfidf_cov += temp_tfidf
-        #     tfidf_cov = tfidf_cov / len(diversity_answer_recommendation)
-        #     lda_cov = lda_cov / len(diversity_answer_recommendation)
-        #
-        #     info_val['tfidf'] = tfidf_cov
-        #     info_val['lda'] = lda_cov
-        #     print("[INFO] lda coverage: {}, tfidf coverage: {}".format(lda_cov, tfidf_cov))
+        if args.is_classification is False and args.use_dpp:
+            tfidf_cov, lda_cov = diversity_evaluation(diversity_answer_recommendation, args.div_topK, tfidf, lda,
+                                                      content_numpy_embed, model.user_count)
+
+            info_val['tfidf'] = tfidf_cov
+            info_val['lda'] = lda_cov
+            print("[INFO] lda coverage: {}, tfidf coverage: {}".format(lda_cov, tfidf_cov))
 
+        args.eval_info.update(info_val)
         for tag, value in info_val.items():
             logger.scalar_summary(tag, value, eval_epoch_count)
+        if checkpoint is not None and checkpoint.report(args, epoch_i + 1, model, optimizer, epoch_count) is False:
+            break
 
     return epoch_count
 
@@ -311,19 +313,15 @@ def main():
     #===========Load DataSet=============#
     args = config_model
     print("cuda : {}".format(args.cuda))
-    data = torch.load(args.data)
+    data = load_preprocessed(args.data)
     word2ix = data['dict']
     G = data['G']
     user_count = data['user_count']
     content = data['content']
     context = data['user_context']
     train_data, val_data= prepare_dataloaders(data, args)
-    if True:
-        pre_trained_word2vec = loadEmbed(args.embed_fileName, args.embed_size, args.vocab_size, word2ix, args.DEBUG).to(args.device)
-        torch.save(pre_trained_word2vec,"./word_vec_class.fuck")
-        pre_trained_word2vec = torch.load("./word_vec_class.fuck")
-    else:
-        pre_trained_word2vec = torch.load("./word_vec_class.fuck")
+    pre_trained_word2vec = loadEmbed(args.embed_fileName, args.embed_size, args.vocab_size, word2ix, args.DEBUG,
+                                     cache_dir=args.embed_cache_dir).to(args.device)
 
     #grid search
     # if args.model == 1:
@@ -334,15 +332,19 @@ def main():
                     "neighbor_number_list": [[2], [2, 5], [5,2],[5, 5]]
                     # "margin":[0.1, 0.2, 0.3]
                     }
-    pragram_list = grid_search(paragram_dic)
-    epoch_count = 0
-    for paragram in pragram_list:
-        for key, value in paragram.items():
-            print("Key: {}, Value: {}".format(key, value))
-            setattr(args, key, value)
-        epoch_count = train(epoch_count=epoch_count,
-            args=args, train_data=train_data, val_data=val_data,
-              user_count=user_count, G=G, content_numpy=content, pre_trained_word2vec=pre_trained_word2vec,context=context)
+    # trials run in one process keep counting epochs for the logger
+    epoch_count = [0]
+    scheduler = HalvingScheduler(args.halving_dir.format("graph"), args.halving_metric,
+                                 args.halving_min_epoch, args.halving_reduction, args.epoch) if args.halving else None
+    checkpoint = CheckpointManager(args.checkpoint_dir.format("graph"), args.checkpoint_metric, args.checkpoint_best,
+                                   args.checkpoint_every, scheduler=scheduler) if args.checkpoint or args.halving else None
+    def trial(trial_args):
+        epoch_count[0] = train(epoch_count=epoch_count[0],
+            args=trial_args, train_data=train_data, val_data=val_data,
+              user_count=user_count, G=G, content_numpy=content, pre_trained_word2vec=pre_trained_word2vec,context=context,
+              checkpoint=checkpoint)
+    run_grid_search(trial, paragram_dic, args, worker_count=args.grid_worker,
+                    result_file=args.grid_result_file.format("graph"), checkpoint=checkpoint)
 
 if __name__ == '__main__':
     main()
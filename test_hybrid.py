@@ -6,8 +6,10 @@ from Util import *
 from HybridAttention.Model import HybridAttentionModel
 
 from DataSet.dataset import classifyDataSetUserContext, rankDataSetUserContext, my_collect_fn_test_hybrid, my_collect_fn_train_hybrid, classify_collect_fn_hybrid
+from DataSet.store import load_preprocessed
+from DataSet.sampler import data_loader
 from Metric.coverage_metric import *
-from Metric.rank_metrics import ndcg_at_k, average_precision, precision_at_k, mean_reciprocal_rank, Accuracy, marcoF1
+from Metric.rank_metrics import GroupedRankingEvaluator, ConfusionAccumulator
 from Config import config_model
 import os
 os.chdir("/home/yichuan/course/induceiveAnswer")
@@ -31,20 +33,25 @@ def prepare_dataloaders(data, args):
     test_data = data['question_answer_user_test']
     question_count = data['question_count']
     user_count = data['user_count']
-    content_embed = ContentEmbed(data['content'])
+    content_embed = ContentEmbed(data['content'], data['content_len'] if 'content_len' in data else None)
     answer_score = data['vote_sort']
     user_context = data['user_context']
     answer_user_dic = data['answer_user_dic']
+    # padded user documents are built once and memory-mapped by every worker
+    user_context_file = userContextFile(args.data, args.max_u_len)
+    if os.path.exists(user_context_file) is False:
+        UserContextEmbed(content_embed, args, user_count).buildUserContextEmbed(user_context, user_context_file)
 
     if args.is_classification:
 
-        train_loader = torch.utils.data.DataLoader(
+        train_loader = data_loader(args,
             classifyDataSetUserContext(
                            args=args,
                         question_answer_user_vote=train_data,
                         content_embed=content_embed,
                         user_count=user_count,
                         user_context=user_context,
+                        user_context_file=user_context_file,
                         is_hybrid=True
                        ),
         num_workers=4,
@@ -53,13 +60,14 @@ def prepare_dataloaders(data, args):
         shuffle=True
         )
 
-        val_loader = torch.utils.data.DataLoader(
+        val_loader = data_loader(args,
         classifyDataSetUserContext(
             args=args,
             question_answer_user_vote=test_data,
             content_embed=content_embed,
             user_count=user_count,
             user_context=user_context,
+            user_context_file=user_context_file,
             is_hybrid=True
         ),
         num_workers=4,
@@ -68,7 +76,7 @@ def prepare_dataloaders(data, args):
         shuffle=True
         )
     else:
-        train_loader = torch.utils.data.DataLoader(
+        train_loader = data_loader(args,
             rankDataSetUserContext(
                 args=args,
                 question_answer_user_vote=train_data,
@@ -79,6 +87,7 @@ def prepare_dataloaders(data, args):
                 question_count=question_count,
                 answer_user_dic=answer_user_dic,
                 user_context=user_context,
+                user_context_file=user_context_file,
                 is_hybrid=True
             ),
             num_workers=4,
@@ -87,7 +96,7 @@ def prepare_dataloaders(data, args):
             collate_fn=my_collect_fn_train_hybrid
         )
 
-        val_loader = torch.utils.data.DataLoader(
+        val_loader = data_loader(args,
             rankDataSetUserContext(
                 args=args,
                 question_answer_user_vote=test_data,
@@ -155,7 +164,7 @@ def train_epoch(model, data, optimizer, args, train_epoch_count):
 def eval_epoch(model, data, args, eval_epoch_count):
     model.eval()
     diversity_answer_recommendation = []
-    questionid_answer_score_gt_dic = {}
+    evaluator = GroupedRankingEvaluator()
     info_test = {}
     accuracy = 0
     one_count = 0
@@ -163,8 +172,7 @@ def eval_epoch(model, data, args, eval_epoch_count):
     line_count = 0
     loss_fn = nn.NLLLoss()
     loss = 0
-    predic_list = []
-    gt_list = []
+    confusion = ConfusionAccumulator()
     with torch.no_grad():
         for batch in tqdm(
             data, mininterval=2, desc="  ----(validation)----  ", leave=True
@@ -180,25 +188,19 @@ def eval_epoch(model, data, args, eval_epoch_count):
                 loss += loss_fn(log_softmax, gt_val).item()
                 score = tensorTonumpy(score, args.cuda)
                 gt_val = tensorTonumpy(gt_val, args.cuda)
-                gt_list += gt_val.tolist()
-                predic_list += predic.tolist()
                 question_id_list = tensorTonumpy(question_id_list, args.cuda)
                 # biggest in the beginning
-                accuracy_temp, zero_count_temp, one_count_temp = Accuracy(gt_val, predic)
+                accuracy_temp, zero_count_temp, one_count_temp = confusion.update(gt_val, predic)
                 accuracy += accuracy_temp
                 zero_count += zero_count_temp
                 one_count += one_count_temp
                 assert one_count_temp + zero_count_temp == args.batch_size,"one count + zero count is not eqaul to batch size{} != {}".format(one_count_temp + zero_count_temp, args.batch_size)
 
-                for questionid, gt, pred_score in zip(question_id_list, gt_val, score):
-                    if questionid in questionid_answer_score_gt_dic:
-                        questionid_answer_score_gt_dic[questionid].append([pred_score, gt])
-                    else:
-                        questionid_answer_score_gt_dic[questionid] = [[pred_score, gt]]
+                evaluator.update(question_id_list, score, gt_val)
 
 
             else:
-                q_val, a_val, u_val, gt_val, question_id_list = map(lambda x: x.to(args.device), batch)
+                q_val, a_val, u_val, gt_val, question_id_list, _ = map(lambda x: x.to(args.device), batch)
                 args.batch_size = gt_val.shape[0]
                 line_count += args.batch_size
                 assert args.batch_size == gt_val.shape[0], "batch size is not eqaul {} != {}".format(args.batch_size, gt_val.shape[0])
@@ -206,33 +208,21 @@ def eval_epoch(model, data, args, eval_epoch_count):
                 score = tensorTonumpy(score, args.cuda)
                 gt_val = tensorTonumpy(gt_val, args.cuda)
                 question_id_list = tensorTonumpy(question_id_list, args.cuda)
-                a_val = tensorTonumpy(a_val, args.cuda)
-                for questionid, answer_content, gt, pred_score in zip(question_id_list, a_val, gt_val, score):
-                    if questionid in questionid_answer_score_gt_dic:
-                        questionid_answer_score_gt_dic[questionid].append([answer_content, pred_score, gt])
-                    else:
-                        questionid_answer_score_gt_dic[questionid] = [[answer_content, pred_score, gt]]
+                evaluator.update(question_id_list, score, gt_val)
 
     mAP = 0
     mRP = 0
     p_at_one = 0
     ndcg_loss = 0
 
-    for _, values in questionid_answer_score_gt_dic.items():
-        #biggest in the begining
-        answer_score_gt_reorder = sorted(values, key=lambda x: -x[-2])
-        rank_gt = [line[-1] for line in answer_score_gt_reorder]
-        if args.is_classification:
-           mAP += average_precision(rank_gt)
-           mRP += mean_reciprocal_rank([rank_gt])
-           p_at_one += precision_at_k([rank_gt], args.precesion_at_k)
-        else:
-            # rank_answer_content = [line[0] for line in answer_score_gt_reorder]
-            # diversity_answer_recommendation.append(rank_answer_content)
-            ndcg_loss += ndcg_at_k(rank_gt, args.ndcg_k)
-            if np.argmax(rank_gt) == 0:
-                p_at_one += 1
-    question_count = len(questionid_answer_score_gt_dic)
+    question_count = evaluator.question_count
+    if args.is_classification:
+        mAP = evaluator.average_precision().sum()
+        mRP = evaluator.mean_reciprocal_rank().sum()
+        p_at_one = evaluator.precision_at_k(args.precesion_at_k).sum()
+    else:
+        ndcg_loss = evaluator.ndcg_at_k(args.ndcg_k).sum()
+        p_at_one = evaluator.top_is_best().sum()
 
 
     if args.is_classification:
@@ -241,7 +231,7 @@ def eval_epoch(model, data, args, eval_epoch_count):
         mRP = mRP * 1.0 / question_count
         accuracy = accuracy * 1.0 / line_count
         loss = loss / line_count
-        f1 = marcoF1(y_gt=gt_list,y_pred=predic_list)
+        f1 = confusion.macro_f1()
         # visualize the data
         info_test['mAP'] = mAP
         info_test['P@1'] = p_at_one
@@ -263,6 +253,8 @@ def eval_epoch(model, data, args, eval_epoch_count):
     eval_epoch_count += 1
 
 
+    #metrics of the last epoch go to the grid search result table
+    args.eval_info = dict(info_test)
     for tag, value in info_test.items():
         logger.scalar_summary(tag, value, eval_epoch_count)
 
@@ -275,7 +267,7 @@ def eval_epoch(model, data, args, eval_epoch_count):
 
 
 
-def train(args, train_data, val_data ,pre_trained_word2vec, content):
+def train(args, train_data, val_data ,pre_trained_word2vec, content, checkpoint=None):
     model = HybridAttentionModel(args, pre_trained_word2vec)
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
 
@@ -287,7 +279,10 @@ def train(args, train_data, val_data ,pre_trained_word2vec, content):
         lda = LDAsimilarity(content, args.lda_topic, False, cov_model_path)
     info_val = {}
 
-    for epoch_i in range(args.epoch):
+    start_epoch = 0
+    if checkpoint is not None:
+        start_epoch, _ = checkpoint.restore(args, model, optimizer)
+    for epoch_i in range(start_epoch, args.epoch):
 
         train_epoch(model, train_data, optimizer, args, epoch_i)
 
@@ -298,8 +293,11 @@ def train(args, train_data, val_data ,pre_trained_word2vec, content):
         #     info_val['tfidf_cov'] = tfidf_cov
         #     info_val['lda_cov'] = lda_cov
         #     print("[INFO] tfidf coverage {}, lda coverage {}".format(tfidf_cov, lda_cov))
+        args.eval_info.update(info_val)
         for tag, value in info_val.items():
             logger.scalar_summary(tag, value, epoch_i)
+        if checkpoint is not None and checkpoint.report(args, epoch_i + 1, model, optimizer) is False:
+            break
 
 
 
@@ -314,20 +312,15 @@ def main():
         args.data = datafoler + datan
         print("[FILE] Data file {}".format(datan))
         print("cuda : {}".format(args.cuda))
-        data = torch.load(args.data)
+        data = load_preprocessed(args.data)
         word2ix = data['dict']
         content = data['content']
         # pre_trained_word2vec = loadEmbed(args.embed_fileName, args.embed_size, args.vocab_size, word2ix, args.DEBUG).to(
         #     args.device)
         train_data, val_data = prepare_dataloaders(data, args)
 
-        if False:
-            pre_trained_word2vec = loadEmbed(args.embed_fileName, args.embed_size, args.vocab_size, word2ix,
-                                             args.DEBUG).to(args.device)
-            torch.save(pre_trained_word2vec, "./word_vec_math.fuck")
-            pre_trained_word2vec = torch.load("./word_vec_math.fuck")
-        else:
-            pre_trained_word2vec = torch.load("./word_vec_math.fuck")
+        pre_trained_word2vec = loadEmbed(args.embed_fileName, args.embed_size, args.vocab_size, word2ix, args.DEBUG,
+                                         cache_dir=args.embed_cache_dir).to(args.device)
 
         args.is_classification = True if "SemEval" in datan else False
         paragram_dic = {"lstm_hidden_size": [128, 256],
@@ -336,13 +329,13 @@ def main():
                         "lr": [1e-4, 5e-4, 1e-3],
                         # "margin": [0.1, 0.2, 0.3]
                         }
-        pragram_list = grid_search(paragram_dic)
-        for paragram in pragram_list:
-            for key, value in paragram.items():
-                print("Key: {}, Value: {}".format(key, value))
-                setattr(args, key, value)
-
-
-            train(args, train_data, val_data, pre_trained_word2vec, content)
+        scheduler = HalvingScheduler(args.halving_dir.format(os.path.splitext(datan)[0]), args.halving_metric,
+                                     args.halving_min_epoch, args.halving_reduction, args.epoch) if args.halving else None
+        checkpoint = CheckpointManager(args.checkpoint_dir.format(os.path.splitext(datan)[0]), args.checkpoint_metric, args.checkpoint_best,
+                                       args.checkpoint_every, scheduler=scheduler) if args.checkpoint or args.halving else None
+        def trial(trial_args):
+            train(trial_args, train_data, val_data, pre_trained_word2vec, content, checkpoint=checkpoint)
+        run_grid_search(trial, paragram_dic, args, worker_count=args.grid_worker,
+                        result_file=args.grid_result_file.format(os.path.splitext(datan)[0]), checkpoint=checkpoint)
 if __name__ == '__main__':
     main()
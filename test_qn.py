@@ -4,7 +4,8 @@ from tqdm import tqdm
 from Util import *
 
 from DataSet.dataset import classifyDataNei, classify_collect_fn_Nei
-from Metric.rank_metrics import ndcg_at_k, average_precision, precision_at_k, mean_reciprocal_rank, Accuracy, marcoF1
+from DataSet.store import load_preprocessed
+from Metric.rank_metrics import GroupedRankingEvaluator, ConfusionAccumulator
 from Config import config_model
 from SimQues.Layer import *
 from SimQues.Model import QuestinGenerate
@@ -23,11 +24,16 @@ i_flag = 0
 train_epoch_count = 0
 eval_epoch_count = 0
 
-def prepare_dataloaders(data, ques_finder, args):
+def prepare_dataloaders(data, ques_finder, args, load_neighbor=False):
     # ========= Preparing DataLoader =========#
     train_data = np.array(data['question_answer_user_train'])
     test_data = np.array(data['question_answer_user_test'])
     user_count = data['user_count']
+    # same category neighbors are searched inside each split, as findSimCate does
+    train_neighbor = CategoryNeighbor("./data/annoy_index_train", ques_finder, train_data, user_count,
+                                      args.k_neighbor, load_file=load_neighbor)
+    test_neighbor = CategoryNeighbor("./data/annoy_index_test", ques_finder, test_data, user_count,
+                                     args.k_neighbor, load_file=load_neighbor)
     # if args.is_classification:
 
     train_loader = torch.utils.data.DataLoader(
@@ -35,8 +41,8 @@ def prepare_dataloaders(data, ques_finder, args):
                 args = args,
                 question_neighbor_finder=ques_finder,
                 user_count=user_count,
-                question_answer_user_vote_cate=train_data
-
+                question_answer_user_vote_cate=train_data,
+                question_neighbor_table=train_neighbor
             ),
             num_workers=4,
             batch_size=args.batch_size,
@@ -49,7 +55,8 @@ def prepare_dataloaders(data, ques_finder, args):
             args= args,
             question_neighbor_finder=ques_finder,
             user_count=user_count,
-            question_answer_user_vote_cate=test_data
+            question_answer_user_vote_cate=test_data,
+            question_neighbor_table=test_neighbor
         ),
         num_workers=4,
         batch_size=args.batch_size,
@@ -137,7 +144,7 @@ def eval_epoch(model, data, args, eval_epoch_count):
     model.eval()
     # 0.5917252146760343　random init
     diversity_answer_recommendation = []
-    questionid_answer_score_gt_dic = {}
+    evaluator = GroupedRankingEvaluator()
     info_test = {}
     accuracy = 0
     one_count = 0
@@ -145,8 +152,7 @@ def eval_epoch(model, data, args, eval_epoch_count):
     line_count = 0
     loss_fn = nn.NLLLoss()
     loss = 0
-    gt_list = []
-    predic_list = []
+    confusion = ConfusionAccumulator()
     with torch.no_grad():
         for batch in tqdm(
             data, mininterval=2, desc="  ----(validation)----  ", leave=True
@@ -165,21 +171,15 @@ def eval_epoch(model, data, args, eval_epoch_count):
                 score = score[:,1]
                 gt_val = tensorTonumpy(gt_val, args.cuda)
                 predic = tensorTonumpy(predic, args.cuda)
-                gt_list += gt_val.tolist()
-                predic_list += predic.tolist()
                 question_id_list = tensorTonumpy(q_val, args.cuda)
                 # biggest in the beginning
-                accuracy_temp, zero_count_temp, one_count_temp = Accuracy(gt_val, predic)
+                accuracy_temp, zero_count_temp, one_count_temp = confusion.update(gt_val, predic)
                 accuracy += accuracy_temp
                 zero_count += zero_count_temp
                 one_count += one_count_temp
                 assert one_count_temp + zero_count_temp == args.batch_size,"one count + zero count is not eqaul to batch size{} != {}".format(one_count_temp + zero_count_temp, args.batch_size)
 
-                for questionid, gt, pred_score in zip(question_id_list, gt_val, score):
-                    if questionid in questionid_answer_score_gt_dic:
-                        questionid_answer_score_gt_dic[questionid].append([pred_score, gt])
-                    else:
-                        questionid_answer_score_gt_dic[questionid] = [[pred_score, gt]]
+                evaluator.update(question_id_list, score, gt_val)
 
 
             else:
@@ -192,36 +192,21 @@ def eval_epoch(model, data, args, eval_epoch_count):
                 gt_val = tensorTonumpy(gt_val, args.cuda)
                 question_id_list = tensorTonumpy(q_val, args.cuda)
                 # a_val = tensorTonumpy(answer_feature, args.cuda)
-                for questionid, answer_content, gt, pred_score in zip(question_id_list, a_val, gt_val, score):
-                    if questionid in questionid_answer_score_gt_dic:
-                        questionid_answer_score_gt_dic[questionid].append([answer_content, pred_score, gt])
-                    else:
-                        questionid_answer_score_gt_dic[questionid] = [[answer_content, pred_score, gt]]
+                evaluator.update(question_id_list, score, gt_val)
 
     mAP = 0
     mRP = 0
     p_at_one = 0
     ndcg_loss = 0
 
-    for _, values in questionid_answer_score_gt_dic.items():
-        #biggest in the begining
-        answer_score_gt_reorder = sorted(values,  key=lambda x: -x[-2])
-        rank_gt = [line[-1] for line in answer_score_gt_reorder]
-        if args.is_classification:
-           mAP += average_precision(rank_gt)
-           mRP += mean_reciprocal_rank([rank_gt])
-           p_at_one += precision_at_k([rank_gt], args.precesion_at_k)
-        else:
-
-            # rank_answer_content = np.array([line[0] for line in answer_score_gt_reorder])
-            # rank_relevance_score = [line[-1] for line in answer_score_gt_reorder]
-            # rank_list = list(range(len(rank_relevance_score)))
-            # rank_order = diversity(featureMatrix=rank_answer_content, rankList=rank_list, relevanceScore=rank_relevance_score, early_stop=args.dpp_early_stop)
-            # diversity_answer_recommendation.append(rank_order)
-            ndcg_loss += ndcg_at_k(rank_gt, args.ndcg_k)
-            if np.argmax(rank_gt) == 0:
-                p_at_one += 1
-    question_count = len(questionid_answer_score_gt_dic)
+    question_count = evaluator.question_count
+    if args.is_classification:
+        mAP = evaluator.average_precision().sum()
+        mRP = evaluator.mean_reciprocal_rank().sum()
+        p_at_one = evaluator.precision_at_k(args.precesion_at_k).sum()
+    else:
+        ndcg_loss = evaluator.ndcg_at_k(args.ndcg_k).sum()
+        p_at_one = evaluator.top_is_best().sum()
 
 
     if args.is_classification:
@@ -230,7 +215,7 @@ def eval_epoch(model, data, args, eval_epoch_count):
         mRP = mRP * 1.0 / question_count
         accuracy = accuracy * 1.0 / line_count
         loss = loss / line_count
-        marco_f1 = marcoF1(y_gt=gt_list, y_pred=predic_list)
+        marco_f1 = confusion.macro_f1()
         # visualize the data
         info_test['mAP'] = mAP
         info_test['P@1'] = p_at_one
@@ -250,13 +235,15 @@ def eval_epoch(model, data, args, eval_epoch_count):
         print("[INFO] Ranking Porblem nDCGG: {}, p@1 is {}".format(ndcg_loss, p_at_one))
 
 
+    #metrics of the last epoch go to the grid search result table
+    args.eval_info = dict(info_test)
     for tag, value in info_test.items():
         logger.scalar_summary(tag, value, eval_epoch_count)
 
     return diversity_answer_recommendation
 
 
-def train(args, train_data, val_data, user_count, question_count, pre_trained_word2vec, content_numpy, context, epoch_count):
+def train(args, train_data, val_data, user_count, question_count, pre_trained_word2vec, content_numpy, context, epoch_count, checkpoint=None):
     content_embed = ContentEmbed(torch.LongTensor(content_numpy).to(args.device))
     content_numpy_embed = ContentEmbed(content_numpy)
     user_embed_model = UserContextEmbed(content_numpy_embed, args, user_count)
@@ -272,7 +259,10 @@ def train(args, train_data, val_data, user_count, question_count, pre_trained_wo
     # tfidf = TFIDFSimilar(content_numpy, False, model_path)
     # lda = LDAsimilarity(content_numpy, args.lda_topic, False, model_path)
     info_val = {}
-    for epoch_i in range(args.epoch):
+    start_epoch = 0
+    if checkpoint is not None:
+        start_epoch, epoch_count = checkpoint.restore(args, model, optimizer, epoch_count)
+    for epoch_i in range(start_epoch, args.epoch):
 
         train_epoch(model, train_data, optimizer, args, epoch_count)
 
@@ -294,8 +284,11 @@ def train(args, train_data, val_data, user_count, question_count, pre_trained_wo
         #     info_val['lda'] = lda_cov
         #     print("[INFO] lda coverage: {}, tfidf coverage: {}".format(lda_cov, tfidf_cov))
 
+        args.eval_info.update(info_val)
         for tag, value in info_val.items():
             logger.scalar_summary(tag, value, eval_epoch_count)
+        if checkpoint is not None and checkpoint.report(args, epoch_i + 1, model, optimizer, epoch_count) is False:
+            break
 
     return epoch_count
 
@@ -303,11 +296,7 @@ def train(args, train_data, val_data, user_count, question_count, pre_trained_wo
 
 def buildAnnoyIndex(question_count, content, topic_count):
     lda_model = LDAKey(content, topic_count=topic_count, model_path='./data/lda_model')
-    lda_vec = np.zeros((question_count, topic_count))
-    for i in range(question_count):
-        lda_output = lda_model.lda_by_index(i)
-        for key, value in lda_output:
-            lda_vec[i, key] = value
+    lda_vec = lda_model.lda_matrix(np.arange(question_count))
 
 
     # lda = LDAKey(content, topic_count, load_pretrain=False, model_path="./data/lda_model")
@@ -325,21 +314,21 @@ def main():
     #===========Load DataSet=============#
     args = config_model
     print("cuda : {}".format(args.cuda))
-    data = torch.load(args.data)
+    data = load_preprocessed(args.data)
     user_count = data['user_count']
     content = data['content']
     word2ix = data['dict']
     context = data['user_context']
     question_count = data['question_count']
-    if True:
-        pre_trained_word2vec = loadEmbed(args.embed_fileName, args.embed_size, args.vocab_size, word2ix, args.DEBUG).to(args.device)
-        torch.save(pre_trained_word2vec,"./word_vec_class.fuck")
+    load_pretrain = args.neighbor_pretrain
+    pre_trained_word2vec = loadEmbed(args.embed_fileName, args.embed_size, args.vocab_size, word2ix, args.DEBUG,
+                                     cache_dir=args.embed_cache_dir).to(args.device)
+    if load_pretrain is False:
         que_neighbor = buildAnnoyIndex(question_count, content, args.lda_topic)
     else:
-        pre_trained_word2vec = torch.load("./word_vec_class.fuck")
         que_neighbor = loadAnnoyIndex(args.lda_topic)
 
-    train_data, val_data= prepare_dataloaders(data, que_neighbor, args)
+    train_data, val_data= prepare_dataloaders(data, que_neighbor, args, load_neighbor=load_pretrain)
 
 
     #grid search
@@ -352,15 +341,19 @@ def main():
 
                     # "margin":[0.1, 0.2, 0.3]
                     }
-    pragram_list = grid_search(paragram_dic)
-    epoch_count = 0
-    for paragram in pragram_list:
-        for key, value in paragram.items():
-            print("Key: {}, Value: {}".format(key, value))
-            setattr(args, key, value)
-        epoch_count = train(epoch_count=epoch_count,
-            args=args, train_data=train_data, val_data=val_data,
-              user_count=user_count, question_count=question_count, content_numpy=content, pre_trained_word2vec=pre_trained_word2vec,context=context)
+    # trials run in one process keep counting epochs for the logger
+    epoch_count = [0]
+    scheduler = HalvingScheduler(args.halving_dir.format("qn"), args.halving_metric,
+                                 args.halving_min_epoch, args.halving_reduction, args.epoch) if args.halving else None
+    checkpoint = CheckpointManager(args.checkpoint_dir.format("qn"), args.checkpoint_metric, args.checkpoint_best,
+                                   args.checkpoint_every, scheduler=scheduler) if args.checkpoint or args.halving else None
+    def trial(trial_args):
+        epoch_count[0] = train(epoch_count=epoch_count[0],
+            args=trial_args, train_data=train_data, val_data=val_data,
+              user_count=user_count, question_count=question_count, content_numpy=content, pre_trained_word2vec=pre_trained_word2vec,context=context,
+              checkpoint=checkpoint)
+    run_grid_search(trial, paragram_dic, args, worker_count=args.grid_worker,
+                    result_file=args.grid_result_file.format("qn"), checkpoint=checkpoint)
 
 if __name__ == '__main__':
     main()